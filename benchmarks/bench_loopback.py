@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the board message processing, without broker.
+
+The backend (MQTTInterface, MsgMapper, MachineLogic and the repositories) is connected to an in-process
+loopback transport. Simulated boards send, for each action, requests one after the other and wait for
+each reply, so the round trip time only includes parsing, dispatching, handling and the database.
+
+Uses the test settings and recreates the test database (test-database.sqldb).
+
+Usage (from root folder):
+    python benchmarks/bench_loopback.py [--machines 10] [--users 200] [--count 500]
+"""
+
+import argparse
+import json
+import logging
+from time import perf_counter
+
+from FabOMatic.conf import FabConfig
+from FabOMatic.database.DatabaseBackend import DatabaseBackend
+from FabOMatic.logic.MsgMapper import MsgMapper
+from FabOMatic.mqtt.MQTTInterface import MQTTInterface
+from FabOMatic.mqtt.mqtt_types import EndUseQuery, InUseQuery, MachineQuery, StartUseQuery, SyncCacheQuery, UserQuery
+from FabOMatic.mqtt.transport import LoopbackBroker, LoopbackTransport
+from FabOMatic.simulator import loadFleet, setupFleet
+
+ACTIONS = {
+    "checkmachine": lambda card, i: MachineQuery(),
+    "checkuser": lambda card, i: UserQuery(card),
+    "startuse": lambda card, i: StartUseQuery(card),
+    "inuse": lambda card, i: InUseQuery(card, i),
+    "stopuse": lambda card, i: EndUseQuery(card, i),
+    "synccache": lambda card, i: SyncCacheQuery(),
+}
+
+
+def measure(broker: LoopbackBroker, topic: str, reply_subtopic: str, machine_id: int, cards: list[str], args):
+    """Sends args.count requests of each action from one board, returns the round trip times per action."""
+    board = LoopbackTransport(broker, f"bench-board-{machine_id}")
+    board.connect()
+    board.subscribe(f"{topic}/{machine_id}{reply_subtopic}")
+    results = {}
+    for action, build in ACTIONS.items():
+        times = []
+        for i in range(args.count):
+            query = build(cards[i % len(cards)], i)
+            start = perf_counter()
+            board.publish(f"{topic}/{machine_id}", query.toJSON())
+            reply = json.loads(board.received.get(timeout=10).payload)
+            times.append(perf_counter() - start)
+            if not reply.get("request_ok", False):
+                raise RuntimeError(f"{action} failed: {reply}")
+        results[action] = times
+    board.disconnect()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Board message processing benchmark, without broker")
+    parser.add_argument("--machines", type=int, default=10, help="Simulated machines in the database")
+    parser.add_argument("--users", type=int, default=200, help="Simulated users in the database")
+    parser.add_argument("-c", "--count", type=int, default=500, help="Requests per action")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    FabConfig.useTestSettings = True
+    settings = FabConfig.loadSubSettings("MQTT")
+
+    db = DatabaseBackend()
+    db.deleteExistingDatabase()
+    db.createAndUpdateDatabase()
+    setupFleet(db, args.machines, args.users)
+    machine_ids, cards = loadFleet(db)
+
+    broker = LoopbackBroker()
+    backend = MQTTInterface(lambda client_id: LoopbackTransport(broker, client_id))
+    MsgMapper(backend, db).registerHandlers()
+    backend.connect()
+    try:
+        results = measure(broker, settings["topic"], settings["reply_subtopic"], machine_ids[0], cards, args)
+    finally:
+        backend.disconnect()
+
+    print(f"{'Action':<14}{'msg/s':>10}{'p50 (ms)':>10}{'p99 (ms)':>10}")
+    for action, times in results.items():
+        times.sort()
+        p50 = times[len(times) // 2] * 1000
+        p99 = times[min(len(times) - 1, int(len(times) * 0.99))] * 1000
+        print(f"{action:<14}{len(times) / sum(times):>10.0f}{p50:>10.2f}{p99:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the board message classes.
+
+Compares the previous message classes (attributes in a __dict__, serialized with json.dumps of the
+__dict__) with the slotted classes of mqtt_types: memory allocated per message, serialization throughput,
+and the cost of a handler logging the query and the response at a disabled debug level.
+
+Usage (from root folder):
+    python benchmarks/bench_messages.py [--count 100000] [--repeat 5]
+"""
+
+import argparse
+import json
+import logging
+import tracemalloc
+from timeit import repeat
+
+from FabOMatic.mqtt.mqtt_types import MachineResponse, StartUseQuery, UserQuery, UserResponse
+
+
+class LegacyUserQuery:
+    """Query class as before the slotted classes."""
+
+    def __init__(self, card_uid: str):
+        self.uid = card_uid
+        self.action = "checkuser"
+
+    def toJSON(self):
+        return json.dumps(self, default=lambda o: (o.__dict__), sort_keys=True, separators=(",", ":"))
+
+
+class LegacyStartUseQuery(LegacyUserQuery):
+    def __init__(self, card_uid: str, replay: bool = False):
+        self.uid = card_uid
+        self.action = "startuse"
+        self.replay = replay
+
+
+class LegacyUserResponse:
+    def __init__(self, request_ok: bool, is_valid: bool, holder_name: str, user_level: int, missing_auth: bool):
+        self.request_ok = request_ok
+        self.is_valid = is_valid
+        self.name = holder_name
+        self.missing_auth = missing_auth
+        self.level = user_level
+
+    def serialize(self) -> str:
+        return json.dumps(self.__dict__)
+
+
+class LegacyMachineResponse:
+    def __init__(self, request_ok, is_valid, maintenance, allowed, name, type_id, logoff, grace, description):
+        self.request_ok = request_ok
+        self.is_valid = is_valid
+        self.maintenance = maintenance
+        self.allowed = allowed
+        self.name = name
+        self.logoff = logoff
+        self.type = type_id
+        self.grace = grace
+        self.description = description
+
+    def serialize(self) -> str:
+        return json.dumps(self.__dict__)
+
+
+def allocated(build, count: int) -> float:
+    """Returns the memory allocated per object kept alive, in bytes."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [build(i) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # The list itself holds one pointer per object
+    return (after - before) / len(objects) - 8
+
+
+def best(statement, count: int, nb_repeat: int) -> float:
+    """Returns the best throughput over the repeats, in operations per second."""
+    return count / min(repeat(statement, number=count, repeat=nb_repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Board message classes benchmark")
+    parser.add_argument("-c", "--count", type=int, default=100000, help="Operations per measure")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Measures, the best one is kept")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.INFO)
+
+    cases = {
+        "UserQuery": (lambda i: LegacyUserQuery(f"{i:08X}"), lambda i: UserQuery(f"{i:08X}")),
+        "StartUseQuery": (lambda i: LegacyStartUseQuery(f"{i:08X}"), lambda i: StartUseQuery(f"{i:08X}")),
+        "UserResponse": (
+            lambda i: LegacyUserResponse(True, True, "Mario", 2, False),
+            lambda i: UserResponse(True, True, "Mario", 2, False),
+        ),
+        "MachineResponse": (
+            lambda i: LegacyMachineResponse(True, True, False, True, "Laser", 1, 120, 2, "CO2 laser"),
+            lambda i: MachineResponse(True, True, False, True, "Laser", 1, 120, 2, "CO2 laser"),
+        ),
+    }
+
+    print(f"{'Memory per message':<40}{'legacy (B)':>14}{'slotted (B)':>14}")
+    for name, (legacy, slotted) in cases.items():
+        print(f"{name:<40}{allocated(legacy, args.count):>14.0f}{allocated(slotted, args.count):>14.0f}")
+
+    query, legacy_query = UserQuery("1234ABCD"), LegacyUserQuery("1234ABCD")
+    response = MachineResponse(True, True, False, True, "Laser", 1, 120, 2, "CO2 laser")
+    legacy_response = LegacyMachineResponse(True, True, False, True, "Laser", 1, 120, 2, "CO2 laser")
+
+    def legacy_handler():
+        logger.debug("Machine query: %s -> response: %s", legacy_query.toJSON(), legacy_response.serialize())
+        return legacy_response.serialize()
+
+    def handler():
+        logger.debug("Machine query: %s -> response: %s", query, response)
+        return response.serialize()
+
+    measures = {
+        "UserQuery.toJSON": (legacy_query.toJSON, query.toJSON),
+        "MachineResponse.serialize": (legacy_response.serialize, response.serialize),
+        "Handler, debug log disabled": (legacy_handler, handler),
+    }
+    print(f"\n{'Throughput':<40}{'legacy (/s)':>14}{'slotted (/s)':>14}{'speedup':>10}")
+    for name, (legacy, slotted) in measures.items():
+        before = best(legacy, args.count, args.repeat)
+        after = best(slotted, args.count, args.repeat)
+        print(f"{name:<40}{before:>14.0f}{after:>14.0f}{after / before:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
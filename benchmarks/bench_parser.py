@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of the board message decoding.
+
+Compares, for each action type, the previous decoding path (UTF-8 decode of the payload, json.loads
+to read the action, then a second json.loads in the query deserialize method) with Parser.parse
+decoding the raw payload once.
+
+Usage (from root folder):
+    python benchmarks/bench_parser.py [--count 100000] [--repeat 5]
+"""
+
+import argparse
+import json
+from timeit import repeat
+
+from FabOMatic.mqtt.mqtt_types import Parser
+
+PAYLOADS = {
+    "checkuser": b'{"action": "checkuser", "uid": "1234ABCD"}',
+    "checkmachine": b'{"action": "checkmachine"}',
+    "startuse": b'{"action": "startuse", "uid": "1234ABCD", "replay": false}',
+    "inuse": b'{"action": "inuse", "uid": "1234ABCD", "duration": 1234}',
+    "stopuse": b'{"action": "stopuse", "uid": "1234ABCD", "duration": 1234, "replay": false}',
+    "maintenance": b'{"action": "maintenance", "uid": "1234ABCD", "replay": false}',
+    "alive": b'{"action": "alive", "version": "1.0.4", "ip": "192.168.1.10", "serial": "A0B1C2", "heap": 150000}',
+    "synccache": b'{"action": "synccache"}',
+}
+
+
+def legacy_parse(payload: bytes):
+    """Decoding path used before the single-pass parser: the payload was decoded twice."""
+    message = payload.decode("utf-8")
+    data = json.loads(message)
+    return Parser._query_types[data["action"]].deserialize(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Board message decoding microbenchmark")
+    parser.add_argument("-c", "--count", type=int, default=100000, help="Messages decoded per measure")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Measures per action, best one is kept")
+    args = parser.parse_args()
+
+    def rate(func) -> float:
+        return args.count / min(repeat(func, number=args.count, repeat=args.repeat))
+
+    print(f"{'action':<14}{'before (msg/s)':>16}{'after (msg/s)':>16}{'speedup':>10}")
+    for action, payload in PAYLOADS.items():
+        before = rate(lambda: legacy_parse(payload))
+        after = rate(lambda: Parser.parse(payload))
+        print(f"{action:<14}{before:>16,.0f}{after:>16,.0f}{after / before:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the SQLite profiles ([database.sqlite] settings) under concurrent web reads and MQTT writes.
+
+For each profile, a temporary database is filled with uses, then one thread applies board events
+(startuse, inuse, stopuse, each one committed as by the MQTT workers) while other threads run the
+queries of the web pages (uses list, maintenance status). Reports the throughput and latencies of both,
+and the number of operations which failed on a locked database.
+
+Usage (from root folder):
+    python benchmarks/bench_sqlite_profile.py [--duration 10] [--readers 2] [--uses 50000]
+"""
+
+import argparse
+import logging
+import os
+import random
+import tempfile
+import threading
+from time import perf_counter, time
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from FabOMatic.database.models import Base, Machine, MachineType, Maintenance, Role, Use, User
+from FabOMatic.database.repositories import MaintenanceCounterRepository, UseRepository
+from FabOMatic.database.sqlite_profile import SqliteProfile
+
+PROFILES = {
+    # Settings before the [database.sqlite] section: rollback journal, SQLite defaults
+    "rollback journal": SqliteProfile(
+        journal_mode="DELETE", synchronous="FULL", cache_size=-2000, temp_store="DEFAULT", optimize_interval_s=0
+    ),
+    "WAL (default)": SqliteProfile(),
+    "WAL, synchronous FULL": SqliteProfile(synchronous="FULL"),
+    "WAL, 256 MB mmap": SqliteProfile(mmap_size=256 * 1024 * 1024),
+}
+
+
+def populate(factory, uses: int, machines: int, rnd: random.Random) -> list[int]:
+    """Creates the test data, returns the machine IDs."""
+    with factory() as session:
+        machine_type = MachineType(type_name="type")
+        role = Role(role_name="user")
+        session.add_all([machine_type, role])
+        session.flush()
+        session.add_all(
+            Machine(machine_name=f"machine {i}", machine_type_id=machine_type.type_id) for i in range(machines)
+        )
+        session.add_all(User(name=f"name {i}", surname="surname", role_id=role.role_id) for i in range(100))
+        session.flush()
+        machine_ids = [machine_id for (machine_id,) in session.query(Machine.machine_id)]
+        user_ids = [user_id for (user_id,) in session.query(User.user_id)]
+        session.add_all(Maintenance(hours_between=100, description="check", machine_id=m) for m in machine_ids)
+        now = time()
+        rows = []
+        for _ in range(uses):
+            start = now - rnd.uniform(0, 365 * 24 * 3600)
+            end = start + rnd.randint(60, 4 * 3600)
+            rows.append(
+                {
+                    "user_id": rnd.choice(user_ids),
+                    "machine_id": rnd.choice(machine_ids),
+                    "start_timestamp": start,
+                    "last_seen": end,
+                    "end_timestamp": end,
+                }
+            )
+        session.execute(insert(Use), rows)
+        session.commit()
+    return machine_ids
+
+
+class Worker(threading.Thread):
+    """Runs an operation in a loop until stopped, keeping the latencies."""
+
+    def __init__(self, operation, stop: threading.Event):
+        super().__init__(daemon=True)
+        self._operation = operation
+        self._stopping = stop
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        while not self._stopping.is_set():
+            start = perf_counter()
+            try:
+                self._operation()
+                self.latencies.append(perf_counter() - start)
+            except OperationalError:
+                # database is locked
+                self.errors += 1
+
+
+def percentile(values: list[float], ratio: float) -> float:
+    """Returns a percentile of the values, in ms."""
+    if len(values) == 0:
+        return 0.0
+    return sorted(values)[min(len(values) - 1, int(len(values) * ratio))] * 1000
+
+
+def run_profile(profile: SqliteProfile, args) -> dict:
+    rnd = random.Random(0)
+    with tempfile.TemporaryDirectory() as folder:
+        engine = create_engine("sqlite:///" + os.path.join(folder, "bench.sqldb"))
+        profile.attach(engine)
+        Base.metadata.create_all(engine)
+        factory = sessionmaker(bind=engine)
+        machine_ids = populate(factory, args.uses, args.machines, rnd)
+
+        with factory() as session:
+            user = session.query(User).first()
+            session.expunge(user)
+
+        def board_event():
+            machine_id = rnd.choice(machine_ids)
+            with factory() as session:
+                use_repo = UseRepository(session)
+                action = rnd.random()
+                if action < 0.2:
+                    use_repo.startUse(machine_id, user)
+                elif action < 0.8:
+                    use_repo.inUse(machine_id, user, rnd.randint(1, 3600))
+                else:
+                    use_repo.endUse(machine_id, user, rnd.randint(1, 3600), False)
+
+        def web_page():
+            with factory() as session:
+                session.query(Use).order_by(Use.start_timestamp.desc()).limit(500).all()
+                MaintenanceCounterRepository(session).getMaintenanceStatus()
+
+        stop = threading.Event()
+        writer = Worker(board_event, stop)
+        readers = [Worker(web_page, stop) for _ in range(args.readers)]
+        for worker in [writer] + readers:
+            worker.start()
+        stop.wait(args.duration)
+        stop.set()
+        for worker in [writer] + readers:
+            worker.join()
+        engine.dispose()
+
+    reads = [latency for reader in readers for latency in reader.latencies]
+    return {
+        "writes/s": len(writer.latencies) / args.duration,
+        "write p50": percentile(writer.latencies, 0.5),
+        "write p99": percentile(writer.latencies, 0.99),
+        "reads/s": len(reads) / args.duration,
+        "read p50": percentile(reads, 0.5),
+        "read p99": percentile(reads, 0.99),
+        "locked": writer.errors + sum(reader.errors for reader in readers),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite profiles benchmark")
+    parser.add_argument("-d", "--duration", type=float, default=10, help="Seconds per profile")
+    parser.add_argument("-r", "--readers", type=int, default=2, help="Threads running the web queries")
+    parser.add_argument("-n", "--uses", type=int, default=50000, help="Number of uses in the database")
+    parser.add_argument("-m", "--machines", type=int, default=40, help="Number of machines")
+    args = parser.parse_args()
+    # Random board events trigger the warnings of missed startuse and stopuse
+    logging.basicConfig(level=logging.ERROR)
+
+    print(f"{args.uses} uses, {args.machines} machines, 1 writer and {args.readers} readers, {args.duration} s each")
+    columns = ["writes/s", "write p50", "write p99", "reads/s", "read p50", "read p99", "locked"]
+    print(f"{'profile':<24}" + "".join(f"{column:>11}" for column in columns) + "   (latencies in ms)")
+    for name, profile in PROFILES.items():
+        result = run_profile(profile, args)
+        print(f"{name:<24}" + "".join(f"{result[column]:>11.1f}" for column in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the authorized cards computation answering the synccache action.
+
+Fills a temporary SQLite database with users, machines and authorizations, then compares, for a few
+machines, the previous path (loading every user, then IsUserAuthorizedForMachine for each of them)
+with UserRepository.getAuthorizedCards, and checks that both give the same cards.
+
+Usage (from root folder):
+    python benchmarks/bench_sync_cache.py [--users 10000] [--machines 100] [--samples 5]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+from time import perf_counter
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from FabOMatic.database.models import Authorization, Base, Machine, MachineType, Role, User
+from FabOMatic.database.repositories import UserRepository
+
+
+def populate(session, users: int, machines: int, rnd: random.Random) -> list[int]:
+    """Creates the test data, returns the machine IDs."""
+    types = [
+        MachineType(type_name="with authorization", access_management=MachineType.MANAGEMENT_WITH_AUTHORIZATION),
+        MachineType(type_name="without authorization", access_management=MachineType.MANAGEMENT_WITHOUT_AUTHORIZATION),
+    ]
+    roles = [Role(role_name="user"), Role(role_name="admin", authorize_all=True)]
+    session.add_all(types + roles)
+    session.flush()
+
+    session.add_all(
+        Machine(
+            machine_name=f"machine {i}",
+            machine_type_id=types[0].type_id if rnd.random() < 0.9 else types[1].type_id,
+            blocked=rnd.random() < 0.05,
+        )
+        for i in range(machines)
+    )
+    session.add_all(
+        User(
+            name=f"name {i}",
+            surname=f"surname {i}",
+            role_id=roles[1].role_id if rnd.random() < 0.02 else roles[0].role_id,
+            card_UUID=f"{i:08X}" if rnd.random() < 0.95 else None,
+            disabled=rnd.random() < 0.05,
+            deleted=rnd.random() < 0.05,
+        )
+        for i in range(users)
+    )
+    session.flush()
+
+    machine_ids = [machine_id for (machine_id,) in session.query(Machine.machine_id)]
+    user_ids = [user_id for (user_id,) in session.query(User.user_id)]
+    session.bulk_insert_mappings(
+        Authorization,
+        [
+            {"user_id": user_id, "machine_id": machine_id}
+            for user_id in user_ids
+            for machine_id in rnd.sample(machine_ids, rnd.randint(0, 5))
+        ],
+    )
+    session.commit()
+    return machine_ids
+
+
+def legacy_cards(session, machine_id: int) -> list:
+    """Computation used before the single query: one authorization query per user."""
+    user_repo = UserRepository(session)
+    machine = session.get(Machine, machine_id)
+    return [
+        (user.card_UUID, user.role.authorize_all)
+        for user in user_repo.get_all()
+        if not user.disabled and not user.deleted and user.card_UUID
+        if user_repo.IsUserAuthorizedForMachine(machine, user)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Authorized cards computation benchmark")
+    parser.add_argument("-u", "--users", type=int, default=10000, help="Number of users")
+    parser.add_argument("-m", "--machines", type=int, default=100, help="Number of machines")
+    parser.add_argument("-s", "--samples", type=int, default=5, help="Machines measured")
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    with tempfile.TemporaryDirectory() as folder:
+        engine = create_engine("sqlite:///" + os.path.join(folder, "bench.sqldb"))
+        Base.metadata.create_all(engine)
+        factory = sessionmaker(bind=engine)
+
+        with factory() as session:
+            machine_ids = populate(session, args.users, args.machines, rnd)
+        print(f"{args.users} users, {args.machines} machines")
+
+        print(f"{'machine':>8}{'cards':>8}{'before (ms)':>14}{'after (ms)':>14}{'speedup':>10}")
+        for machine_id in rnd.sample(machine_ids, min(args.samples, len(machine_ids))):
+            with factory() as session:
+                start = perf_counter()
+                before = legacy_cards(session, machine_id)
+                before_ms = (perf_counter() - start) * 1000
+
+            with factory() as session:
+                start = perf_counter()
+                after = UserRepository(session).getAuthorizedCards(machine_id)
+                after_ms = (perf_counter() - start) * 1000
+
+            if before != after:
+                raise AssertionError(f"Different cards for machine {machine_id}")
+            print(f"{machine_id:>8}{len(after):>8}{before_ms:>14.1f}{after_ms:>14.1f}{before_ms / after_ms:>9.1f}x")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
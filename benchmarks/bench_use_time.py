@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the use time computations (total time, time since the last intervention).
+
+Fills a temporary SQLite database with a large uses table, then compares, for a few machines, the
+previous path (loading every Use and summing the durations in Python) with the SQL SUM aggregates of
+MachineRepository and UserRepository, and checks that both give the same times.
+
+Usage (from root folder):
+    python benchmarks/bench_use_time.py [--uses 1000000] [--machines 20] [--users 1000] [--samples 3]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+from time import perf_counter, time
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from FabOMatic.database.models import Base, Intervention, Machine, MachineType, Maintenance, Role, Use, User
+from FabOMatic.database.repositories import MachineRepository, UserRepository
+
+CHUNK = 50000
+
+
+def populate(session, uses: int, machines: int, users: int, rnd: random.Random) -> tuple[list[int], list[int]]:
+    """Creates the test data, returns the machine IDs and the user IDs."""
+    machine_type = MachineType(type_name="type")
+    role = Role(role_name="user")
+    session.add_all([machine_type, role])
+    session.flush()
+    session.add_all(
+        Machine(machine_name=f"machine {i}", machine_type_id=machine_type.type_id) for i in range(machines)
+    )
+    session.add_all(User(name=f"name {i}", surname="surname", role_id=role.role_id) for i in range(users))
+    session.flush()
+    machine_ids = [machine_id for (machine_id,) in session.query(Machine.machine_id)]
+    user_ids = [user_id for (user_id,) in session.query(User.user_id)]
+
+    # Uses over the last 5 years, a few of them still open
+    now = time()
+    for first in range(0, uses, CHUNK):
+        rows = []
+        for _ in range(min(CHUNK, uses - first)):
+            start = now - rnd.uniform(0, 5 * 365 * 24 * 3600)
+            end = start + rnd.randint(60, 4 * 3600) if rnd.random() > 0.001 else None
+            rows.append(
+                {
+                    "user_id": rnd.choice(user_ids),
+                    "machine_id": rnd.choice(machine_ids),
+                    "start_timestamp": start,
+                    "last_seen": start if end is None else end,
+                    "end_timestamp": end,
+                }
+            )
+        session.execute(insert(Use), rows)
+
+    # Two maintenances per machine, done every few months
+    for machine_id in machine_ids:
+        maintenances = [
+            Maintenance(hours_between=100, description=f"maintenance {i}", machine_id=machine_id) for i in range(2)
+        ]
+        session.add_all(maintenances)
+        session.flush()
+        for maintenance in maintenances:
+            for _ in range(20):
+                session.add(
+                    Intervention(
+                        maintenance_id=maintenance.maintenance_id,
+                        machine_id=machine_id,
+                        user_id=rnd.choice(user_ids),
+                        timestamp=now - rnd.uniform(0, 5 * 365 * 24 * 3600),
+                    )
+                )
+    session.commit()
+    return machine_ids, user_ids
+
+
+def legacy_relative_time(session, machine_id: int, maintenance_id: int = None) -> float:
+    """Computation used before the SQL aggregates: the uses were loaded and summed in Python."""
+    query = session.query(Intervention).filter(Intervention.machine_id == machine_id)
+    if maintenance_id is not None:
+        query = query.filter(Intervention.maintenance_id == maintenance_id)
+    record = query.order_by(Intervention.timestamp.desc()).first()
+    last_intervention = 0 if record is None else record.timestamp
+    uses = (
+        session.query(Use)
+        .filter(Use.end_timestamp.is_not(None), Use.machine_id == machine_id, Use.start_timestamp > last_intervention)
+        .all()
+    )
+    return sum([use.end_timestamp - use.start_timestamp for use in uses], 0)
+
+
+def legacy_total_time(session, machine_id: int) -> float:
+    uses = session.query(Use).filter(Use.end_timestamp.is_not(None), Use.machine_id == machine_id).all()
+    return sum([use.end_timestamp - use.start_timestamp for use in uses], 0)
+
+
+def legacy_user_time(session, user_id: int) -> float:
+    uses = session.query(Use).filter(Use.user_id == user_id, Use.end_timestamp.is_not(None)).all()
+    return sum([use.end_timestamp - use.start_timestamp for use in uses], 0)
+
+
+def measure(factory, compute) -> tuple[float, float]:
+    """Returns the result and the duration in ms of a computation, in a new session."""
+    with factory() as session:
+        start = perf_counter()
+        result = compute(session)
+        return result, (perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Use time computations benchmark")
+    parser.add_argument("-n", "--uses", type=int, default=1000000, help="Number of uses")
+    parser.add_argument("-m", "--machines", type=int, default=20, help="Number of machines")
+    parser.add_argument("-u", "--users", type=int, default=1000, help="Number of users")
+    parser.add_argument("-s", "--samples", type=int, default=3, help="Machines and users measured")
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    with tempfile.TemporaryDirectory() as folder:
+        engine = create_engine("sqlite:///" + os.path.join(folder, "bench.sqldb"))
+        Base.metadata.create_all(engine)
+        factory = sessionmaker(bind=engine)
+
+        with factory() as session:
+            machine_ids, user_ids = populate(session, args.uses, args.machines, args.users, rnd)
+            maintenances = {m.machine_id: m for m in session.query(Maintenance)}
+        print(f"{args.uses} uses, {args.machines} machines, {args.users} users")
+
+        cases = []
+        for machine_id in rnd.sample(machine_ids, min(args.samples, len(machine_ids))):
+            maintenance = maintenances[machine_id]
+            cases += [
+                (
+                    f"getTotalUseTime({machine_id})",
+                    lambda session, m=machine_id: legacy_total_time(session, m),
+                    lambda session, m=machine_id: MachineRepository(session).getTotalUseTime(m),
+                ),
+                (
+                    f"getRelativeUseTime({machine_id})",
+                    lambda session, m=machine_id: legacy_relative_time(session, m),
+                    lambda session, m=machine_id: MachineRepository(session).getRelativeUseTime(m),
+                ),
+                (
+                    f"getRelativeUseTimeByMaintenance({machine_id})",
+                    lambda session, m=maintenance: legacy_relative_time(session, m.machine_id, m.maintenance_id),
+                    lambda session, m=maintenance: MachineRepository(session).getRelativeUseTimeByMaintenance(
+                        m.machine_id, m
+                    ),
+                ),
+            ]
+        for user_id in rnd.sample(user_ids, min(args.samples, len(user_ids))):
+            cases.append(
+                (
+                    f"getUserTotalTime({user_id})",
+                    lambda session, u=user_id: legacy_user_time(session, u),
+                    lambda session, u=user_id: UserRepository(session).getUserTotalTime(u),
+                )
+            )
+
+        print(f"{'computation':<42}{'before (ms)':>14}{'after (ms)':>14}{'speedup':>10}")
+        for name, legacy, aggregate in cases:
+            before, before_ms = measure(factory, legacy)
+            after, after_ms = measure(factory, aggregate)
+            # Sums in a different order may differ in the last digits
+            if abs(before - after) > 1e-6 * max(1.0, abs(before)):
+                raise AssertionError(f"Different results for {name}: {before} != {after}")
+            print(f"{name:<42}{before_ms:>14.1f}{after_ms:>14.1f}{before_ms / after_ms:>9.1f}x")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -42,17 +42,41 @@ class Backend:
     def disconnect(self):
         """Disconnect from the MQTT broker"""
         self._mqtt.disconnect()
+        self._mapper.flushHeartbeats(force=True)
+        self._db.flushMachinesLastSeen(force=True)
 
     def publishStats(self):
-        self._mqtt.publishStats()
+        self._mqtt.publishStats(self._mapper.stats())
+
+    def stats(self) -> dict:
+        """Runtime statistics of the backend, as published on the MQTT stats topic."""
+        return {**self._mqtt.stats(), **self._mapper.stats()}
 
     def closeOrphans(self):
-        self._db.closeOrphans()
+        self._db.closeOrphans(self._mapper.pendingHeartbeats())
+
+    def flushWriteBehind(self):
+        """Write the buffered board heartbeats and machines liveness to the database, when due."""
+        self._mapper.flushHeartbeats()
+        self._db.flushMachinesLastSeen()
+
+    def refreshCaches(self):
+        """Reload the in-memory authorization data, when due, to see the changes of other processes."""
+        self._db.refreshCaches()
+
+    def optimizeDatabase(self):
+        """Refresh the database query planner statistics, when due."""
+        self._db.optimize()
 
     def purge_data(self):
         """Purge data from the database."""
         self._db.purge_data()
 
+    def rebuildCounters(self) -> int:
+        """Recompute the maintenance counters, after manual edits of the uses or interventions."""
+        self._db.createAndUpdateDatabase()
+        return self._db.rebuildMaintenanceCounters()
+
     def getMapper(self) -> MsgMapper:
         return self._mapper
 
@@ -86,7 +110,10 @@ def start(loglevel):
                 logging.error("Failed to connect to Database or MQTT broker")
         else:
             back.publishStats()
+            back.flushWriteBehind()
             back.closeOrphans()
+            back.refreshCaches()
+            back.optimizeDatabase()
         sleep(5)
 
 
@@ -121,6 +148,9 @@ def main():
     parser = argparse.ArgumentParser(description="Fab-O-Matic Backend server.")
     parser.add_argument("-p", "--purge", action="store_true", help="Purge data and exit")
     parser.add_argument("-w", "--weekly-summary", action="store_true", help="Send weekly summary emails and exit")
+    parser.add_argument(
+        "-r", "--rebuild-counters", action="store_true", help="Recompute the maintenance counters and exit"
+    )
     parser.add_argument("-l", "--loglevel", type=int, default=10, help="Set log level (default: 10)")
 
     args = parser.parse_args()
@@ -131,6 +161,12 @@ def main():
         back = Backend()
         back.purge_data()
         logging.info("Purge operation completed. Exiting.")
+    elif args.rebuild_counters:
+        configure_logger(args.loglevel)
+        logging.info("Rebuilding maintenance counters...")
+        back = Backend()
+        nb_counters = back.rebuildCounters()
+        logging.info("%d maintenance counters rebuilt. Exiting.", nb_counters)
     elif args.weekly_summary:
         configure_logger(args.loglevel)
         send_weekly_summary()
@@ -19,14 +19,13 @@ branch_labels: Union[str, Sequence[str], None] = None
 depends_on: Union[str, Sequence[str], None] = None
 
 from alembic import op
-from sqlalchemy import engine_from_config
 from sqlalchemy import inspect
 
 
 def _table_has_column(table, column):
-    config = op.get_context().config
-    engine = engine_from_config(config.get_section(config.config_ini_section), prefix="sqlalchemy.")
-    insp = inspect(engine)
+    # Through the migration connection: with transactional DDL (PostgreSQL), the tables created by the
+    # previous revisions are not committed yet
+    insp = inspect(op.get_bind())
     has_column = False
     for col in insp.get_columns(table):
         if column not in col["name"]:
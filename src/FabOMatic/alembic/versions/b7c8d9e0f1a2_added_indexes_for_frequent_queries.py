@@ -0,0 +1,66 @@
+"""Added indexes for frequent queries
+
+Revision ID: b7c8d9e0f1a2
+Revises: f1a2b3c4d5e6
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b7c8d9e0f1a2"
+down_revision: Union[str, None] = "f1a2b3c4d5e6"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+OPEN_USE = sa.text("end_timestamp IS NULL")
+
+
+def upgrade() -> None:
+    op.create_index("idx_uses_machine_start", "uses", ["machine_id", "start_timestamp", "end_timestamp"], unique=False)
+    op.create_index("idx_uses_user_id", "uses", ["user_id"], unique=False)
+    op.create_index("idx_uses_start_timestamp", "uses", ["start_timestamp"], unique=False)
+    op.create_index("idx_uses_last_seen", "uses", ["last_seen"], unique=False)
+    op.create_index(
+        "idx_uses_open_machine_id",
+        "uses",
+        ["machine_id"],
+        unique=False,
+        sqlite_where=OPEN_USE,
+        postgresql_where=OPEN_USE,
+    )
+    op.create_index(
+        "idx_uses_open_last_seen",
+        "uses",
+        ["last_seen"],
+        unique=False,
+        sqlite_where=OPEN_USE,
+        postgresql_where=OPEN_USE,
+    )
+    op.create_index(
+        "idx_interventions_machine_maintenance_timestamp",
+        "interventions",
+        ["machine_id", "maintenance_id", "timestamp"],
+        unique=False,
+    )
+    op.create_index("idx_interventions_timestamp", "interventions", ["timestamp"], unique=False)
+    op.create_index("idx_unknown_cards_timestamp", "unknown_cards", ["timestamp"], unique=False)
+    op.create_index("idx_boards_machine_id", "boards", ["machine_id"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index("idx_boards_machine_id", table_name="boards")
+    op.drop_index("idx_unknown_cards_timestamp", table_name="unknown_cards")
+    op.drop_index("idx_interventions_timestamp", table_name="interventions")
+    op.drop_index("idx_interventions_machine_maintenance_timestamp", table_name="interventions")
+    op.drop_index("idx_uses_open_last_seen", table_name="uses")
+    op.drop_index("idx_uses_open_machine_id", table_name="uses")
+    op.drop_index("idx_uses_last_seen", table_name="uses")
+    op.drop_index("idx_uses_start_timestamp", table_name="uses")
+    op.drop_index("idx_uses_user_id", table_name="uses")
+    op.drop_index("idx_uses_machine_start", table_name="uses")
@@ -0,0 +1,55 @@
+"""Added maintenance counters table
+
+Revision ID: c8d9e0f1a2b3
+Revises: b7c8d9e0f1a2
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c8d9e0f1a2b3"
+down_revision: Union[str, None] = "b7c8d9e0f1a2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Counters of the existing maintenances, computed from the uses since their last intervention
+FILL_COUNTERS = """
+INSERT INTO maintenance_counters (machine_id, maintenance_id, seconds, last_intervention)
+SELECT m.machine_id, m.maintenance_id,
+    COALESCE(
+        (SELECT SUM(u.end_timestamp - u.start_timestamp) FROM uses u
+         WHERE u.machine_id = m.machine_id AND u.end_timestamp IS NOT NULL
+         AND u.start_timestamp > COALESCE(
+            (SELECT MAX(i.timestamp) FROM interventions i
+             WHERE i.machine_id = m.machine_id AND i.maintenance_id = m.maintenance_id), 0)),
+        0),
+    COALESCE(
+        (SELECT MAX(i.timestamp) FROM interventions i
+         WHERE i.machine_id = m.machine_id AND i.maintenance_id = m.maintenance_id),
+        0)
+FROM maintenances m
+"""
+
+
+def upgrade() -> None:
+    op.create_table(
+        "maintenance_counters",
+        sa.Column("machine_id", sa.Integer(), nullable=False),
+        sa.Column("maintenance_id", sa.Integer(), nullable=False),
+        sa.Column("seconds", sa.Float(), nullable=False),
+        sa.Column("last_intervention", sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(["machine_id"], ["machines.machine_id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["maintenance_id"], ["maintenances.maintenance_id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("machine_id", "maintenance_id"),
+    )
+    op.execute(FILL_COUNTERS)
+
+
+def downgrade() -> None:
+    op.drop_table("maintenance_counters")
@@ -0,0 +1,34 @@
+"""Widened users password hash
+
+Revision ID: d9e0f1a2b3c4
+Revises: c8d9e0f1a2b3
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = "d9e0f1a2b3c4"
+down_revision: Union[str, None] = "c8d9e0f1a2b3"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _is_sqlite():
+    return op.get_context().dialect.name == "sqlite"
+
+
+def upgrade() -> None:
+    # Scrypt hashes are longer than 128 characters. SQLite does not enforce the length, and altering the
+    # column would rebuild the users table referenced by the uses and interventions.
+    if not _is_sqlite():
+        op.alter_column("users", "password_hash", existing_type=sa.String(length=128), type_=sa.String(length=256))
+
+
+def downgrade() -> None:
+    if not _is_sqlite():
+        op.alter_column("users", "password_hash", existing_type=sa.String(length=256), type_=sa.String(length=128))
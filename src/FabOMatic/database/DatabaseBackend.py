@@ -1,15 +1,23 @@
 """This is the class handling the Database. More to come."""
 
 import os
-from os import path
+from contextlib import contextmanager
 from os.path import dirname, abspath
 import logging
 from time import time
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine
+from sqlalchemy import Engine
 from sqlalchemy.orm.exc import NoResultFound
 from FabOMatic.conf import FabConfig
-from FabOMatic.database.models import MachineType, Role, Use, User, Machine
+from FabOMatic.database.models import MachineType, Role, Use, User, Machine, Maintenance, Intervention
+from FabOMatic.database.heartbeats import use_heartbeats
+from FabOMatic.database.liveness import machine_liveness
+from FabOMatic.database.authorization_index import AuthorizationIndex
+from FabOMatic.database.cache import InvalidatingCache
+from FabOMatic.database.notifications import Change, changes_notifier
+from FabOMatic.database import sqlite_profile, transfer
+from FabOMatic.database.engines import engine_factory
+from FabOMatic.database.sqlite_profile import SqliteProfile
 
 from .repositories import (
     BoardsRepository,
@@ -20,14 +28,20 @@ from .repositories import (
     MachineTypeRepository,
     AuthorizationRepository,
     MaintenanceRepository,
+    MaintenanceCounterRepository,
     InterventionRepository,
     UnknownCardsRepository,
     Session,
     Base,
+    UNIT_OF_WORK,
 )
 
+ROLLBACK_ONLY = "rollback_only"
+
+# Interval between reloads of the in-memory authorization data, to see the changes of other processes
+CACHE_REFRESH_S = 300
+
 MODULE_DIR = dirname(dirname(abspath(__file__)))
-MIGRATIONS_DIR = path.join(MODULE_DIR, "alembic")
 
 
 class DatabaseBackend:
@@ -37,23 +51,100 @@ class DatabaseBackend:
         """Create instance of Database."""
 
         self._settings = None
+        self._last_optimize = time()
+        self._machine_status_cache = InvalidatingCache()
         self._loadSettings()
         self._connect()
+        changes_notifier.subscribe(self._url, self._onChanges)
 
     def _loadSettings(self) -> None:
         """Load settings from TOML file."""
         self._settings = FabConfig.loadSettings()
         self._url = FabConfig.getDatabaseUrl()
         self._name = FabConfig.getSetting("database", "name")
+        self._sqlite_profile = SqliteProfile.fromSettings(self._settings["database"].get("sqlite"))
+        self._cache_refresh_s = self._settings["database"].get("cache_refresh_s", CACHE_REFRESH_S)
+        self._last_cache_refresh = time()
 
     def _connect(self) -> None:
         """Connect to the database."""
         from sqlalchemy.orm import sessionmaker
 
-        self._engine = create_engine(self._url, echo=False)
+        # Shared with the web application and the other backends of the same database
+        self._engine = engine_factory.getEngine(self._url, self._settings["database"])
         self._session = sessionmaker(bind=self._engine)
+        self._authorization_index = AuthorizationIndex(self._session)
         logging.info("Connected to database %s", self._url)
 
+    def getEngine(self) -> Engine:
+        """Get the engine of the database, shared by all the components of the process.
+
+        Returns:
+            Engine: The engine, with its connection pool.
+        """
+        return self._engine
+
+    def poolStats(self, read_only: bool = False) -> dict:
+        """Get the metrics of the connection pool.
+
+        Args:
+            read_only (bool, optional): Metrics of the pool of the read-only sessions of the web pages.
+                Defaults to False.
+
+        Returns:
+            dict: The pool size, the connections in use now and at most, the checkouts, the timeouts and
+                the p50/p95/max time waited for a connection (ms). Empty if the pool is not metered.
+        """
+        return engine_factory.stats(self._url, read_only)
+
+    def getMachineStatusCache(self) -> InvalidatingCache:
+        """Get the cache of the machines status replied to the boards, keyed by machine_id.
+
+        Returns:
+            InvalidatingCache: The cache, invalidated when a committed change affects a machine status.
+        """
+        return self._machine_status_cache
+
+    def getAuthorizationIndex(self) -> AuthorizationIndex:
+        """Get the in-memory index of the cards and authorizations, loaded on first use.
+
+        Returns:
+            AuthorizationIndex: The index, refreshed when changes to users, roles, machines,
+                machine types or authorizations are committed.
+        """
+        return self._authorization_index
+
+    def _onChanges(self, changes: list[Change] | None) -> None:
+        """Invalidate or refresh the cached data affected by committed changes.
+
+        Args:
+            changes (list[Change] | None): The committed changes, None if the whole database changed.
+        """
+        if changes is None:
+            # The pooled connections may still read the replaced database file
+            engine_factory.dispose(self._url)
+            self._machine_status_cache.clear()
+            self._authorization_index.reset()
+            return
+
+        for change in changes:
+            if change.model not in (MachineType, Machine, Maintenance, Intervention, Use):
+                continue
+            if change.model is Use and not (
+                change.operation == "delete"
+                or "end_timestamp" in change.changed
+                or (change.operation == "insert" and change.values.get("end_timestamp") is not None)
+            ):
+                # Maintenance status only depends on closed uses
+                continue
+            machine_id = change.values.get("machine_id")
+            if change.model is MachineType or machine_id is None or "machine_id" in change.changed:
+                # Affected machines are not known
+                self._machine_status_cache.clear()
+            else:
+                self._machine_status_cache.invalidate(machine_id)
+        self._authorization_index.applyChanges(changes)
+
     def getOne(self, Model, **kwargs):
         """Return one instance of Model matching kwargs.
 
@@ -92,6 +183,41 @@ class DatabaseBackend:
         """
         return self._session()
 
+    @contextmanager
+    def unitOfWork(self, session: Session = None):
+        """Run a group of repository operations in a single transaction.
+
+        Repositories used with the yielded session flush their changes instead of committing them,
+        and the transaction is committed once when the block exits, or rolled back on exception.
+        When an existing session is given, the block joins it and leaves the commit to its owner;
+        an exception in the block then marks the outer unit of work for rollback.
+
+        Args:
+            session (Session, optional): An enclosing session to join. Defaults to None.
+
+        Yields:
+            Session: The session to use in the block.
+        """
+        if session is not None:
+            try:
+                yield session
+            except Exception:
+                session.info[ROLLBACK_ONLY] = True
+                raise
+            return
+
+        with self._session() as session:
+            session.info[UNIT_OF_WORK] = True
+            try:
+                yield session
+                if session.info.get(ROLLBACK_ONLY, False):
+                    session.rollback()
+                else:
+                    session.commit()
+            except Exception:
+                session.rollback()
+                raise
+
     def getUserRepository(self, session: Session) -> UserRepository:
         """Get a UserRepository object for user-related database operations.
 
@@ -169,6 +295,17 @@ class DatabaseBackend:
         """
         return MaintenanceRepository(session)
 
+    def getMaintenanceCounterRepository(self, session: Session) -> MaintenanceCounterRepository:
+        """Get a MaintenanceCounterRepository object for the use time accumulated since the interventions.
+
+        Args:
+            session: The session object to use for database operations.
+
+        Returns:
+            A MaintenanceCounterRepository object.
+        """
+        return MaintenanceCounterRepository(session)
+
     def getInterventionRepository(self, session: Session) -> InterventionRepository:
         """Get an InterventionRepository object for intervention-related database operations.
 
@@ -187,43 +324,55 @@ class DatabaseBackend:
         return BoardsRepository(session)
 
     def deleteExistingDatabase(self) -> bool:
-        """Delete the existing database."""
-        if self._url.startswith("sqlite:///"):
-            file_path = self._url[len("sqlite:///") :]
-            if os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                except Exception as e:
-                    logging.error("Error deleting existing database %s: %s", file_path, e)
-                    return False
-                logging.warning("Deleted existing database %s", file_path)
-                return True
-            else:
-                logging.warning("No existing database found at %s", file_path)
+        """Delete the existing database: the SQLite file, or all the tables of other databases.
+
+        Returns:
+            bool: True if the database existed and has been deleted.
+        """
+        if not self._url.startswith("sqlite:///"):
+            try:
+                engine_factory.dispose(self._url)
+                existed = transfer.dropTables(self._engine)
+            except Exception as e:
+                logging.error("Error dropping the tables of %s: %s", self._engine.url, e)
                 return False
-        logging.warning("Not deleting non-SQLite database %s", self._url)
-        return False
+            logging.warning("Dropped all tables of database %s", self._engine.url)
+            machine_liveness.clear()
+            use_heartbeats.clear()
+            changes_notifier.notifyReset(self._url)
+            return existed
+
+        file_path = self._url[len("sqlite:///") :]
+        if os.path.exists(file_path):
+            try:
+                # Pooled connections would keep the deleted file and its write-ahead log open
+                engine_factory.dispose(self._url)
+                sqlite_profile.removeDatabaseFiles(file_path)
+            except Exception as e:
+                logging.error("Error deleting existing database %s: %s", file_path, e)
+                return False
+            logging.warning("Deleted existing database %s", file_path)
+            machine_liveness.clear()
+            use_heartbeats.clear()
+            changes_notifier.notifyReset(self._url)
+            return True
+        else:
+            logging.warning("No existing database found at %s", file_path)
+            return False
 
     def createAndUpdateDatabase(self) -> None:
         """Create the database."""
         # Runs any migrations
-        from alembic.config import Config
-        from alembic import command
-
-        alembic_cfg = Config("alembic.ini")
-        alembic_cfg.set_main_option("sqlalchemy.url", self._url)
-        alembic_cfg.set_main_option("script_location", MIGRATIONS_DIR)
-        alembic_cfg.attributes["configure_logger"] = False
-        command.upgrade(alembic_cfg, "head")
+        transfer.upgradeSchema(self._url)
 
         with self._session() as session:
             if len(self.getUserRepository(session).get_all()) == 0:
                 self.seedDatabase()
 
-        if self.getUserRepository(session).get_anonymous() is None:
-            logging.warning("Adding anonymous role and user to existing database")
-            role = self.seedAnonymousRole(session)
-            self.seedAnonymousUser(session, role)
+            if self.getUserRepository(session).get_anonymous() is None:
+                logging.warning("Adding anonymous role and user to existing database")
+                role = self.seedAnonymousRole(session)
+                self.seedAnonymousUser(session, role)
 
     def seedDatabase(self) -> None:
         """Seed the database with initial data."""
@@ -286,19 +435,42 @@ class DatabaseBackend:
             trans = session.begin()
             for table in reversed(meta.sorted_tables):
                 session.execute(table.delete())
+            # Like SQLite, the next rows get the IDs again from 1
+            transfer.resetSequences(session.connection())
             trans.commit()
+        machine_liveness.clear()
+        use_heartbeats.clear()
+        changes_notifier.notifyReset(self._url)
 
     def copy(self, destination: str) -> None:
-        """Copy the database to a new location.
+        """Copy the database to a SQLite file.
 
         Args:
             destination (str): The destination of the copy.
         """
-        from shutil import copyfile
-
-        copyfile(self._url.replace("sqlite:///", ""), destination)
+        transfer.exportDatabase(self._engine, destination)
         logging.info("Copied database from %s to %s", self._name, destination)
 
+    def restore(self, source: str) -> None:
+        """Replace the contents of the database with a SQLite file, e.g. a copy.
+
+        Args:
+            source (str): The SQLite file, upgraded to the latest schema revision if needed.
+        """
+        transfer.importDatabase(source, self._engine)
+        machine_liveness.clear()
+        use_heartbeats.clear()
+        changes_notifier.notifyReset(self._url)
+        logging.warning("Restored database %s from %s", self._name, source)
+
+    def getSize(self) -> int:
+        """Get the size of the database, as reported by the database.
+
+        Returns:
+            int: The size in bytes, 0 if it is not known.
+        """
+        return transfer.databaseSize(self._engine)
+
     def purge_data(self, max_days: int = 365) -> bool:
         try:
             with self._session() as session:
@@ -333,7 +505,90 @@ class DatabaseBackend:
             logging.error(f"Error purging records: {e}")
             return False
 
-    def closeOrphans(self):
+    def refreshCaches(self, force: bool = False) -> bool:
+        """Forget the authorization index and the machines status cache, when due.
+
+        They are kept up to date with the changes committed by this process only. Changes written by
+        other processes (CLI commands, the simulator setup, manual SQL, another backend on the same
+        server database) are seen after at most one refresh interval.
+
+        Args:
+            force (bool, optional): Run regardless of the refresh interval. Defaults to False.
+
+        Returns:
+            bool: True if the caches were forgotten, they are loaded again on next use.
+        """
+        interval_s = self._cache_refresh_s
+        if not force and (interval_s == 0 or time() - self._last_cache_refresh < interval_s):
+            return False
+        self._last_cache_refresh = time()
+        self._authorization_index.reset()
+        self._machine_status_cache.clear()
+        return True
+
+    def optimize(self, force: bool = False) -> bool:
+        """Refresh the query planner statistics of a SQLite database, when due.
+
+        Args:
+            force (bool, optional): Run regardless of the optimize interval. Defaults to False.
+
+        Returns:
+            bool: True if the database was optimized.
+        """
+        interval_s = self._sqlite_profile.optimize_interval_s
+        if self._engine.dialect.name != "sqlite":
+            return False
+        if not force and (interval_s == 0 or time() - self._last_optimize < interval_s):
+            return False
+        self._last_optimize = time()
+        try:
+            sqlite_profile.optimize(self._engine)
+            return True
+        except Exception as e:
+            logging.error("Error optimizing database: %s", e)
+            return False
+
+    def rebuildMaintenanceCounters(self, machine_id: int = None) -> int:
+        """Recompute the maintenance counters from the uses and interventions history.
+
+        Args:
+            machine_id (int, optional): The machine to recompute. Defaults to None, for all the machines.
+
+        Returns:
+            int: The number of counters recomputed.
+        """
+        with self._session() as session:
+            return self.getMaintenanceCounterRepository(session).rebuild(machine_id)
+
+    def flushMachinesLastSeen(self, force: bool = False) -> int:
+        """Write the machines last_seen timestamps kept in memory to the database, when due.
+
+        Args:
+            force (bool, optional): Write regardless of the flush interval. Defaults to False.
+
+        Returns:
+            int: The number of machines updated.
+        """
+        dirty = machine_liveness.takeDirty(force)
+        if len(dirty) == 0:
+            return 0
+        try:
+            with self._session() as session:
+                return self.getMachineRepository(session).updateLastSeen(dirty)
+        except Exception as e:
+            logging.error("flushMachinesLastSeen exception %s", str(e), exc_info=True)
+            machine_liveness.markDirty(dirty.keys())
+            return 0
+
+    def closeOrphans(self, pending_last_seen: dict[int, float] = None):
+        """Close the open uses whose board has not been heard of for more than 1 hour.
+
+        Args:
+            pending_last_seen (dict[int, float], optional): last_seen timestamps not yet written
+                to the database, keyed by use_id. They take precedence over the stored ones.
+        """
+        if pending_last_seen is None:
+            pending_last_seen = {}
         try:
             # Close records from boards more than 1 hour old
             MAX_DELAY_S = 60 * 60 * 1
@@ -347,8 +602,11 @@ class DatabaseBackend:
                     .all()
                 )
                 for o in orphans:
+                    last_seen = max(o.last_seen, pending_last_seen.get(o.use_id, 0))
+                    if last_seen >= current_time - MAX_DELAY_S:
+                        continue
                     logging.warning(f"Closing orphan record on {o.serialize()}")
-                    uses_repo.endUse(o.machine_id, o.user, int(o.last_seen - o.start_timestamp) + 1, False)
+                    uses_repo.endUse(o.machine_id, o.user, int(last_seen - o.start_timestamp) + 1, False)
         except Exception as e:
             # Log any exception that occurs and roll back the transaction
             logging.error(f"Error closing orphans records: {e}")
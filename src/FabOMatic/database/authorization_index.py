@@ -0,0 +1,278 @@
+""" In-memory index of the cards, users and authorizations, answering the boards checkuser requests. """
+
+import logging
+import threading
+from dataclasses import dataclass
+
+from sqlalchemy.orm import sessionmaker
+
+from .constants import USER_LEVEL
+from .models import Authorization, Machine, MachineType, Role, User
+from .notifications import Change
+
+
+@dataclass(frozen=True)
+class IndexedUser:
+    """The fields of a User needed to authorize a card."""
+
+    user_id: int
+    name: str
+    card_UUID: str | None
+    role_id: int
+    disabled: bool
+    deleted: bool
+
+
+@dataclass(frozen=True)
+class IndexedRole:
+    """The flags of a Role needed to authorize a card."""
+
+    authorize_all: bool
+    maintenance: bool
+
+
+@dataclass(frozen=True)
+class IndexedMachine:
+    """The fields of a Machine needed to authorize a card."""
+
+    blocked: bool
+    type_id: int | None
+
+
+# Columns whose change can modify an authorization, per model
+RELEVANT_COLUMNS = {
+    User: {"name", "card_UUID", "role_id", "disabled", "deleted"},
+    Role: {"authorize_all", "maintenance"},
+    Machine: {"blocked", "machine_type_id"},
+    MachineType: {"access_management"},
+    Authorization: {"user_id", "machine_id"},
+}
+
+
+class AuthorizationIndex:
+    """
+    Process-wide index of card_UUID -> user, with the role flags, machine flags and authorized machines of each user.
+
+    The index is loaded on first use, then refreshed entity by entity from the changes committed to the database,
+    so that checking a card does not query the database.
+    """
+
+    def __init__(self, session_factory: sessionmaker):
+        """
+        Initializes a new instance of the AuthorizationIndex class.
+
+        Args:
+            session_factory (sessionmaker): Factory of the sessions used to load the index.
+        """
+        self._session_factory = session_factory
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._generation = 0
+        self._users: dict[int, IndexedUser] = {}
+        self._cards: dict[str, int] = {}
+        self._roles: dict[int, IndexedRole] = {}
+        self._machines: dict[int, IndexedMachine] = {}
+        self._types: dict[int, int] = {}
+        self._authorizations: dict[int, frozenset[int]] = {}
+
+    def _ensureLoaded(self) -> None:
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self.load()
+
+    def load(self) -> None:
+        """Loads the whole index from the database."""
+        with self._lock, self._session_factory() as session:
+            users = {user.user_id: self._entry(user) for user in session.query(User)}
+            authorizations = {}
+            for user_id, machine_id in session.query(Authorization.user_id, Authorization.machine_id):
+                authorizations.setdefault(user_id, set()).add(machine_id)
+
+            # Readers are not locked, so each table is replaced at once
+            self._users = users
+            self._cards = {user.card_UUID: user.user_id for user in users.values() if user.card_UUID}
+            self._roles = {r.role_id: IndexedRole(r.authorize_all, r.maintenance) for r in session.query(Role)}
+            self._machines = {
+                m.machine_id: IndexedMachine(m.blocked, m.machine_type_id) for m in session.query(Machine)
+            }
+            self._types = {t.type_id: t.access_management for t in session.query(MachineType)}
+            self._authorizations = {user_id: frozenset(ids) for user_id, ids in authorizations.items()}
+            self._loaded = True
+            self._generation += 1
+        logging.info("Authorization index loaded: %d users, %d machines", len(self._users), len(self._machines))
+
+    def reset(self) -> None:
+        """Forgets the index, which is loaded again on next use."""
+        with self._lock:
+            self._loaded = False
+            self._generation += 1
+
+    def generation(self) -> int:
+        """
+        Returns:
+            int: A counter incremented each time the contents of the index change.
+        """
+        # Changes are only tracked once the index is loaded
+        self._ensureLoaded()
+        return self._generation
+
+    def userByCard(self, card_uuid: str) -> IndexedUser | None:
+        """
+        Args:
+            card_uuid (str): The UUID of the card.
+
+        Returns:
+            IndexedUser | None: The user owning the card, None if the card is unknown.
+        """
+        self._ensureLoaded()
+        user_id = self._cards.get(card_uuid)
+        return self._users.get(user_id) if user_id is not None else None
+
+    def hasMachine(self, machine_id: int) -> bool:
+        """
+        Args:
+            machine_id (int): The ID of the machine.
+
+        Returns:
+            bool: True if the machine exists.
+        """
+        self._ensureLoaded()
+        return machine_id in self._machines
+
+    def role(self, user: IndexedUser) -> IndexedRole:
+        """
+        Args:
+            user (IndexedUser): The user.
+
+        Returns:
+            IndexedRole: The flags of the role of the user.
+        """
+        self._ensureLoaded()
+        return self._roles.get(user.role_id, IndexedRole(False, False))
+
+    def userLevel(self, user: IndexedUser) -> USER_LEVEL:
+        """Same as User.user_level.
+
+        Args:
+            user (IndexedUser): The user.
+
+        Returns:
+            USER_LEVEL: The level of the user.
+        """
+        if user.disabled:
+            return USER_LEVEL.INVALID
+        if self.role(user).authorize_all:
+            return USER_LEVEL.ADMIN
+        return USER_LEVEL.NORMAL
+
+    def isAuthorized(self, machine_id: int, user: IndexedUser) -> bool:
+        """Same as UserRepository.IsUserAuthorizedForMachine.
+
+        Args:
+            machine_id (int): The ID of the machine.
+            user (IndexedUser): The user.
+
+        Returns:
+            bool: True if the user is authorized to use the machine.
+        """
+        self._ensureLoaded()
+        if user.disabled or user.deleted:
+            return False
+
+        if self.role(user).authorize_all:
+            return True
+
+        machine = self._machines.get(machine_id)
+        if machine is None or machine.blocked:
+            return False
+
+        if self._types.get(machine.type_id) == MachineType.MANAGEMENT_WITHOUT_AUTHORIZATION:
+            return True
+
+        return machine_id in self._authorizations.get(user.user_id, frozenset())
+
+    def applyChanges(self, changes: list[Change] | None) -> None:
+        """
+        Refreshes the entities affected by committed changes.
+
+        Args:
+            changes (list[Change] | None): The committed changes, None if the whole database changed.
+        """
+        if not self._loaded:
+            return
+        if changes is None:
+            self.reset()
+            return
+
+        stale = {User: set(), Role: set(), Machine: set(), MachineType: set(), Authorization: set()}
+        for change in changes:
+            if change.model not in stale:
+                continue
+            if change.operation == "update" and not (change.changed & RELEVANT_COLUMNS[change.model]):
+                continue
+            if change.model is Authorization:
+                # The previous user of an updated authorization is not known
+                key = change.values.get("user_id") if change.operation != "update" else None
+            else:
+                key = change.values.get(change.model.__mapper__.primary_key[0].key)
+            if key is None:
+                # Not enough information to refresh a single entity
+                self.reset()
+                return
+            stale[change.model].add(key)
+
+        if any(stale.values()):
+            try:
+                self._refresh(stale)
+            except Exception as e:
+                logging.error("Authorization index refresh exception %s", str(e), exc_info=True)
+                self.reset()
+
+    def _refresh(self, stale: dict[type, set]) -> None:
+        with self._lock, self._session_factory() as session:
+            for user_id in stale[User]:
+                user = session.get(User, user_id)
+                previous = self._users.get(user_id)
+                if user is None:
+                    self._users.pop(user_id, None)
+                else:
+                    self._users[user_id] = self._entry(user)
+                    if user.card_UUID:
+                        self._cards[user.card_UUID] = user_id
+                if previous is not None and previous.card_UUID and self._cards.get(previous.card_UUID) == user_id:
+                    if user is None or user.card_UUID != previous.card_UUID:
+                        del self._cards[previous.card_UUID]
+            for role_id in stale[Role]:
+                role = session.get(Role, role_id)
+                if role is None:
+                    self._roles.pop(role_id, None)
+                else:
+                    self._roles[role_id] = IndexedRole(role.authorize_all, role.maintenance)
+            for machine_id in stale[Machine]:
+                machine = session.get(Machine, machine_id)
+                if machine is None:
+                    self._machines.pop(machine_id, None)
+                else:
+                    self._machines[machine_id] = IndexedMachine(machine.blocked, machine.machine_type_id)
+            for type_id in stale[MachineType]:
+                machine_type = session.get(MachineType, type_id)
+                if machine_type is None:
+                    self._types.pop(type_id, None)
+                else:
+                    self._types[type_id] = machine_type.access_management
+            for user_id in stale[Authorization]:
+                machine_ids = session.query(Authorization.machine_id).filter(Authorization.user_id == user_id)
+                self._authorizations[user_id] = frozenset(machine_id for (machine_id,) in machine_ids)
+            self._generation += 1
+
+    @staticmethod
+    def _entry(user: User) -> IndexedUser:
+        return IndexedUser(user.user_id, user.name, user.card_UUID, user.role_id, user.disabled, user.deleted)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: The number of users and cards in the index.
+        """
+        return {"users": len(self._users), "cards": len(self._cards)}
@@ -0,0 +1,90 @@
+""" Keyed cache of values computed from the database, invalidated on changes. """
+
+import threading
+
+
+class InvalidatingCache:
+    """
+    Thread-safe cache of values computed from the database.
+
+    A generation counter protects against storing a value computed from data that changed meanwhile:
+    read the generation before computing the value and pass it to put, which ignores the value if
+    an invalidation happened in between.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Args:
+            key: The key of the value.
+
+        Returns:
+            The cached value, None if not cached.
+        """
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+            return value
+
+    def generation(self) -> int:
+        """
+        Returns:
+            int: The current generation, to be passed to put.
+        """
+        return self._generation
+
+    def put(self, key, value, generation: int) -> bool:
+        """
+        Stores a value, unless the cache has been invalidated since the generation was read.
+
+        Args:
+            key: The key of the value.
+            value: The value, must not be None.
+            generation (int): The generation read before computing the value.
+
+        Returns:
+            bool: True if the value was stored.
+        """
+        with self._lock:
+            if generation != self._generation:
+                return False
+            self._values[key] = value
+            return True
+
+    def invalidate(self, key) -> None:
+        """
+        Removes a value from the cache.
+
+        Args:
+            key: The key of the value.
+        """
+        with self._lock:
+            self._generation += 1
+            self._values.pop(key, None)
+
+    def clear(self) -> None:
+        """Removes all the values from the cache."""
+        with self._lock:
+            self._generation += 1
+            self._values.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: The number of hits and misses, and the hit rate in percent.
+        """
+        total = self._hits + self._misses
+        return {
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": round(100.0 * self._hits / total, 1) if total > 0 else 0.0,
+        }
@@ -0,0 +1,254 @@
+""" Engines shared by the components of the process, one per database, with their pool metrics. """
+
+import logging
+import threading
+from dataclasses import dataclass, fields
+from time import perf_counter
+from urllib.parse import quote
+
+from sqlalchemy import Engine, create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from FabOMatic.database.notifications import normalizeUrl
+from FabOMatic.database.sqlite_profile import SqliteProfile
+from FabOMatic.statistics import RingBuffer
+
+
+@dataclass(frozen=True)
+class PoolSettings:
+    """
+    Connection pool settings, read from the [database.pool] section of the settings file.
+
+    Attributes:
+        size (int): Connections kept open in the pool.
+        max_overflow (int): Connections opened beyond the pool size under load, closed when returned.
+        timeout_s (float): Seconds to wait for a free connection before failing.
+        recycle_s (int): Connections older than this are reopened on checkout, -1 to keep them.
+    """
+
+    size: int = 5
+    max_overflow: int = 10
+    timeout_s: float = 30
+    recycle_s: int = -1
+
+    def __post_init__(self):
+        for field in fields(self):
+            value = getattr(self, field.name)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"Invalid pool {field.name} '{value}', expected a number")
+        if self.size < 1 or self.max_overflow < 0 or self.timeout_s <= 0 or self.recycle_s < -1:
+            raise ValueError("Invalid pool settings: size must be at least 1 and timeout_s positive")
+
+    @classmethod
+    def fromSettings(cls, settings: dict | None) -> "PoolSettings":
+        """
+        Builds the pool settings of the [database.pool] settings section.
+
+        Args:
+            settings (dict | None): The section, missing settings take the default values.
+
+        Returns:
+            PoolSettings: The settings.
+
+        Raises:
+            ValueError: If a setting is unknown or has an invalid value.
+        """
+        settings = settings or {}
+        known = {field.name for field in fields(cls)}
+        unknown = set(settings) - known
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown [database.pool] settings: {', '.join(sorted(unknown))}")
+        return cls(**settings)
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool measuring the time spent waiting for a connection, and the connections in use."""
+
+    def __init__(self, creator, *args, **kwargs):
+        super().__init__(creator, *args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self._wait_times = RingBuffer(256)
+        self._checkouts = 0
+        self._timeouts = 0
+        self._max_in_use = 0
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            with self._metrics_lock:
+                self._timeouts += 1
+            raise
+        elapsed = perf_counter() - start
+        with self._metrics_lock:
+            self._wait_times.append(elapsed)
+            self._checkouts += 1
+            self._max_in_use = max(self._max_in_use, self.checkedout())
+        return connection
+
+    def recreate(self) -> "MeteredQueuePool":
+        # Called by Engine.dispose, the metrics are kept across the pools of the engine
+        pool = super().recreate()
+        pool._metrics_lock = self._metrics_lock
+        pool._wait_times = self._wait_times
+        pool._checkouts = self._checkouts
+        pool._timeouts = self._timeouts
+        pool._max_in_use = self._max_in_use
+        return pool
+
+    def metrics(self) -> dict:
+        """
+        Returns:
+            dict: The pool size, the connections in use now and at most, the number of checkouts and
+                timeouts, and the p50/p95/max time waited for a connection (ms).
+        """
+        with self._metrics_lock:
+            p50, p95 = self._wait_times.percentiles(50, 95)
+            return {
+                "size": self.size(),
+                "max_overflow": self._max_overflow,
+                "in_use": self.checkedout(),
+                "in_use_max": self._max_in_use,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "wait_ms": [round(value * 1000, 2) for value in (p50, p95, self._wait_times.max())],
+            }
+
+
+class EngineFactory:
+    """
+    Creates one engine per database URL and hands it to every component of the process, so that the
+    MQTT backend and the web application share one connection pool and one set of connection settings.
+
+    The settings of the first request for a URL are used, later ones get the existing engine.
+    """
+
+    def __init__(self):
+        self._engines: dict[str, Engine] = {}
+        self._read_engines: dict[str, Engine] = {}
+        self._lock = threading.Lock()
+
+    def getEngine(self, url: str, settings: dict | None = None) -> Engine:
+        """
+        Returns the engine of a database, creating it on first use.
+
+        Args:
+            url (str): The URL of the database.
+            settings (dict | None, optional): The [database] settings section, for its "pool" and "sqlite"
+                subsections. Defaults to None (default pool and SQLite settings).
+
+        Returns:
+            Engine: The shared engine.
+
+        Raises:
+            ValueError: If the pool or SQLite settings are invalid.
+        """
+        key = normalizeUrl(url)
+        with self._lock:
+            engine = self._engines.get(key)
+            if engine is None:
+                engine = self._engines[key] = self._createEngine(url, settings or {})
+            return engine
+
+    def getReadEngine(self, url: str, settings: dict | None = None) -> Engine:
+        """
+        Returns the engine of the read-only sessions of a database, creating it on first use.
+
+        SQLite files are opened a second time in read-only mode, with their own pool: the long reads of the
+        web pages do not hold the connections of the writers. On server databases, the engine connects to
+        the replica of the "read_url" setting if set, else it shares the pool of the database, with
+        read-only transactions on PostgreSQL.
+
+        Args:
+            url (str): The URL of the database.
+            settings (dict | None, optional): The [database] settings section, for its "read_url" setting and
+                its "pool" and "sqlite" subsections. Defaults to None.
+
+        Returns:
+            Engine: The read-only engine.
+
+        Raises:
+            ValueError: If the pool or SQLite settings are invalid.
+        """
+        settings = settings or {}
+        key = normalizeUrl(url)
+        with self._lock:
+            engine = self._read_engines.get(key)
+        if engine is not None:
+            return engine
+
+        if _isMemory(url):
+            # A second connection would open another, empty, database
+            engine = self.getEngine(url, settings)
+        elif url.startswith("sqlite:///"):
+            path = make_url(url).database
+            engine = self._createEngine(f"sqlite:///file:{quote(path)}?mode=ro&uri=true", settings, True)
+        else:
+            engine = self.getEngine(settings.get("read_url") or url, settings)
+            if engine.dialect.name == "postgresql":
+                # Reset when the connections are returned to the shared pool
+                engine = engine.execution_options(postgresql_readonly=True)
+        with self._lock:
+            return self._read_engines.setdefault(key, engine)
+
+    def _createEngine(self, url: str, settings: dict, read_only: bool = False) -> Engine:
+        pool = PoolSettings.fromSettings(settings.get("pool"))
+        profile = SqliteProfile.fromSettings(settings.get("sqlite"))
+        if _isMemory(url):
+            # A memory database only lives in its connection, the default pool keeps one per thread
+            engine = create_engine(url, echo=False)
+        else:
+            engine = create_engine(
+                url,
+                echo=False,
+                poolclass=MeteredQueuePool,
+                pool_size=pool.size,
+                max_overflow=pool.max_overflow,
+                pool_timeout=pool.timeout_s,
+                pool_recycle=pool.recycle_s,
+            )
+        profile.attach(engine, read_only)
+        logging.debug("Created engine for %s with %s", engine.url, pool)
+        return engine
+
+    def dispose(self, url: str) -> None:
+        """
+        Closes the pooled connections of the engines of a database, e.g. before its file is replaced.
+        The engines stay usable, new connections are opened on demand.
+
+        Args:
+            url (str): The URL of the database.
+        """
+        key = normalizeUrl(url)
+        with self._lock:
+            engines = [self._engines.get(key), self._read_engines.get(key)]
+        for engine in engines:
+            if engine is not None:
+                engine.dispose()
+
+    def stats(self, url: str, read_only: bool = False) -> dict:
+        """
+        Args:
+            url (str): The URL of the database.
+            read_only (bool, optional): Metrics of the pool of the read-only engine. Defaults to False.
+
+        Returns:
+            dict: The metrics of the connection pool of the database (see MeteredQueuePool.metrics), empty if
+                its engine has not been created or does not use a metered pool.
+        """
+        with self._lock:
+            engines = self._read_engines if read_only else self._engines
+            engine = engines.get(normalizeUrl(url))
+        if engine is None or not isinstance(engine.pool, MeteredQueuePool):
+            return {}
+        return engine.pool.metrics()
+
+
+def _isMemory(url: str) -> bool:
+    return ":memory:" in url or url.rstrip("/") == "sqlite:"
+
+
+engine_factory = EngineFactory()
@@ -0,0 +1,107 @@
+""" Write-behind buffer of the inuse heartbeats of the open uses. """
+
+import logging
+import threading
+from time import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # DatabaseBackend clears the buffer when the database contents are replaced
+    from .DatabaseBackend import DatabaseBackend
+
+
+class HeartbeatBuffer:
+    """
+    Process-wide write-behind buffer for the inuse heartbeats sent by the boards.
+
+    Instead of committing the last_seen timestamp of an open use on every heartbeat, the latest
+    timestamp of each open use is kept in memory and all of them are written in a single
+    transaction, at most once per flush interval. The web pages merge the pending timestamps with
+    the database values.
+    """
+
+    def __init__(self, flush_interval_s: float = 30):
+        """
+        Initializes a new instance of the HeartbeatBuffer class.
+
+        Args:
+            flush_interval_s (float, optional): Minimum delay between two flushes. Defaults to 30.
+        """
+        self.flush_interval_s = flush_interval_s
+        self._pending: dict[int, float] = {}
+        self._last_flush = time()
+        self._lock = threading.Lock()
+
+    def touch(self, use_id: int, timestamp: float) -> None:
+        """
+        Records a heartbeat for an open use.
+
+        Args:
+            use_id (int): The ID of the open use.
+            timestamp (float): Time of the heartbeat.
+        """
+        with self._lock:
+            if timestamp > self._pending.get(use_id, 0):
+                self._pending[use_id] = timestamp
+
+    def lastSeen(self, use_id: int, db_last_seen: float) -> float:
+        """
+        Merges the last_seen value read from the database with the pending heartbeats.
+
+        Args:
+            use_id (int): The ID of the use.
+            db_last_seen (float): The last_seen value stored in the database.
+
+        Returns:
+            float: The most recent of the two timestamps.
+        """
+        return max(self._pending.get(use_id, 0), db_last_seen)
+
+    def pending(self) -> dict[int, float]:
+        """
+        Returns:
+            dict[int, float]: A copy of the heartbeats not yet written, keyed by use ID.
+        """
+        with self._lock:
+            return dict(self._pending)
+
+    def clear(self) -> None:
+        """Forgets the pending heartbeats, used when the database contents are replaced."""
+        with self._lock:
+            self._pending.clear()
+
+    def flush(self, db: "DatabaseBackend", force: bool = False) -> int:
+        """
+        Writes the pending heartbeats to the database in one transaction.
+
+        Args:
+            db (DatabaseBackend): The database to write to.
+            force (bool, optional): Flush even if the flush interval has not elapsed. Defaults to False.
+
+        Returns:
+            int: The number of uses updated.
+        """
+        if not force and time() - self._last_flush < self.flush_interval_s:
+            return 0
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time()
+
+        if len(pending) == 0:
+            return 0
+
+        try:
+            with db.getSession() as session:
+                updated = db.getUseRepository(session).updateLastSeen(pending)
+            logging.debug("Flushed %d heartbeats, %d uses updated", len(pending), updated)
+            return updated
+        except Exception as e:
+            logging.error("Heartbeats flush exception %s", str(e), exc_info=True)
+            # Keep the heartbeats for the next flush
+            for use_id, timestamp in pending.items():
+                self.touch(use_id, timestamp)
+            return 0
+
+
+use_heartbeats = HeartbeatBuffer()
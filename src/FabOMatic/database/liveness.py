@@ -0,0 +1,106 @@
+""" In-memory table of the last time each machine board was heard of. """
+
+import threading
+from time import time
+
+
+class LivenessTable:
+    """
+    Process-wide table of the machines last_seen timestamps.
+
+    Boards send a message every few seconds, and the timestamp only needs to reach the machines
+    table for other processes and restarts. The table keeps the latest timestamp of every machine
+    and tracks which ones changed since the last write, so they can be persisted in bulk.
+    """
+
+    def __init__(self, flush_interval_s: float = 30):
+        """
+        Initializes a new instance of the LivenessTable class.
+
+        Args:
+            flush_interval_s (float, optional): Minimum delay between two writes to the database. Defaults to 30.
+        """
+        self.flush_interval_s = flush_interval_s
+        self._last_seen: dict[int, float] = {}
+        self._dirty: set[int] = set()
+        self._last_flush = time()
+        self._lock = threading.Lock()
+
+    def touch(self, machine_id: int, timestamp: float) -> None:
+        """
+        Records that a machine board has been heard of.
+
+        Args:
+            machine_id (int): The ID of the machine.
+            timestamp (float): Time of the message.
+        """
+        with self._lock:
+            if timestamp > self._last_seen.get(machine_id, 0):
+                self._last_seen[machine_id] = timestamp
+                self._dirty.add(machine_id)
+
+    def lastSeen(self, machine_id: int, db_last_seen: float | None) -> float | None:
+        """
+        Merges the last_seen value read from the database with the in-memory one.
+
+        Args:
+            machine_id (int): The ID of the machine.
+            db_last_seen (float | None): The last_seen value stored in the database.
+
+        Returns:
+            float | None: The most recent of the two timestamps, None if the machine was never seen.
+        """
+        memory = self._last_seen.get(machine_id)
+        if memory is None:
+            return db_last_seen
+        if db_last_seen is None:
+            return memory
+        return max(memory, db_last_seen)
+
+    def activeCount(self, within_s: float) -> int:
+        """
+        Args:
+            within_s (float): Age of the last message, in seconds.
+
+        Returns:
+            int: The number of machines heard of within that time.
+        """
+        since = time() - within_s
+        return sum(1 for last_seen in list(self._last_seen.values()) if last_seen >= since)
+
+    def takeDirty(self, force: bool = False) -> dict[int, float]:
+        """
+        Gets the timestamps changed since the previous call, if the flush interval has elapsed.
+
+        Args:
+            force (bool, optional): Ignore the flush interval. Defaults to False.
+
+        Returns:
+            dict[int, float]: The timestamps to persist, keyed by machine ID.
+        """
+        with self._lock:
+            if not force and time() - self._last_flush < self.flush_interval_s:
+                return {}
+            self._last_flush = time()
+            dirty = {machine_id: self._last_seen[machine_id] for machine_id in self._dirty}
+            self._dirty.clear()
+            return dirty
+
+    def markDirty(self, machine_ids) -> None:
+        """
+        Marks machines to be written again on the next flush, e.g. after a failed write.
+
+        Args:
+            machine_ids (iterable): The IDs of the machines.
+        """
+        with self._lock:
+            self._dirty.update(machine_id for machine_id in machine_ids if machine_id in self._last_seen)
+
+    def clear(self) -> None:
+        """Forgets all the timestamps, used when the database contents are replaced."""
+        with self._lock:
+            self._last_seen.clear()
+            self._dirty.clear()
+
+
+machine_liveness = LivenessTable()
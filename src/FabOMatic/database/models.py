@@ -5,25 +5,33 @@ import os
 from time import time
 from itsdangerous import URLSafeTimedSerializer as Serializer
 from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, UniqueConstraint
-from sqlalchemy import event, Engine, Index
+from sqlalchemy import event, Engine, Index, text
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 
 from .constants import DEFAULT_TIMEOUT_MINUTES, USER_LEVEL
+from .liveness import machine_liveness
 
 Base = declarative_base()
 
 
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
-    """Set SQLite PRAGMA foreign_keys=ON."""
+    """Set SQLite PRAGMA foreign_keys=ON.
+
+    Performance settings are applied by the SqliteProfile of the engine, and PRAGMA optimize is run
+    periodically by DatabaseBackend.optimize.
+    """
     if isinstance(dbapi_connection, sqlite3.Connection):  # play well with other DB backends
         cursor = dbapi_connection.cursor()
         cursor.execute("PRAGMA foreign_keys=ON")
-        cursor.execute("pragma auto_vacuum = incremental;")
-        cursor.execute("pragma optimize;")
+        try:
+            cursor.execute("pragma auto_vacuum = incremental;")
+        except sqlite3.OperationalError:
+            # Connections of the read-only engine cannot change it, it only applies to new databases anyway
+            pass
         cursor.close()
 
 
@@ -71,7 +79,7 @@ class User(UserMixin, Base):
     card_UUID = Column(String, unique=True, nullable=True)
     disabled = Column(Boolean, unique=False, nullable=False, default=False)
     deleted = Column(Boolean, unique=False, nullable=False, default=False)
-    password_hash = Column(String(128), nullable=True)
+    password_hash = Column(String(256), nullable=True)
     email = Column(String, nullable=True)
     receive_weekly_summary = Column(Boolean, unique=False, nullable=False, default=False)
 
@@ -185,6 +193,7 @@ class Maintenance(Base):
 
     machine = relationship("Machine", back_populates="maintenances")
     interventions = relationship("Intervention", back_populates="maintenance", cascade="all, delete-orphan")
+    counters = relationship("MaintenanceCounter", back_populates="maintenance", cascade="all, delete-orphan")
 
     def serialize(self):
         """Serialize data and return a Dict."""
@@ -215,6 +224,11 @@ class Intervention(Base):
     timestamp = Column(Float, nullable=False)
     replay = Column(Boolean, nullable=True)
 
+    __table_args__ = (
+        Index("idx_interventions_machine_maintenance_timestamp", "machine_id", "maintenance_id", "timestamp"),
+        Index("idx_interventions_timestamp", "timestamp"),
+    )
+
     machine = relationship("Machine", back_populates="interventions")
     maintenance = relationship("Maintenance", back_populates="interventions")
     user = relationship("User", back_populates="interventions")
@@ -231,6 +245,35 @@ class Intervention(Base):
         }
 
 
+class MaintenanceCounter(Base):
+    """Machine use time accumulated since the last intervention of a maintenance.
+
+    Incremented when a use is closed and reset when the intervention is registered, so the maintenance
+    status does not need to sum the uses. Counters can be recomputed from the uses and interventions
+    with MaintenanceCounterRepository.rebuild.
+    """
+
+    __tablename__ = "maintenance_counters"
+
+    machine_id = Column(Integer, ForeignKey("machines.machine_id", ondelete="CASCADE"), primary_key=True)
+    maintenance_id = Column(
+        Integer, ForeignKey("maintenances.maintenance_id", ondelete="CASCADE"), primary_key=True
+    )
+    seconds = Column(Float, nullable=False, default=0)
+    last_intervention = Column(Float, nullable=False, default=0)
+
+    maintenance = relationship("Maintenance", back_populates="counters")
+
+    def serialize(self):
+        """Serialize data and return a Dict."""
+        return {
+            "machine_id": self.machine_id,
+            "maintenance_id": self.maintenance_id,
+            "seconds": self.seconds,
+            "last_intervention": self.last_intervention,
+        }
+
+
 class MachineType(Base):
     """Dataclass handling a machine type."""
 
@@ -307,12 +350,17 @@ class Machine(Base):
             return sorted(self.boards, key=lambda b: b.last_seen, reverse=True)[0]
         return None
 
+    def lastSeen(self) -> float | None:
+        """Last machine communication, including the one not yet written to the database."""
+        return machine_liveness.lastSeen(self.machine_id, self.last_seen)
+
     def isOnline(self) -> bool:
         """Indicates is the last machine communication is less than 90s ago"""
-        if self.last_seen is None:
+        last_seen = self.lastSeen()
+        if last_seen is None:
             return False
 
-        return time() - self.last_seen < 90
+        return time() - last_seen < 90
 
 
 class Use(Base):
@@ -328,6 +376,26 @@ class Use(Base):
     end_timestamp = Column(Float, nullable=True)
     replay = Column(Boolean, nullable=True)
 
+    # Open uses are few, partial indexes keep them at hand for the board messages and the orphans check
+    __table_args__ = (
+        Index("idx_uses_machine_start", "machine_id", "start_timestamp", "end_timestamp"),
+        Index("idx_uses_user_id", "user_id"),
+        Index("idx_uses_start_timestamp", "start_timestamp"),
+        Index("idx_uses_last_seen", "last_seen"),
+        Index(
+            "idx_uses_open_machine_id",
+            "machine_id",
+            sqlite_where=text("end_timestamp IS NULL"),
+            postgresql_where=text("end_timestamp IS NULL"),
+        ),
+        Index(
+            "idx_uses_open_last_seen",
+            "last_seen",
+            sqlite_where=text("end_timestamp IS NULL"),
+            postgresql_where=text("end_timestamp IS NULL"),
+        ),
+    )
+
     machine = relationship("Machine", back_populates="uses")
     user = relationship("User", back_populates="uses")
 
@@ -357,6 +425,8 @@ class UnknownCard(Base):
     timestamp = Column(Float, nullable=False)
     machine_id = Column(Integer, ForeignKey("machines.machine_id"), nullable=False)
 
+    __table_args__ = (Index("idx_unknown_cards_timestamp", "timestamp"),)
+
     machine = relationship("Machine", back_populates="cards")
 
     def serialize(self):
@@ -388,6 +458,8 @@ class Board(Base):
 
     last_seen = Column(Float, nullable=False)
 
+    __table_args__ = (Index("idx_boards_machine_id", "machine_id"),)
+
     machine = relationship("Machine", back_populates="boards")
 
     def serialize(self):
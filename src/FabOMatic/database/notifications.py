@@ -0,0 +1,144 @@
+""" Notifications of the database changes, sent once the transaction is committed. """
+
+import logging
+import threading
+import weakref
+from dataclasses import dataclass, field
+
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+
+# Session.info key holding the changes flushed in the current transaction
+PENDING_CHANGES = "pending_changes"
+
+
+@dataclass(frozen=True)
+class Change:
+    """A row inserted, updated or deleted through the ORM.
+
+    Attributes:
+        model (type): The model class of the row.
+        operation (str): "insert", "update" or "delete".
+        values (dict): The loaded column values of the row, after the change (before it, for a deletion).
+        changed (frozenset): The names of the columns modified by an update.
+    """
+
+    model: type
+    operation: str
+    values: dict
+    changed: frozenset = field(default_factory=frozenset)
+
+
+def normalizeUrl(url) -> str:
+    """Return a comparable representation of a database URL."""
+    return make_url(url).render_as_string(hide_password=False)
+
+
+class ChangeNotifier:
+    """
+    Collects the ORM changes of every session and forwards them to the subscribers of the database,
+    after the transaction is committed. The changes of a rolled back transaction are discarded.
+
+    Subscribers are kept with weak references, so they do not need to unsubscribe.
+    """
+
+    def __init__(self):
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, url: str, callback) -> None:
+        """
+        Registers a callback for the changes committed to a database.
+
+        Args:
+            url (str): The URL of the database.
+            callback (callable): Called with the list of changes, or None when the whole database has been replaced.
+                Bound methods are referenced weakly.
+        """
+        if hasattr(callback, "__self__"):
+            ref = weakref.WeakMethod(callback)
+        else:
+            ref = weakref.ref(callback)
+        with self._lock:
+            self._subscribers.append((normalizeUrl(url), ref))
+
+    def notify(self, url: str, changes: list[Change] | None) -> None:
+        """
+        Sends changes to the subscribers of a database.
+
+        Args:
+            url (str): The URL of the database.
+            changes (list[Change] | None): The committed changes, None if the whole database changed.
+        """
+        url = normalizeUrl(url)
+        with self._lock:
+            self._subscribers = [(u, ref) for u, ref in self._subscribers if ref() is not None]
+            callbacks = [ref() for u, ref in self._subscribers if u == url]
+
+        for callback in callbacks:
+            if callback is None:
+                continue
+            try:
+                callback(changes)
+            except Exception as e:
+                logging.error("Change notification exception %s", str(e), exc_info=True)
+
+    def notifyReset(self, url: str) -> None:
+        """
+        Tells the subscribers that the contents of the database have been replaced.
+
+        Args:
+            url (str): The URL of the database.
+        """
+        self.notify(url, None)
+
+
+changes_notifier = ChangeNotifier()
+
+
+def _snapshot(obj) -> dict:
+    # Only the loaded values, so that no query is issued during the flush. Attributes of an object
+    # expired by a previous commit are missing, except for the primary key taken from its identity.
+    state = inspect(obj)
+    values = {attr.key: state.dict[attr.key] for attr in state.mapper.column_attrs if attr.key in state.dict}
+    if state.identity is not None:
+        for column, value in zip(state.mapper.primary_key, state.identity):
+            values.setdefault(state.mapper.get_property_by_column(column).key, value)
+    return values
+
+
+@event.listens_for(Session, "after_flush")
+def _collectChanges(session: Session, flush_context):
+    pending = session.info.setdefault(PENDING_CHANGES, [])
+    for obj in session.new:
+        pending.append(Change(type(obj), "insert", _snapshot(obj)))
+    for obj in session.dirty:
+        state = inspect(obj)
+        changed = frozenset(
+            attr.key for attr in state.mapper.column_attrs if state.attrs[attr.key].history.has_changes()
+        )
+        if len(changed) > 0:
+            pending.append(Change(type(obj), "update", _snapshot(obj), changed))
+    for obj in session.deleted:
+        pending.append(Change(type(obj), "delete", _snapshot(obj)))
+
+
+@event.listens_for(Session, "after_commit")
+def _dispatchChanges(session: Session):
+    if session.in_nested_transaction():
+        # Released savepoint, the changes are committed with the enclosing transaction
+        return
+    pending = session.info.pop(PENDING_CHANGES, None)
+    if not pending:
+        return
+    changes_notifier.notify(session.get_bind().url, pending)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discardChanges(session: Session, previous_transaction):
+    if previous_transaction.nested:
+        # Rolled back savepoint: the changes flushed before it are still pending, the ones made inside it are
+        # kept too, an extra notification only refreshes unchanged data
+        return
+    session.info.pop(PENDING_CHANGES, None)
@@ -1,11 +1,13 @@
 """ Database repositories for the FabOMatic application."""
 
 import logging
+from dataclasses import dataclass
 from datetime import datetime
 from time import time
 from typing import List, Optional, Tuple
 
-from sqlalchemy import update
+from sqlalchemy import and_, bindparam, delete, exists, func, insert, literal, or_, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 from .models import (
@@ -16,6 +18,7 @@ from .models import (
     Intervention,
     User,
     Maintenance,
+    MaintenanceCounter,
     Authorization,
     Role,
     Base,
@@ -25,29 +28,87 @@ from .constants import DEFAULT_TIMEOUT_MINUTES
 from sqlalchemy.orm import object_session
 
 
+# Session.info key set by DatabaseBackend.unitOfWork: repositories flush instead of committing
+UNIT_OF_WORK = "unit_of_work"
+
+
+def inUnitOfWork(session: Session) -> bool:
+    """Return True if the session is managed by DatabaseBackend.unitOfWork."""
+    return session.info.get(UNIT_OF_WORK, False)
+
+
+# Session.info key of the sessions connected to a read-only engine
+READ_ONLY = "read_only"
+
+
+def isReadOnly(session: Session) -> bool:
+    """Return True if the session cannot write, e.g. the sessions of the web listing pages."""
+    return session.info.get(READ_ONLY, False)
+
+
+@dataclass(frozen=True)
+class MaintenanceStatus:
+    """Use time of a Machine since the last intervention of one of its maintenances."""
+
+    maintenance: Maintenance
+    elapsed_s: float
+
+    @property
+    def elapsed_h(self) -> float:
+        """Use time since the last intervention, in hours."""
+        return self.elapsed_s / 3600.0
+
+    @property
+    def expired(self) -> bool:
+        """True if the maintenance is due."""
+        return self.elapsed_s > self.maintenance.hours_between * 3600.0
+
+    @property
+    def overdue_h(self) -> float:
+        """Use time since the maintenance is due in hours, negative if not due yet."""
+        return self.elapsed_h - self.maintenance.hours_between
+
+
 class BaseRepository:
     """Base class for all repositories."""
 
     def __init__(self, db_session: Session):
         self.db_session = db_session
 
+    def _commit(self, session: Session = None) -> bool:
+        """Commit the session, or only flush it when it is part of a unit of work.
+
+        Args:
+            session (Session, optional): session to commit. Defaults to the repository session.
+
+        Returns:
+            bool: True if the session was committed, False if it was only flushed.
+        """
+        if session is None:
+            session = self.db_session
+        if inUnitOfWork(session):
+            session.flush()
+            return False
+        session.commit()
+        return True
+
     def create(self, model: Base):
         """Create a new model instance in the database."""
         self.db_session.add(model)
-        self.db_session.commit()
-        self.db_session.refresh(model)
+        if self._commit():
+            self.db_session.refresh(model)
 
     def update(self, model: Base):
         """Update an existing model instance in the database."""
         if object_session(model) is None:
             raise ValueError("Object is not bound to a session")
-        object_session(model).commit()
-        self.db_session.refresh(model)
+        if self._commit(object_session(model)):
+            self.db_session.refresh(model)
 
     def delete(self, model: Base):
         """Delete a model instance from the database."""
         self.db_session.delete(model)
-        self.db_session.commit()
+        self._commit()
 
     def rollback(self):
         """Rollback the current database session."""
@@ -179,8 +240,12 @@ class UserRepository(BaseRepository):
         Returns:
             float: User time in seconds
         """
-        uses = self.db_session.query(Use).filter(Use.user_id == user_id, Use.end_timestamp.is_not(None)).all()
-        return sum([use.end_timestamp - use.start_timestamp for use in uses], 0)
+        total = (
+            self.db_session.query(func.sum(Use.end_timestamp - Use.start_timestamp))
+            .filter(Use.user_id == user_id, Use.end_timestamp.is_not(None))
+            .scalar()
+        )
+        return total if total is not None else 0
 
     def IsUserAuthorizedForMachine(self, machine: Machine, user: User) -> bool:
         """Return True if the User is authorized to use the Machine, False otherwise.
@@ -211,6 +276,45 @@ class UserRepository(BaseRepository):
 
         return machine.machine_id in machine_ids
 
+    def getAuthorizedCards(self, machine_id: int) -> List[Tuple[str, bool]]:
+        """Get the cards of the users authorized to use a machine, with a single query.
+
+        Same rules as IsUserAuthorizedForMachine, users without card are skipped.
+
+        Args:
+            machine_id (int): The ID of the machine.
+
+        Returns:
+            List[Tuple[str, bool]]: (card_UUID, authorize_all) of each authorized user, ordered by user ID.
+                Empty if the machine does not exist.
+        """
+        authorized = (
+            self.db_session.query(Authorization.authorization_id)
+            .filter(Authorization.user_id == User.user_id, Authorization.machine_id == Machine.machine_id)
+            .exists()
+        )
+        query = (
+            self.db_session.query(User.card_UUID, Role.authorize_all)
+            .join(Role, Role.role_id == User.role_id)
+            .join(Machine, Machine.machine_id == machine_id)
+            .outerjoin(MachineType, MachineType.type_id == Machine.machine_type_id)
+            .filter(
+                User.disabled.is_(False),
+                User.deleted.is_(False),
+                User.card_UUID.is_not(None),
+                User.card_UUID != "",
+                or_(
+                    Role.authorize_all.is_(True),
+                    and_(
+                        Machine.blocked.is_(False),
+                        or_(MachineType.access_management == MachineType.MANAGEMENT_WITHOUT_AUTHORIZATION, authorized),
+                    ),
+                ),
+            )
+            .order_by(User.user_id)
+        )
+        return [(card_uuid, bool(authorize_all)) for card_uuid, authorize_all in query]
+
     def get_all(self) -> List[User]:
         """Get all users.
 
@@ -279,6 +383,216 @@ class MaintenanceRepository(BaseRepository):
         return self.db_session.query(Maintenance).order_by(Maintenance.maintenance_id).all()
 
 
+class MaintenanceCounterRepository(BaseRepository):
+    """
+    Repository class for the use time accumulated by the machines since their last maintenance interventions.
+    """
+
+    def __init__(self, db_session: Session):
+        super().__init__(db_session)
+
+    def getMaintenanceStatus(self, machine_id: int = None) -> List[MaintenanceStatus]:
+        """Return the use time since the last intervention of every maintenance, in a single query.
+
+        Counters missing (maintenances added since the last rebuild) or outdated (interventions added, edited
+        or deleted without resetting them) are computed from the history first. They are stored in a savepoint,
+        with the transaction of the session: the pending work of the caller is not committed by a read.
+
+        Args:
+            machine_id (int, optional): id of the Machine. Defaults to None, for all the machines.
+
+        Returns:
+            List[MaintenanceStatus]: the status of the maintenances, ordered by machine and maintenance.
+        """
+        last_intervention = (
+            select(func.max(Intervention.timestamp))
+            .where(
+                Intervention.machine_id == Maintenance.machine_id,
+                Intervention.maintenance_id == Maintenance.maintenance_id,
+            )
+            .scalar_subquery()
+        )
+        query = (
+            select(
+                Maintenance,
+                MaintenanceCounter.seconds,
+                MaintenanceCounter.last_intervention == func.coalesce(last_intervention, 0),
+            )
+            .outerjoin(
+                MaintenanceCounter,
+                and_(
+                    MaintenanceCounter.maintenance_id == Maintenance.maintenance_id,
+                    MaintenanceCounter.machine_id == Maintenance.machine_id,
+                ),
+            )
+            .order_by(Maintenance.machine_id, Maintenance.maintenance_id)
+        )
+        if machine_id is not None:
+            query = query.where(Maintenance.machine_id == machine_id)
+
+        rows = self.db_session.execute(query).all()
+        outdated = {maintenance.machine_id for maintenance, _, up_to_date in rows if not up_to_date}
+        if len(outdated) == 0:
+            return [MaintenanceStatus(maintenance, seconds or 0) for maintenance, seconds, _ in rows]
+        if isReadOnly(self.db_session):
+            # The counters cannot be rebuilt
+            return self._computeStatuses(rows)
+
+        try:
+            with self.db_session.begin_nested():
+                for outdated_machine_id in sorted(outdated):
+                    self._rebuild(outdated_machine_id)
+        except IntegrityError:
+            # Another worker stored the missing counters first, its transaction may not be visible yet
+            logging.info("Maintenance counters of machines %s rebuilt concurrently", sorted(outdated))
+            return self._computeStatuses(rows)
+        rows = self.db_session.execute(query).all()
+        return [MaintenanceStatus(maintenance, seconds or 0) for maintenance, seconds, _ in rows]
+
+    def _computeStatuses(self, rows: list) -> List[MaintenanceStatus]:
+        """Return the statuses of the rows of getMaintenanceStatus, computing the outdated ones without storing them.
+
+        Args:
+            rows (list): the (Maintenance, seconds, up_to_date) rows.
+
+        Returns:
+            List[MaintenanceStatus]: the status of the maintenances, in the order of the rows.
+        """
+        machine_repo = MachineRepository(self.db_session)
+        return [
+            MaintenanceStatus(
+                maintenance,
+                (
+                    (seconds or 0)
+                    if up_to_date
+                    else machine_repo.getRelativeUseTimeByMaintenance(maintenance.machine_id, maintenance)
+                ),
+            )
+            for maintenance, seconds, up_to_date in rows
+        ]
+
+    def getCounters(self, machine_id: int) -> dict[int, float]:
+        """Return the use time of a Machine since the last intervention, for each of its maintenances.
+
+        Args:
+            machine_id (int): id of the Machine
+
+        Returns:
+            dict[int, float]: use time in seconds, keyed by maintenance_id
+        """
+        statuses = self.getMaintenanceStatus(machine_id)
+        return {status.maintenance.maintenance_id: status.elapsed_s for status in statuses}
+
+    def addUseTime(self, machine_id: int, start_timestamp: float, duration_s: float) -> int:
+        """Add the duration of a closed use to the counters of the Machine.
+
+        The use is not counted for the maintenances done after it started, as when summing the uses.
+        The session is neither flushed nor committed.
+
+        Args:
+            machine_id (int): id of the Machine
+            start_timestamp (float): start of the use
+            duration_s (float): duration of the use in seconds
+
+        Returns:
+            int: number of counters incremented
+        """
+        result = self.db_session.execute(
+            update(MaintenanceCounter)
+            .where(
+                MaintenanceCounter.machine_id == machine_id,
+                MaintenanceCounter.last_intervention < start_timestamp,
+            )
+            .values(seconds=MaintenanceCounter.seconds + duration_s)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+    def reset(self, machine_id: int, maintenance_id: int, timestamp: float) -> None:
+        """Reset the counter of a maintenance after an intervention. The session is neither flushed nor committed.
+
+        Args:
+            machine_id (int): id of the Machine
+            maintenance_id (int): id of the Maintenance
+            timestamp (float): time of the intervention
+        """
+        self.db_session.execute(
+            update(MaintenanceCounter)
+            .where(
+                MaintenanceCounter.machine_id == machine_id,
+                MaintenanceCounter.maintenance_id == maintenance_id,
+                MaintenanceCounter.last_intervention <= timestamp,
+            )
+            .values(seconds=0, last_intervention=timestamp)
+            .execution_options(synchronize_session=False)
+        )
+
+    def rebuild(self, machine_id: int = None) -> int:
+        """Recompute the counters from the uses and the interventions, after they have been edited.
+
+        Args:
+            machine_id (int, optional): id of the Machine. Defaults to None, for all the machines.
+
+        Returns:
+            int: number of counters recomputed
+        """
+        count = self._rebuild(machine_id)
+        self._commit()
+        logging.info("Rebuilt %d maintenance counters", count)
+        return count
+
+    def _rebuild(self, machine_id: int = None) -> int:
+        """Recompute the counters as rebuild does, without flushing nor committing the session.
+
+        Args:
+            machine_id (int, optional): id of the Machine. Defaults to None, for all the machines.
+
+        Returns:
+            int: number of counters recomputed
+        """
+        same_maintenance = and_(
+            Maintenance.maintenance_id == MaintenanceCounter.maintenance_id,
+            Maintenance.machine_id == MaintenanceCounter.machine_id,
+        )
+        # Counters of maintenances deleted or moved to another machine
+        stale = delete(MaintenanceCounter).where(~exists().where(same_maintenance))
+        missing = select(Maintenance.machine_id, Maintenance.maintenance_id, literal(0.0), literal(0.0)).where(
+            ~exists().where(same_maintenance)
+        )
+        last_intervention = func.coalesce(
+            select(func.max(Intervention.timestamp))
+            .where(
+                Intervention.machine_id == MaintenanceCounter.machine_id,
+                Intervention.maintenance_id == MaintenanceCounter.maintenance_id,
+            )
+            .correlate_except(Intervention)
+            .scalar_subquery(),
+            0,
+        )
+        seconds = (
+            select(func.sum(Use.end_timestamp - Use.start_timestamp))
+            .where(
+                Use.machine_id == MaintenanceCounter.machine_id,
+                Use.end_timestamp.is_not(None),
+                Use.start_timestamp > last_intervention,
+            )
+            .scalar_subquery()
+        )
+        recompute = update(MaintenanceCounter).values(
+            last_intervention=last_intervention, seconds=func.coalesce(seconds, 0)
+        )
+        if machine_id is not None:
+            stale = stale.where(MaintenanceCounter.machine_id == machine_id)
+            missing = missing.where(Maintenance.machine_id == machine_id)
+            recompute = recompute.where(MaintenanceCounter.machine_id == machine_id)
+
+        columns = ["machine_id", "maintenance_id", "seconds", "last_intervention"]
+        self.db_session.execute(stale.execution_options(synchronize_session=False))
+        self.db_session.execute(insert(MaintenanceCounter).from_select(columns, missing))
+        result = self.db_session.execute(recompute.execution_options(synchronize_session=False))
+        return result.rowcount
+
+
 class InterventionRepository(BaseRepository):
     def __init__(self, db_session: Session):
         """
@@ -319,13 +633,11 @@ class InterventionRepository(BaseRepository):
         if user.disabled:
             raise ValueError("Invalid user")
 
-        machine_repo = MachineRepository(self.db_session)
+        counter_repo = MaintenanceCounterRepository(self.db_session)
+        counters = counter_repo.getCounters(machine.machine_id)
         timestamp = time()
         for maintenance in machine.maintenances:
-            if (
-                machine_repo.getRelativeUseTimeByMaintenance(machine.machine_id, maintenance)
-                > maintenance.hours_between * 3600
-            ):
+            if counters.get(maintenance.maintenance_id, 0) > maintenance.hours_between * 3600:
                 intervention = Intervention(
                     machine_id=machine.machine_id,
                     maintenance_id=maintenance.maintenance_id,
@@ -333,7 +645,8 @@ class InterventionRepository(BaseRepository):
                     user_id=user.user_id,
                 )
                 self.db_session.add(intervention)
-        self.db_session.commit()
+                counter_repo.reset(machine.machine_id, maintenance.maintenance_id, timestamp)
+        self._commit()
 
     def purge_records(self, anon: User, cut_off: datetime) -> int:
         """Purge intervention records older than the cutoff date by anonymizing them.
@@ -361,7 +674,7 @@ class InterventionRepository(BaseRepository):
                     update(Intervention).where(Intervention.timestamp < cutoff_timestamp).values(user_id=anon.user_id)
                 )
                 # Commit the transaction
-                self.db_session.commit()
+                self._commit()
                 logging.info(f"Anonymized {num_records_to_anonymize} old Intervention records.")
 
             return num_records_to_anonymize
@@ -394,6 +707,35 @@ class MachineRepository(BaseRepository):
             is not None
         )
 
+    def updateLastSeen(self, last_seen: dict[int, float]) -> int:
+        """Update the last_seen timestamp of several machines in one transaction.
+
+        Timestamps older than the stored ones are left untouched.
+
+        Args:
+            last_seen (dict[int, float]): new last_seen timestamps, keyed by machine_id
+
+        Returns:
+            int: number of machines updated
+        """
+        if len(last_seen) == 0:
+            return 0
+
+        table = Machine.__table__
+        statement = (
+            table.update()
+            .where(
+                table.c.machine_id == bindparam("b_machine_id"),
+                or_(table.c.last_seen.is_(None), table.c.last_seen < bindparam("b_last_seen")),
+            )
+            .values(last_seen=bindparam("b_last_seen"))
+        )
+        result = self.db_session.execute(
+            statement, [{"b_machine_id": machine_id, "b_last_seen": ts} for machine_id, ts in last_seen.items()]
+        )
+        self._commit()
+        return result.rowcount
+
     def getTimeout(self, machine_id: int) -> int:
         """
         Retrieves the timeout value for a given machine.
@@ -443,36 +785,41 @@ class MachineRepository(BaseRepository):
         """
         return self.db_session.query(Machine).order_by(Machine.machine_id).all()
 
-    def getRelativeUseTime(self, machine_id: int) -> int:
-        """Return total time the Machine has been used since last intervention.
+    def _sumUseTime(
+        self, machine_id: int, since_intervention: bool = False, maintenance_id: int = None
+    ) -> Tuple[float, int]:
+        """Sum the duration of the closed uses of a Machine in the database, without loading them.
 
         Args:
             machine_id (int): id of the Machine
+            since_intervention (bool, optional): only sum the uses started after the last intervention.
+                Defaults to False.
+            maintenance_id (int, optional): only consider the interventions of this Maintenance. Defaults to None.
 
         Returns:
-            int: Machine time in seconds
+            Tuple[float, int]: total time in seconds (0 if no use) and number of uses summed
         """
-        record = (
-            self.db_session.query(Intervention)
-            .filter(Intervention.machine_id == machine_id)
-            .order_by(Intervention.timestamp.desc())
-            .first()
-        )
+        query = self.db_session.query(
+            func.sum(Use.end_timestamp - Use.start_timestamp), func.count(Use.use_id)
+        ).filter(Use.end_timestamp.is_not(None), Use.machine_id == machine_id)
+        if since_intervention:
+            last_intervention = select(func.max(Intervention.timestamp)).where(Intervention.machine_id == machine_id)
+            if maintenance_id is not None:
+                last_intervention = last_intervention.where(Intervention.maintenance_id == maintenance_id)
+            query = query.filter(Use.start_timestamp > func.coalesce(last_intervention.scalar_subquery(), 0))
+        total, count = query.one()
+        return (total if total is not None else 0), count
 
-        if record is None:
-            last_intervention = 0
-        else:
-            last_intervention = record.timestamp
+    def getRelativeUseTime(self, machine_id: int) -> int:
+        """Return total time the Machine has been used since last intervention.
 
-        uses = (
-            self.db_session.query(Use)
-            .filter(
-                Use.end_timestamp.is_not(None), Use.machine_id == machine_id, Use.start_timestamp > last_intervention
-            )
-            .all()
-        )
+        Args:
+            machine_id (int): id of the Machine
 
-        return sum([use.end_timestamp - use.start_timestamp for use in uses], 0)
+        Returns:
+            int: Machine time in seconds
+        """
+        return self._sumUseTime(machine_id, since_intervention=True)[0]
 
     def getRelativeUseTimeByMaintenance(self, machine_id: int, maintenance: Maintenance) -> int:
         """Return total time the Machine has been used since last intervention.
@@ -484,29 +831,14 @@ class MachineRepository(BaseRepository):
         Returns:
             int: Machine time in seconds
         """
-        record = (
-            self.db_session.query(Intervention)
-            .filter(Intervention.machine_id == machine_id, Intervention.maintenance_id == maintenance.maintenance_id)
-            .order_by(Intervention.timestamp.desc())
-            .first()
-        )
-
-        if record is None:
-            last_intervention = 0
-        else:
-            last_intervention = record.timestamp
-
-        uses = (
-            self.db_session.query(Use)
-            .filter(
-                Use.end_timestamp.is_not(None), Use.machine_id == machine_id, Use.start_timestamp > last_intervention
-            )
-            .all()
-        )
-
-        relative_time = sum([use.end_timestamp - use.start_timestamp for use in uses], 0)
+        relative_time, count = self._sumUseTime(machine_id, True, maintenance.maintenance_id)
         logging.debug(
-            f"Machine {machine_id} Maintenance [{maintenance.description} - {maintenance.lcd_message}], last_intervention {last_intervention} relative time = {relative_time} seconds ({len(uses)} uses)"
+            "Machine %s Maintenance [%s - %s], relative time = %s seconds (%d uses)",
+            machine_id,
+            maintenance.description,
+            maintenance.lcd_message,
+            relative_time,
+            count,
         )
         return relative_time
 
@@ -519,10 +851,8 @@ class MachineRepository(BaseRepository):
         Returns:
             int: Machine time in seconds
         """
-        uses = self.db_session.query(Use).filter(Use.end_timestamp.is_not(None), Use.machine_id == machine_id).all()
-
-        total_time = sum([use.end_timestamp - use.start_timestamp for use in uses], 0)
-        logging.debug(f"Machine {machine_id} total time = {total_time} seconds ({len(uses)} uses)")
+        total_time, count = self._sumUseTime(machine_id)
+        logging.debug("Machine %s total time = %s seconds (%d uses)", machine_id, total_time, count)
         return total_time
 
     def getMachineMaintenanceNeeded(self, machine_id: int) -> Tuple[bool, str]:
@@ -534,11 +864,10 @@ class MachineRepository(BaseRepository):
         Returns:
             bool
         """
-        machine = self.db_session.query(Machine).filter(Machine.machine_id == machine_id).first()
-        for maintenance in machine.maintenances:
-            if self.getRelativeUseTimeByMaintenance(machine_id, maintenance) > maintenance.hours_between * 3600.0:
-                logging.debug(f"Machine {machine_id} needs maintenance [{maintenance.description}]")
-                return (True, maintenance.lcd_message)
+        for status in MaintenanceCounterRepository(self.db_session).getMaintenanceStatus(machine_id):
+            if status.expired:
+                logging.debug(f"Machine {machine_id} needs maintenance [{status.maintenance.description}]")
+                return (True, status.maintenance.lcd_message)
 
         return (False, "")
 
@@ -589,10 +918,51 @@ class UseRepository(BaseRepository):
                 end_timestamp=None,
             )
         )
-        self.db_session.commit()
+        self._commit()
 
         return True
 
+    def getOpenUse(self, machine_id: int) -> Optional[Use]:
+        """Get the Use of a Machine which has not been closed yet.
+
+        Args:
+            machine_id (int): id of the Machine
+
+        Returns:
+            Optional[Use]: the open Use, None if the machine is not in use.
+        """
+        return self.db_session.query(Use).filter(Use.machine_id == machine_id, Use.end_timestamp.is_(None)).first()
+
+    def updateLastSeen(self, last_seen: dict[int, float]) -> int:
+        """Update the last_seen timestamp of several open uses in one transaction.
+
+        Closed uses and timestamps older than the stored ones are left untouched.
+
+        Args:
+            last_seen (dict[int, float]): new last_seen timestamps, keyed by use_id
+
+        Returns:
+            int: number of uses updated
+        """
+        if len(last_seen) == 0:
+            return 0
+
+        table = Use.__table__
+        statement = (
+            table.update()
+            .where(
+                table.c.use_id == bindparam("b_use_id"),
+                table.c.end_timestamp.is_(None),
+                table.c.last_seen < bindparam("b_last_seen"),
+            )
+            .values(last_seen=bindparam("b_last_seen"))
+        )
+        result = self.db_session.execute(
+            statement, [{"b_use_id": use_id, "b_last_seen": ts} for use_id, ts in last_seen.items()]
+        )
+        self._commit()
+        return result.rowcount
+
     def inUse(self, machine_id: int, user: User, duration_s: int) -> bool:
         """Register current usage of the machine by a user.
 
@@ -609,7 +979,7 @@ class UseRepository(BaseRepository):
         if machine is None or user is None or duration_s < 0 or duration_s > UseRepository.MAX_DURATION:
             return False
 
-        record = self.db_session.query(Use).filter(Use.machine_id == machine_id, Use.end_timestamp.is_(None)).first()
+        record = self.getOpenUse(machine_id)
         end = time()
 
         if record is None:
@@ -627,7 +997,7 @@ class UseRepository(BaseRepository):
             # Update existing record
             record.last_seen = end
 
-        self.db_session.commit()
+        self._commit()
 
         return True
 
@@ -650,7 +1020,8 @@ class UseRepository(BaseRepository):
         if duration_s < 0 or duration_s > UseRepository.MAX_DURATION:
             duration_s = 1
 
-        record = self.db_session.query(Use).filter(Use.machine_id == machine_id, Use.end_timestamp.is_(None)).first()
+        counter_repo = MaintenanceCounterRepository(self.db_session)
+        record = self.getOpenUse(machine_id)
         end = time()
 
         if record is None:
@@ -677,27 +1048,30 @@ class UseRepository(BaseRepository):
             )
             if existing_record is None:
                 logging.warning("Missing startUse detected, creating new record on the fly.")
+                counter_repo.addUseTime(machine_id, record.start_timestamp, duration_s)
                 self.create(record)
                 machine.machine_hours += (record.end_timestamp - record.start_timestamp) / 3600.0
-                self.db_session.commit()
+                self._commit()
             else:
                 logging.warning("Duplicate stopUse detected, ignoring client request")
         else:
             # Update existing record
             record.end_timestamp = record.start_timestamp + duration_s
             record.last_seen = end
-            self.db_session.commit()
+            counter_repo.addUseTime(machine_id, record.start_timestamp, duration_s)
+            self._commit()
 
             # Close eventual previous uses which were not closed
             for rec in self.db_session.query(Use).filter(Use.machine_id == machine_id, Use.end_timestamp.is_(None)):
                 duration_s += rec.last_seen - rec.start_timestamp
                 rec.end_timestamp = rec.last_seen
-                self.db_session.commit()
+                counter_repo.addUseTime(machine_id, rec.start_timestamp, rec.last_seen - rec.start_timestamp)
+                self._commit()
 
         machine.machine_hours += duration_s / 3600.0
         machine_repo.update(machine)
 
-        self.db_session.commit()
+        self._commit()
 
         return duration_s
 
@@ -736,7 +1110,7 @@ class UseRepository(BaseRepository):
                     update(Use).where(Use.last_seen < cutoff_timestamp).values(user_id=anon.user_id)
                 )
                 # Commit the transaction
-                self.db_session.commit()
+                self._commit()
                 logging.info(f"Anonymized {num_records_to_anonymize} old Use records.")
 
             return num_records_to_anonymize
@@ -766,7 +1140,7 @@ class UnknownCardsRepository(BaseRepository):
         """
         record = UnknownCard(card_UUID=uuid, machine_id=machine.machine_id, timestamp=time())
         self.create(record)
-        self.db_session.commit()
+        self._commit()
         return record.id
 
     def purge_records(self, cutoff: datetime) -> int:
@@ -789,7 +1163,7 @@ class UnknownCardsRepository(BaseRepository):
             # Perform the deletion
             old_records_query.delete(synchronize_session=False)
             # Commit the transaction
-            self.db_session.commit()
+            self._commit()
             logging.info(f"Deleted {num_deleted} old UnknownCard records.")
             return num_deleted
         except Exception as e:
@@ -831,7 +1205,7 @@ class BoardsRepository(BaseRepository):
             record.heap = heap
             record.last_seen = time()
             self.update(record)
-            self.db_session.commit()
+            self._commit()
             logging.debug(
                 f"Updated board #{record.board_id} for machine {machine.machine_id} (IP: {ip}, FW: {version}, Serial: {serial})"
             )
@@ -847,7 +1221,7 @@ class BoardsRepository(BaseRepository):
             last_seen=time(),
         )
         self.create(record)
-        self.db_session.commit()
+        self._commit()
         logging.info(
             f"Registered new board #{record.board_id} for machine {machine.machine_id} (IP: {ip}, FW: {version})"
         )
@@ -0,0 +1,181 @@
+""" SQLite connection settings, read from the [database.sqlite] section of the settings file. """
+
+import logging
+import os
+import sqlite3
+from dataclasses import dataclass, fields
+from functools import partial
+
+from sqlalchemy import Engine, event
+
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+SYNCHRONOUS = ("OFF", "NORMAL", "FULL", "EXTRA")
+TEMP_STORES = ("DEFAULT", "FILE", "MEMORY")
+
+# Files written next to the database in WAL mode
+WAL_SUFFIXES = ("-wal", "-shm")
+
+
+@dataclass(frozen=True)
+class SqliteProfile:
+    """
+    PRAGMA settings applied to every new SQLite connection.
+
+    The defaults use the write-ahead log: the web pages keep reading while the board messages are
+    written, and commits only sync the log at checkpoints (synchronous NORMAL, safe in WAL mode).
+
+    Attributes:
+        journal_mode (str): DELETE (rollback journal, readers block writers), WAL, ...
+        synchronous (str): OFF, NORMAL, FULL or EXTRA.
+        cache_size (int): Page cache per connection, in pages if positive, in KiB if negative.
+        mmap_size (int): Bytes of the database file read through memory mapping, 0 to disable.
+        temp_store (str): DEFAULT, FILE or MEMORY, where temporary tables and indexes are kept.
+        busy_timeout (int): Milliseconds a connection waits for a lock before failing.
+        optimize_interval_s (float): Interval between runs of PRAGMA optimize, 0 to disable.
+    """
+
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    cache_size: int = -8000
+    mmap_size: int = 0
+    temp_store: str = "MEMORY"
+    busy_timeout: int = 5000
+    optimize_interval_s: float = 3600
+
+    def __post_init__(self):
+        # PRAGMA values cannot be bound as parameters, only known values are accepted
+        for name, allowed in (
+            ("journal_mode", JOURNAL_MODES),
+            ("synchronous", SYNCHRONOUS),
+            ("temp_store", TEMP_STORES),
+        ):
+            value = getattr(self, name)
+            if not isinstance(value, str) or value.upper() not in allowed:
+                raise ValueError(f"Invalid SQLite {name} '{value}', expected one of {', '.join(allowed)}")
+            object.__setattr__(self, name, value.upper())
+        for name in ("cache_size", "mmap_size", "busy_timeout"):
+            value = getattr(self, name)
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise ValueError(f"Invalid SQLite {name} '{value}', expected an integer")
+        if self.mmap_size < 0 or self.busy_timeout < 0 or self.optimize_interval_s < 0:
+            raise ValueError("SQLite mmap_size, busy_timeout and optimize_interval_s cannot be negative")
+
+    @classmethod
+    def fromSettings(cls, settings: dict | None) -> "SqliteProfile":
+        """
+        Builds the profile of the [database.sqlite] settings section.
+
+        Args:
+            settings (dict | None): The section, missing settings take the default values.
+
+        Returns:
+            SqliteProfile: The profile.
+
+        Raises:
+            ValueError: If a setting is unknown or has an invalid value.
+        """
+        settings = settings or {}
+        known = {field.name for field in fields(cls)}
+        unknown = set(settings) - known
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown [database.sqlite] settings: {', '.join(sorted(unknown))}")
+        return cls(**settings)
+
+    def pragmas(self, read_only: bool = False) -> list[str]:
+        """
+        Args:
+            read_only (bool, optional): Statements of the read-only connections, which leave the journal settings
+                to the writing connections and refuse writes. Defaults to False.
+
+        Returns:
+            list[str]: The PRAGMA statements run on every new connection.
+        """
+        common = [
+            f"PRAGMA cache_size={self.cache_size}",
+            f"PRAGMA mmap_size={self.mmap_size}",
+            f"PRAGMA temp_store={self.temp_store}",
+            f"PRAGMA busy_timeout={self.busy_timeout}",
+        ]
+        if read_only:
+            return common + ["PRAGMA query_only=ON"]
+        return [f"PRAGMA journal_mode={self.journal_mode}", f"PRAGMA synchronous={self.synchronous}"] + common
+
+    def apply(self, dbapi_connection, connection_record=None, read_only: bool = False) -> None:
+        """
+        Runs the PRAGMA statements on a new connection, as an engine "connect" event handler.
+
+        Args:
+            dbapi_connection: The new DBAPI connection, left untouched if it is not a SQLite connection.
+            connection_record: The pool record of the connection, unused.
+            read_only (bool, optional): Apply the statements of the read-only connections. Defaults to False.
+        """
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in self.pragmas(read_only):
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+    def attach(self, engine: Engine, read_only: bool = False) -> None:
+        """
+        Applies the profile to the new connections of a SQLite engine. Other engines are left untouched.
+
+        Args:
+            engine (Engine): The engine, before its first connection.
+            read_only (bool, optional): The engine only reads, e.g. opened with mode=ro. Defaults to False.
+        """
+        if engine.dialect.name == "sqlite":
+            event.listen(engine, "connect", partial(self.apply, read_only=read_only))
+
+
+def optimize(engine: Engine) -> None:
+    """
+    Runs PRAGMA optimize, refreshing the statistics of the query planner when they are outdated.
+
+    Args:
+        engine (Engine): A SQLite engine.
+    """
+    with engine.connect() as connection:
+        # Bounds the time spent on large tables, statistics of a sample are enough for the planner
+        connection.exec_driver_sql("PRAGMA analysis_limit=400")
+        connection.exec_driver_sql("PRAGMA optimize")
+    logging.debug("SQLite database optimized")
+
+
+def backup(source: str, destination: str) -> None:
+    """
+    Copies a SQLite database, including the transactions still in its write-ahead log.
+
+    Unlike a file copy, the copy is consistent even if the database is being written.
+
+    Args:
+        source (str): Path of the database.
+        destination (str): Path of the copy, replaced if it exists.
+    """
+    removeDatabaseFiles(destination)
+    with sqlite3.connect(source) as source_connection, sqlite3.connect(destination) as copy_connection:
+        source_connection.backup(copy_connection)
+    # The connections are only closed explicitly, the context managers commit
+    source_connection.close()
+    copy_connection.close()
+
+
+def removeDatabaseFiles(path: str) -> bool:
+    """
+    Deletes a SQLite database with its write-ahead log and shared memory files.
+
+    A log left behind would be applied to a new database created at the same path.
+
+    Args:
+        path (str): Path of the database.
+
+    Returns:
+        bool: True if the database file existed.
+    """
+    existed = os.path.exists(path)
+    for file_path in [path] + [path + suffix for suffix in WAL_SUFFIXES]:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    return existed
@@ -0,0 +1,183 @@
+""" Size, schema upgrade, export and import of the database, for SQLite and PostgreSQL. """
+
+import logging
+import os
+import shutil
+import tempfile
+
+from sqlalchemy import Connection, Engine, MetaData, Integer, create_engine, func, insert, select, text
+from sqlalchemy.pool import NullPool
+
+from FabOMatic.database import sqlite_profile
+from FabOMatic.database.models import Base
+
+MODULE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MIGRATIONS_DIR = os.path.join(MODULE_DIR, "alembic")
+
+# Rows read and written at once when copying a table
+BATCH_SIZE = 1000
+
+# PostgreSQL waits this long for the open transactions of other connections before dropping a table
+DROP_LOCK_TIMEOUT = "10s"
+
+
+def isSqlite(engine: Engine) -> bool:
+    """
+    Args:
+        engine (Engine): The engine.
+
+    Returns:
+        bool: True if the engine connects to a SQLite database.
+    """
+    return engine.dialect.name == "sqlite"
+
+
+def upgradeSchema(url: str) -> None:
+    """
+    Applies the Alembic migrations to a database, creating its tables if it is empty.
+
+    Args:
+        url (str): The URL of the database.
+    """
+    from alembic.config import Config
+    from alembic import command
+
+    alembic_cfg = Config("alembic.ini")
+    alembic_cfg.set_main_option("sqlalchemy.url", url)
+    alembic_cfg.set_main_option("script_location", MIGRATIONS_DIR)
+    alembic_cfg.attributes["configure_logger"] = False
+    command.upgrade(alembic_cfg, "head")
+
+
+def databaseSize(engine: Engine) -> int:
+    """
+    Args:
+        engine (Engine): The engine of the database.
+
+    Returns:
+        int: The size of the database in bytes, as reported by the database, 0 if it is not known.
+    """
+    with engine.connect() as connection:
+        if isSqlite(engine):
+            # Includes the pages still in the write-ahead log, unlike the file size
+            page_count = connection.exec_driver_sql("PRAGMA page_count").scalar()
+            page_size = connection.exec_driver_sql("PRAGMA page_size").scalar()
+            return page_count * page_size
+        if engine.dialect.name == "postgresql":
+            return connection.execute(text("SELECT pg_database_size(current_database())")).scalar()
+    return 0
+
+
+def dropTables(engine: Engine) -> bool:
+    """
+    Drops all the tables of a database, including the Alembic version table.
+
+    Args:
+        engine (Engine): The engine of the database.
+
+    Returns:
+        bool: True if the database had tables.
+    """
+    metadata = MetaData()
+    with engine.begin() as connection:
+        if engine.dialect.name == "postgresql":
+            connection.execute(text(f"SET LOCAL lock_timeout = '{DROP_LOCK_TIMEOUT}'"))
+        metadata.reflect(bind=connection)
+        metadata.drop_all(bind=connection)
+    return len(metadata.tables) > 0
+
+
+def resetSequences(connection: Connection) -> None:
+    """
+    Sets the PostgreSQL sequences of the primary keys after the largest ID of their table, or back to 1
+    if the table is empty. Nothing is done on other databases, SQLite always continues after the largest ID.
+
+    Args:
+        connection (Connection): A connection to the database, in the transaction which changed the rows.
+    """
+    if connection.dialect.name != "postgresql":
+        return
+    for table in Base.metadata.sorted_tables:
+        columns = list(table.primary_key.columns)
+        if len(columns) != 1 or not isinstance(columns[0].type, Integer):
+            continue
+        column = columns[0]
+        last_id = func.max(column)
+        connection.execute(
+            select(
+                func.setval(
+                    func.pg_get_serial_sequence(table.name, column.name),
+                    func.coalesce(last_id, 1),
+                    last_id.is_not(None),
+                )
+            ).select_from(table)
+        )
+
+
+def _copyRows(source: Engine, destination: Engine) -> int:
+    """
+    Replaces the rows of the model tables of a database with the rows of another one, in one transaction.
+    Both databases must have the same schema revision.
+
+    Returns:
+        int: The number of rows copied.
+    """
+    tables = Base.metadata.sorted_tables
+    count = 0
+    with source.connect() as reader, destination.begin() as writer:
+        for table in reversed(tables):
+            writer.execute(table.delete())
+        for table in tables:
+            result = reader.execution_options(yield_per=BATCH_SIZE).execute(select(table))
+            for rows in result.partitions():
+                writer.execute(insert(table), [row._asdict() for row in rows])
+                count += len(rows)
+        # The sequences of the primary keys do not follow the copied values
+        resetSequences(writer)
+    return count
+
+
+def exportDatabase(engine: Engine, destination: str) -> None:
+    """
+    Copies a database into a SQLite file, which can be downloaded and imported again.
+
+    Args:
+        engine (Engine): The engine of the database, at the latest schema revision.
+        destination (str): Path of the SQLite file, replaced if it exists.
+    """
+    if isSqlite(engine):
+        sqlite_profile.backup(engine.url.database, destination)
+        return
+    sqlite_profile.removeDatabaseFiles(destination)
+    url = "sqlite:///" + os.path.abspath(destination)
+    upgradeSchema(url)
+    target = create_engine(url, poolclass=NullPool)
+    try:
+        count = _copyRows(engine, target)
+    finally:
+        target.dispose()
+    logging.info("Exported %d rows of %s to %s", count, engine.url.render_as_string(hide_password=True), destination)
+
+
+def importDatabase(source: str, engine: Engine) -> None:
+    """
+    Replaces the contents of a database with a SQLite file, e.g. made by exportDatabase.
+
+    The file is left untouched: a copy is upgraded to the latest schema revision, then its rows replace the
+    rows of the database in one transaction.
+
+    Args:
+        source (str): Path of the SQLite file.
+        engine (Engine): The engine of the database, at the latest schema revision.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        copy = os.path.join(folder, "import.sqldb")
+        shutil.copyfile(source, copy)
+        url = "sqlite:///" + copy
+        upgradeSchema(url)
+        reader = create_engine(url, poolclass=NullPool)
+        try:
+            count = _copyRows(reader, engine)
+        finally:
+            reader.dispose()
+    logging.info("Imported %d rows from %s to %s", count, source, engine.url.render_as_string(hide_password=True))
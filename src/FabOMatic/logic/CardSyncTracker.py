@@ -0,0 +1,130 @@
+""" This module contains the CardSyncTracker class. """
+
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from time import time
+
+
+@dataclass
+class _MachineCards:
+    """The card list of a machine, with its version and the recent changes."""
+
+    version: int
+    generation: object
+    cards: dict
+    history: deque = field(default_factory=deque)
+
+
+@dataclass(frozen=True)
+class SyncResult:
+    """
+    Outcome of a synchronization request.
+
+    Attributes:
+        version (int): The current version of the machine card list.
+        cards (list | None): The full card list, None when a delta is enough.
+        added (list): The cards added or modified since the board version.
+        removed (list): The UIDs of the cards removed since the board version.
+    """
+
+    version: int
+    cards: list | None
+    added: list = field(default_factory=list)
+    removed: list = field(default_factory=list)
+
+
+class CardSyncTracker:
+    """
+    Keeps the authorized cards list of each machine with a version number, so that boards holding
+    a recent version only receive the changes.
+
+    The list of a machine is computed again only when the authorization data generation changed.
+    Versions start from the current time in milliseconds, so that a version held by a board before
+    a restart of the backend cannot match a version of the new process, and the board gets the full list.
+    """
+
+    HISTORY_SIZE = 32
+
+    def __init__(self, compute: callable, generation: callable, max_cards: int = 200):
+        """
+        Initializes a new instance of the CardSyncTracker class.
+
+        Args:
+            compute (callable): compute(machine_id, session) returns the list of {"uid", "level"} cards of the
+                machine.
+            generation (callable): generation() returns a value that changes when the authorizations change.
+            max_cards (int, optional): Maximum cards held by a board. Larger lists are always sent in full.
+                Defaults to 200.
+        """
+        self._compute = compute
+        self._generation = generation
+        self._max_cards = max_cards
+        self._machines: dict[int, _MachineCards] = {}
+        self._lock = threading.Lock()
+
+    def _current(self, machine_id: int, session) -> _MachineCards:
+        generation = self._generation()
+        with self._lock:
+            entry = self._machines.get(machine_id)
+            if entry is not None and entry.generation == generation:
+                return entry
+
+        # Raises if the list cannot be computed: nothing is stored, the next request computes it again
+        cards = {card["uid"]: card["level"] for card in self._compute(machine_id, session)}
+
+        with self._lock:
+            entry = self._machines.get(machine_id)
+            if entry is None:
+                entry = _MachineCards(int(time() * 1000), generation, cards, deque(maxlen=self.HISTORY_SIZE))
+                self._machines[machine_id] = entry
+                return entry
+
+            added = {uid: level for uid, level in cards.items() if entry.cards.get(uid) != level}
+            removed = [uid for uid in entry.cards if uid not in cards]
+            if added or removed:
+                entry.history.append((entry.version, added, removed))
+                entry.version += 1
+                entry.cards = cards
+            entry.generation = generation
+            return entry
+
+    def sync(self, machine_id: int, board_version: int | None, session=None) -> SyncResult:
+        """
+        Gets what a board must apply to hold the current card list of its machine.
+
+        Args:
+            machine_id (int): The ID of the machine.
+            board_version (int | None): The version held by the board, None if it holds no list.
+            session (Session, optional): Session passed to compute. Defaults to None.
+
+        Returns:
+            SyncResult: The full list if the board version is unknown, else the changes since that version.
+
+        Raises:
+            Exception: The exception of compute, if the card list cannot be computed.
+        """
+        entry = self._current(machine_id, session)
+        with self._lock:
+            version = entry.version
+            if board_version == version:
+                return SyncResult(version, None)
+
+            versions = [from_version for from_version, _, _ in entry.history]
+            if board_version not in versions or len(entry.cards) > self._max_cards:
+                cards = [{"uid": uid, "level": level} for uid, level in entry.cards.items()]
+                return SyncResult(version, cards)
+
+            added = {}
+            removed = set()
+            for _, step_added, step_removed in list(entry.history)[versions.index(board_version) :]:
+                for uid in step_removed:
+                    added.pop(uid, None)
+                    removed.add(uid)
+                for uid, level in step_added.items():
+                    removed.discard(uid)
+                    added[uid] = level
+
+        return SyncResult(
+            version, None, [{"uid": uid, "level": level} for uid, level in added.items()], sorted(removed)
+        )
@@ -0,0 +1,120 @@
+""" This module contains the IdempotencyCache class. """
+
+import threading
+from collections import OrderedDict
+from time import time
+
+from FabOMatic.mqtt.mqtt_types import BaseJson, BatchQuery, EndUseQuery, RegisterMaintenanceQuery, StartUseQuery
+
+
+class IdempotencyCache:
+    """
+    Store of the replies to the replayed board events which must be applied once, per machine.
+
+    Boards send again the buffered events which were not acknowledged, so the same replayed startuse,
+    stopuse, maintenance or batch message may be received several times. Events carry no identifier, but a
+    board sends its buffer in order and repeats an event before sending the next one: a duplicate always
+    follows the event it repeats. The last replayed event applied on each machine is kept with its reply,
+    and a replayed event identical to it, received within the time window, is answered with that reply
+    without reaching the database.
+
+    Live events are never deduplicated, a user may legitimately repeat them, and they end the sequence
+    of replayed events of their machine.
+    """
+
+    def __init__(self, capacity: int = 4096, window_s: float = 60):
+        """
+        Initializes a new instance of the IdempotencyCache class.
+
+        Args:
+            capacity (int, optional): Maximum number of machines whose last reply is kept. Defaults to 4096.
+            window_s (float, optional): Delay within which an event sent again is a duplicate. Defaults to 60.
+        """
+        self._capacity = max(1, capacity)
+        self._window_s = window_s
+        self._replies: OrderedDict[int, tuple] = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _signature(query: BaseJson) -> tuple:
+        if isinstance(query, BatchQuery):
+            return (query.action, tuple(IdempotencyCache._signature(event) for event in query.events))
+        return (query.action, query.uid, getattr(query, "duration", None))
+
+    def keyOf(self, machine_id: int, query: BaseJson, replay: bool) -> tuple | None:
+        """
+        Args:
+            machine_id (int): The machine of the event.
+            query (BaseJson): The startuse, stopuse, maintenance or batch event.
+            replay (bool): If the event has been buffered by the board and sent later on.
+
+        Returns:
+            tuple | None: The key of the event, None if the event is not deduplicated.
+        """
+        if not replay or not isinstance(query, (StartUseQuery, EndUseQuery, RegisterMaintenanceQuery, BatchQuery)):
+            return None
+        return (machine_id, self._signature(query))
+
+    def get(self, key: tuple, now: float = None):
+        """
+        Looks up the reply to an event, if it repeats the last replayed event applied on its machine.
+
+        Args:
+            key (tuple): The key of the event, from keyOf.
+            now (float, optional): Time of reception. Defaults to the current time.
+
+        Returns:
+            The reply to the first event, None if the event is new.
+        """
+        machine_id, signature = key
+        now = time() if now is None else now
+        with self._lock:
+            last = self._replies.get(machine_id)
+            if last is not None and last[0] == signature and now - last[2] < self._window_s:
+                self._replies.move_to_end(machine_id)
+                self._hits += 1
+                return last[1]
+            self._misses += 1
+            return None
+
+    def put(self, key: tuple, reply, now: float = None) -> None:
+        """
+        Stores the reply to an applied event as the last one of its machine, evicting the least recently
+        used machine if full.
+
+        Args:
+            key (tuple): The key of the event, from keyOf.
+            reply: The reply, must not be None.
+            now (float, optional): Time at which the event was applied. Defaults to the current time.
+        """
+        machine_id, signature = key
+        with self._lock:
+            self._replies[machine_id] = (signature, reply, time() if now is None else now)
+            self._replies.move_to_end(machine_id)
+            while len(self._replies) > self._capacity:
+                self._replies.popitem(last=False)
+
+    def forget(self, machine_id: int) -> None:
+        """
+        Ends the sequence of replayed events of a machine, e.g. when a live event is applied.
+
+        Args:
+            machine_id (int): The machine.
+        """
+        with self._lock:
+            self._replies.pop(machine_id, None)
+
+    def clear(self) -> None:
+        """Forgets the stored replies."""
+        with self._lock:
+            self._replies.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: The number of hits (duplicate events) and misses, and the number of replies kept.
+        """
+        with self._lock:
+            return {"hits": self._hits, "misses": self._misses, "size": len(self._replies)}
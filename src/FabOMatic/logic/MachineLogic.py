@@ -4,6 +4,8 @@ import logging
 
 from time import time
 
+from sqlalchemy.orm import Session
+
 from FabOMatic.mqtt import MQTTInterface
 from FabOMatic.mqtt.mqtt_types import (
     AliveQuery,
@@ -15,6 +17,9 @@ from FabOMatic.mqtt.mqtt_types import (
 )
 from FabOMatic.database.DatabaseBackend import DatabaseBackend
 from FabOMatic.database.constants import DEFAULT_GRACE_PERIOD_MINUTES, DEFAULT_TIMEOUT_MINUTES, USER_LEVEL
+from FabOMatic.database.heartbeats import HeartbeatBuffer
+from FabOMatic.database.liveness import machine_liveness
+from FabOMatic.database.repositories import UseRepository
 
 
 class MachineLogic:
@@ -25,6 +30,7 @@ class MachineLogic:
     """
 
     database: DatabaseBackend = None
+    heartbeats: HeartbeatBuffer = None
 
     def __init__(self, machine_id: int):
         """
@@ -55,24 +61,29 @@ class MachineLogic:
         Updates the last seen timestamp of the machine.
         """
         self._last_alive = time()
-        try:
-            with MachineLogic.database.getSession() as session:
-                machine_repo = MachineLogic.database.getMachineRepository(session)
-                machine = machine_repo.get_by_id(self._machine_id)
-                machine.last_seen = time()
-                machine_repo.update(machine)
-        except Exception as e:
-            logging.error("updateMachineLastSeen exception %s", str(e), exc_info=True)
+        # Persisted in bulk by DatabaseBackend.flushMachinesLastSeen
+        machine_liveness.touch(self._machine_id, self._last_alive)
 
-    def machineStatus(self):
+    def machineStatus(self, session: Session = None):
         """
         Gets the status of the machine.
 
+        Args:
+            session (Session, optional): Unit of work of the message being processed. Defaults to None.
+
         Returns:
             MachineResponse: The machine response object containing the status information.
         """
         try:
-            with MachineLogic.database.getSession() as session:
+            # The cache is invalidated by DatabaseBackend when a committed change affects the status
+            cache = MachineLogic.database.getMachineStatusCache()
+            response = cache.get(self._machine_id)
+            if response is not None:
+                self.updateMachineLastSeen()
+                return response
+
+            generation = cache.generation()
+            with MachineLogic.database.unitOfWork(session) as session:
                 machine_repo = MachineLogic.database.getMachineRepository(session)
                 machine = machine_repo.get_by_id(self._machine_id)
                 if machine is None:
@@ -81,7 +92,7 @@ class MachineLogic:
                     )
                 self.updateMachineLastSeen()
                 maintenance = machine_repo.getMachineMaintenanceNeeded(machine.machine_id)
-                return MachineResponse(
+                response = MachineResponse(
                     True,
                     True,
                     maintenance[0],
@@ -92,67 +103,77 @@ class MachineLogic:
                     machine.machine_type.grace_period_min,
                     maintenance[1],
                 )
+            cache.put(self._machine_id, response, generation)
+            return response
         except Exception as e:
             logging.error("machineStatus exception %s", str(e), exc_info=True)
             return MachineResponse(
                 False, False, False, False, "?", 0, DEFAULT_TIMEOUT_MINUTES, DEFAULT_GRACE_PERIOD_MINUTES, ""
             )
 
-    def machineAlive(self, alive: AliveQuery):
+    def machineAlive(self, alive: AliveQuery, session: Session = None):
         """
         Called when a machine sends an alive message.
+
+        Args:
+            alive (AliveQuery): The alive message.
+            session (Session, optional): Unit of work of the message being processed. Defaults to None.
         """
-        with MachineLogic.database.getSession() as session:
+        with MachineLogic.database.unitOfWork(session) as session:
             board_repo = MachineLogic.database.getBoardsRepository(session)
             machine = MachineLogic.database.getMachineRepository(session).get_by_id(self._machine_id)
             board_repo.registerBoard(alive.ip, alive.version, alive.serial, alive.heap, machine)
             self.updateMachineLastSeen()
 
-    def isAuthorized(self, card_uuid: str) -> UserResponse:
+    def isAuthorized(self, card_uuid: str, session: Session = None) -> UserResponse:
         """
         Checks if a user is authorized to use the machine.
 
         Args:
             card_uuid (str): The UUID of the user's card.
+            session (Session, optional): Unit of work of the message being processed. Defaults to None.
 
         Returns:
             UserResponse: The user response object containing the authorization information.
         """
         try:
             self.updateMachineLastSeen()
-            with MachineLogic.database.getSession() as session:
-                machine_repo = MachineLogic.database.getMachineRepository(session)
-                user_repo = MachineLogic.database.getUserRepository(session)
-                user = user_repo.getUserByCardUUID(card_uuid)
-                machine = machine_repo.get_by_id(self._machine_id)
-                if user is None and machine is not None:
+            # Answered from memory, the database is only written for unknown cards
+            index = MachineLogic.database.getAuthorizationIndex()
+            user = index.userByCard(card_uuid)
+            known_machine = index.hasMachine(self._machine_id)
+            if user is None and known_machine:
+                with MachineLogic.database.unitOfWork(session) as session:
+                    machine = MachineLogic.database.getMachineRepository(session).get_by_id(self._machine_id)
                     unknown_repo = MachineLogic.database.getUnknownCardsRepository(session)
                     unknown_repo.registerUnknownCard(card_uuid, machine)
 
-                if machine is None or user is None:
-                    return UserResponse(True, False, "Unknown", USER_LEVEL.INVALID, False)
-                if user_repo.IsUserAuthorizedForMachine(machine, user):
-                    return UserResponse(True, True, user.name, user.user_level(), False)
-                else:
-                    return UserResponse(True, False, "User not authorized", USER_LEVEL.INVALID, True)
+            if not known_machine or user is None:
+                return UserResponse(True, False, "Unknown", USER_LEVEL.INVALID, False)
+            if index.isAuthorized(self._machine_id, user):
+                return UserResponse(True, True, user.name, index.userLevel(user), False)
+            else:
+                return UserResponse(True, False, "User not authorized", USER_LEVEL.INVALID, True)
 
         except Exception as e:
             logging.error("isAuthorized exception %s", str(e), exc_info=True)
             return UserResponse(False, False, "", USER_LEVEL.INVALID, True)
 
-    def startUse(self, card_uuid: str, replay: bool) -> SimpleResponse:
+    def startUse(self, card_uuid: str, replay: bool, session: Session = None) -> SimpleResponse:
         """
         Starts the use of the machine by a user.
 
         Args:
             card_uuid (str): The UUID of the user's card.
+            replay (bool): If this message has been buffered and sent later on
+            session (Session, optional): Unit of work of the message being processed. Defaults to None.
 
         Returns:
             SimpleResponse: The simple response object indicating the success or failure of the operation.
         """
         try:
             self.updateMachineLastSeen()
-            with MachineLogic.database.getSession() as session:
+            with MachineLogic.database.unitOfWork(session) as session:
                 user_repo = MachineLogic.database.getUserRepository(session)
                 user = user_repo.getUserByCardUUID(card_uuid)
                 if user is None:
@@ -166,26 +187,34 @@ class MachineLogic:
             logging.error("startUse exception %s", str(e), exc_info=True)
             return SimpleResponse(False, "BACKEND EXCEPTION")
 
-    def inUse(self, card_uuid: str, duration_s: int) -> SimpleResponse:
+    def inUse(self, card_uuid: str, duration_s: int, session: Session = None) -> SimpleResponse:
         """
         Update current usage of the machine by a user.
 
         Args:
             card_uuid (str): The UUID of the user's card.
             duration_s (int): The duration of the machine use in seconds.
+            session (Session, optional): Unit of work of the message being processed. Defaults to None.
 
         Returns:
             SimpleResponse: The simple response object indicating the success or failure of the operation.
         """
         try:
             self.updateMachineLastSeen()
-            with MachineLogic.database.getSession() as session:
+            with MachineLogic.database.unitOfWork(session) as session:
                 user_repo = MachineLogic.database.getUserRepository(session)
                 user = user_repo.getUserByCardUUID(card_uuid)
                 if user is None:
                     return SimpleResponse(False, "Invalid card")
 
                 use_repo = MachineLogic.database.getUseRepository(session)
+                if MachineLogic.heartbeats is not None and 0 <= duration_s <= UseRepository.MAX_DURATION:
+                    record = use_repo.getOpenUse(self._machine_id)
+                    if record is not None:
+                        # Heartbeat of a known use, written later on by the buffer
+                        MachineLogic.heartbeats.touch(record.use_id, time())
+                        return SimpleResponse(True, "inUse")
+
                 result = use_repo.inUse(self._machine_id, user, duration_s)
 
                 return SimpleResponse(result, "inUse")
@@ -193,20 +222,22 @@ class MachineLogic:
             logging.error("inuse exception %s", str(e), exc_info=True)
             return SimpleResponse(False, "BACKEND EXCEPTION")
 
-    def endUse(self, card_uuid: str, duration_s: int, replay: bool) -> SimpleResponse:
+    def endUse(self, card_uuid: str, duration_s: int, replay: bool, session: Session = None) -> SimpleResponse:
         """
         Ends the use of the machine by a user.
 
         Args:
             card_uuid (str): The UUID of the user's card.
             duration_s (int): The duration of the machine use in seconds.
+            replay (bool): If this message has been buffered and sent later on
+            session (Session, optional): Unit of work of the message being processed. Defaults to None.
 
         Returns:
             SimpleResponse: The simple response object indicating the success or failure of the operation.
         """
         try:
             self.updateMachineLastSeen()
-            with MachineLogic.database.getSession() as session:
+            with MachineLogic.database.unitOfWork(session) as session:
                 user_repo = MachineLogic.database.getUserRepository(session)
                 user = user_repo.getUserByCardUUID(card_uuid)
                 if user is None:
@@ -220,20 +251,21 @@ class MachineLogic:
             logging.error("enduse exception %s", str(e), exc_info=True)
             return SimpleResponse(False, "BACKEND EXCEPTION")
 
-    def registerMaintenance(self, card_uuid: str, replay: bool) -> SimpleResponse:
+    def registerMaintenance(self, card_uuid: str, replay: bool, session: Session = None) -> SimpleResponse:
         """
         Registers a maintenance intervention for the machine.
 
         Args:
             card_uuid (str): The UUID of the user's card.
             replay (bool): If this message has been buffered and sent later on
+            session (Session, optional): Unit of work of the message being processed. Defaults to None.
 
         Returns:
             SimpleResponse: The simple response object indicating the success or failure of the operation.
         """
         try:
             self.updateMachineLastSeen()
-            with MachineLogic.database.getSession() as session:
+            with MachineLogic.database.unitOfWork(session) as session:
                 user_repo = MachineLogic.database.getUserRepository(session)
                 user = user_repo.getUserByCardUUID(card_uuid)
                 if user is None:
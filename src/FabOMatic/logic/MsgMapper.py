@@ -1,8 +1,15 @@
 """ This module provides the MsgMapper class"""
 
 import logging
+from contextlib import nullcontext
 
-from FabOMatic.database.DatabaseBackend import DatabaseBackend
+from sqlalchemy.orm import Session
+
+from FabOMatic.conf import FabConfig
+from FabOMatic.database.DatabaseBackend import DatabaseBackend, ROLLBACK_ONLY
+from FabOMatic.database.constants import USER_LEVEL
+from FabOMatic.database.heartbeats import use_heartbeats
+from FabOMatic.database.liveness import machine_liveness
 from FabOMatic.mqtt import MQTTInterface
 from FabOMatic.mqtt.mqtt_types import (
     UserQuery,
@@ -16,21 +23,52 @@ from FabOMatic.mqtt.mqtt_types import (
     SimpleResponse,
     SyncCacheQuery,
     SyncCacheResponse,
+    SyncCacheDeltaResponse,
+    BatchQuery,
+    BatchResponse,
 )
+from FabOMatic.statistics import runtime_stats
+from FabOMatic.tracing import lap
 
+from .CardSyncTracker import CardSyncTracker
+from .IdempotencyCache import IdempotencyCache
 from .MachineLogic import MachineLogic
 
+# Maximum number of cards held by a board (C++ implementation)
+MAX_CACHE_SIZE = 200
+
+# A machine is counted as active if its board sent a message within this delay (same as Machine.isOnline)
+ACTIVE_MACHINE_S = 90
+
+# Machines whose last replayed event is kept to answer it if sent again, and delay within which it is a duplicate
+DUPLICATE_CACHE_SIZE = 4096
+DUPLICATE_WINDOW_S = 60
+
+# Key of the session info holding the replies to store once the unit of work is committed
+PENDING_REPLIES = "pending_replies"
+
 
 class MsgMapper:
     """This class provides the handlers that incoming parsed MQTT message
     to the machine_logic instance, and returns the response as a string ."""
 
     def __init__(self, mqtt: MQTTInterface, db: DatabaseBackend):
+        write_behind_s = FabConfig.loadSubSettings("database").get("write_behind_s", 30)
+        self._heartbeats = use_heartbeats
+        self._heartbeats.flush_interval_s = write_behind_s
+        machine_liveness.flush_interval_s = write_behind_s
         MachineLogic.database = db
+        MachineLogic.heartbeats = self._heartbeats
         self._mqtt = mqtt
         self._db = db
         self._machines = {}
         self._handlers = {}
+        self._replies = IdempotencyCache(DUPLICATE_CACHE_SIZE, DUPLICATE_WINDOW_S)
+        self._card_sync = CardSyncTracker(
+            lambda machine_id, session: self._getAuthorizedCardsForMachine(machine_id, session),
+            lambda: self._db.getAuthorizationIndex().generation(),
+            MAX_CACHE_SIZE,
+        )
 
     def getMachineLogic(self, mid: int) -> MachineLogic | None:
         """
@@ -53,109 +91,197 @@ class MsgMapper:
                 return None
         return self._machines[mid]
 
-    def handleUserQuery(self, machine_logic: MachineLogic, userquery: UserQuery) -> str:
-        response = machine_logic.isAuthorized(userquery.uid)
-        logging.debug("User query: %s -> response: %s", userquery.toJSON(), response.serialize())
+    def _applyOnce(
+        self, machine_logic: MachineLogic, event: BaseJson, replay: bool, apply: callable, session: Session
+    ) -> SimpleResponse | BatchResponse:
+        """
+        Applies a board event, unless it is a replayed event sent again (see IdempotencyCache).
+
+        Args:
+            machine_logic (MachineLogic): The machine logic object.
+            event (BaseJson): The startuse, stopuse, maintenance or batch event.
+            replay (bool): If the event has been buffered by the board and sent later on.
+            apply (callable): Applies the event and returns the response.
+            session (Session): Unit of work of the message, the reply is stored when it is committed.
+
+        Returns:
+            SimpleResponse | BatchResponse: The response, the one of the first event for a duplicate.
+        """
+        key = self._replies.keyOf(machine_logic.getMachineId(), event, replay)
+        if key is None:
+            self._replies.forget(machine_logic.getMachineId())
+            return apply()
+
+        response = self._replies.get(key)
+        if response is not None:
+            logging.info("[Machine %d] Duplicate event %s, answered with the previous reply", key[0], event)
+            return response
+
+        response = apply()
+        if response.request_ok:
+            if session is None:
+                self._replies.put(key, response)
+            else:
+                session.info.setdefault(PENDING_REPLIES, []).append((key, response))
+        return response
+
+    def _storeReplies(self, session: Session) -> None:
+        """
+        Stores the replies to the events applied in a unit of work, if it was committed.
+
+        Args:
+            session (Session): The unit of work.
+        """
+        pending = session.info.pop(PENDING_REPLIES, [])
+        if not session.info.get(ROLLBACK_ONLY, False):
+            for key, response in pending:
+                self._replies.put(key, response)
+
+    def handleUserQuery(self, machine_logic: MachineLogic, userquery: UserQuery, session: Session = None) -> str:
+        response = machine_logic.isAuthorized(userquery.uid, session)
+        # Messages are passed as logging arguments, they are serialized only if the record is emitted
+        logging.debug("User query: %s -> response: %s", userquery, response)
         return response.serialize()
 
-    def handleStartUseQuery(self, machine_logic: MachineLogic, startUse: StartUseQuery) -> str:
-        response = machine_logic.startUse(startUse.uid, startUse.replay)
+    def handleStartUseQuery(
+        self, machine_logic: MachineLogic, startUse: StartUseQuery, session: Session = None
+    ) -> str:
+        response = self._applyOnce(
+            machine_logic,
+            startUse,
+            startUse.replay,
+            lambda: machine_logic.startUse(startUse.uid, startUse.replay, session),
+            session,
+        )
+        reply = response.serialize()
         logging.info(
             "[Machine %d] Start use query: %s -> response: %s",
             machine_logic.getMachineId(),
-            startUse.toJSON(),
-            response.serialize(),
+            startUse,
+            reply,
         )
-        return response.serialize()
+        return reply
 
-    def handleInUseQuery(self, machine_logic: MachineLogic, inUse: InUseQuery) -> str:
-        response = machine_logic.inUse(inUse.uid, inUse.duration)
+    def handleInUseQuery(self, machine_logic: MachineLogic, inUse: InUseQuery, session: Session = None) -> str:
+        response = machine_logic.inUse(inUse.uid, inUse.duration, session)
+        reply = response.serialize()
         logging.info(
             "[Machine %d] In use query: %s -> response: %s",
             machine_logic.getMachineId(),
-            inUse.toJSON(),
-            response.serialize(),
+            inUse,
+            reply,
         )
-        return response.serialize()
-
-    def handleEndUseQuery(self, machine_logic: MachineLogic, stopUse: EndUseQuery) -> str:
-        response = machine_logic.endUse(stopUse.uid, stopUse.duration, stopUse.replay)
+        return reply
+
+    def handleEndUseQuery(self, machine_logic: MachineLogic, stopUse: EndUseQuery, session: Session = None) -> str:
+        response = self._applyOnce(
+            machine_logic,
+            stopUse,
+            stopUse.replay,
+            lambda: machine_logic.endUse(stopUse.uid, stopUse.duration, stopUse.replay, session),
+            session,
+        )
+        reply = response.serialize()
         logging.info(
             "[Machine %d] End use query: %s -> response: %s",
             machine_logic.getMachineId(),
-            stopUse.toJSON(),
-            response.serialize(),
+            stopUse,
+            reply,
         )
-        return response.serialize()
-
-    def handleMaintenanceQuery(self, machine_logic: MachineLogic, maintenance: RegisterMaintenanceQuery) -> str:
-        response = machine_logic.registerMaintenance(maintenance.uid, maintenance.replay)
+        return reply
+
+    def handleMaintenanceQuery(
+        self, machine_logic: MachineLogic, maintenance: RegisterMaintenanceQuery, session: Session = None
+    ) -> str:
+        response = self._applyOnce(
+            machine_logic,
+            maintenance,
+            maintenance.replay,
+            lambda: machine_logic.registerMaintenance(maintenance.uid, maintenance.replay, session),
+            session,
+        )
+        reply = response.serialize()
         logging.info(
             "[Machine %d] Start use query: %s -> response: %s",
             machine_logic.getMachineId(),
-            maintenance.toJSON(),
-            response.serialize(),
+            maintenance,
+            reply,
         )
-        return response.serialize()
+        return reply
 
-    def handleAliveQuery(self, machine_logic: MachineLogic, alive: AliveQuery) -> str:
+    def handleAliveQuery(self, machine_logic: MachineLogic, alive: AliveQuery, session: Session = None) -> str:
         """
         Handles an alive query message.
 
         Args:
             machine_logic (MachineLogic): The machine logic instance.
             alive (AliveQuery): The alive query message.
+            session (Session, optional): Unit of work of the message. Defaults to None.
 
         Returns:
             str: None
         """
-        machine_logic.machineAlive(alive)
-        logging.debug("Alive query: %s", alive.toJSON())
+        machine_logic.machineAlive(alive, session)
+        logging.debug("Alive query: %s", alive)
         return None
 
-    def handleMachineQuery(self, machine_logic: MachineLogic, machineQuery: MachineQuery) -> str:
+    def handleMachineQuery(
+        self, machine_logic: MachineLogic, machineQuery: MachineQuery, session: Session = None
+    ) -> str:
         """
         Handles a machine query and returns the serialized machine status.
 
         Args:
             machine_logic (MachineLogic): The machine logic object.
             machineQuery (MachineQuery): The machine query object.
+            session (Session, optional): Unit of work of the message. Defaults to None.
 
         Returns:
             str: The serialized machine status.
         """
-        status = machine_logic.machineStatus()
-        logging.debug("Machine query: %s -> response: %s", machineQuery.toJSON(), status.serialize())
+        status = machine_logic.machineStatus(session)
+        logging.debug("Machine query: %s -> response: %s", machineQuery, status)
         return status.serialize()
 
-    def handleSyncCacheQuery(self, machine_logic: MachineLogic, syncQuery: SyncCacheQuery) -> str:
+    def handleSyncCacheQuery(
+        self, machine_logic: MachineLogic, syncQuery: SyncCacheQuery, session: Session = None
+    ) -> str:
         """
         Handles a sync cache query and returns the authorized cards for the machine.
 
         Args:
             machine_logic (MachineLogic): The machine logic object.
             syncQuery (SyncCacheQuery): The sync cache query object.
+            session (Session, optional): Unit of work of the message. Defaults to None.
 
         Returns:
             str: The serialized sync cache response with authorized cards.
         """
         try:
             machine_id = machine_logic.getMachineId()
-            logging.info(f"[Machine {machine_id}] Sync cache query: {syncQuery.toJSON()}")
-            
-            # Get all authorized users for this specific machine
-            authorized_cards = self._getAuthorizedCardsForMachine(machine_id)
+            logging.info("[Machine %d] Sync cache query: %s", machine_id, syncQuery)
             
+            # Authorized cards of this machine, computed again only after authorization changes
+            result = self._card_sync.sync(machine_id, syncQuery.version, session)
+
+            if result.cards is None:
+                response = SyncCacheDeltaResponse(True, result.version, result.added, result.removed)
+                logging.info(
+                    f"[Machine {machine_id}] Sync cache response: version {result.version}, "
+                    f"{len(result.added)} added, {len(result.removed)} removed"
+                )
+                return response.serialize()
+
+            authorized_cards = result.cards
             # Limit to maximum cache size (200 cards as per C++ implementation)
-            max_cache_size = 200
-            if len(authorized_cards) > max_cache_size:
-                authorized_cards = authorized_cards[:max_cache_size]
-                logging.warning(f"[Machine {machine_id}] Truncated sync cache to {max_cache_size} cards")
+            if len(authorized_cards) > MAX_CACHE_SIZE:
+                authorized_cards = authorized_cards[:MAX_CACHE_SIZE]
+                logging.warning(f"[Machine {machine_id}] Truncated sync cache to {MAX_CACHE_SIZE} cards")
             
-            response = SyncCacheResponse(True, authorized_cards)
+            response = SyncCacheResponse(True, authorized_cards, result.version)
             logging.info(f"[Machine {machine_id}] Sync cache response: {len(authorized_cards)} cards")
-            logging.debug(f"[Machine {machine_id}] Sync cache response: {response.serialize()}")
-            
+            logging.debug("[Machine %d] Sync cache response: %s", machine_id, response)
+
             return response.serialize()
             
         except Exception as e:
@@ -163,12 +289,58 @@ class MsgMapper:
             error_response = SyncCacheResponse(False, [])
             return error_response.serialize()
 
+    def handleBatchQuery(self, machine_logic: MachineLogic, batch: BatchQuery, session: Session = None) -> str:
+        """
+        Handles the events buffered by a board while offline, applied in order as replays.
+
+        All the events are applied in the transaction of the message: if one of them fails with an
+        exception, none is recorded and the board is expected to send the batch again. A batch sent again
+        after a lost reply is not applied twice.
+
+        Args:
+            machine_logic (MachineLogic): The machine logic object.
+            batch (BatchQuery): The batch of startuse, stopuse and maintenance events.
+            session (Session, optional): Unit of work of the message. Defaults to None.
+
+        Returns:
+            str: The serialized batch response, with one result per event.
+        """
+
+        def apply(event: BaseJson) -> SimpleResponse:
+            if isinstance(event, StartUseQuery):
+                return machine_logic.startUse(event.uid, True, session)
+            if isinstance(event, EndUseQuery):
+                return machine_logic.endUse(event.uid, event.duration, True, session)
+            return machine_logic.registerMaintenance(event.uid, True, session)
+
+        def applyAll() -> BatchResponse:
+            results = [apply(event).request_ok for event in batch.events]
+            if session.info.get(ROLLBACK_ONLY, False):
+                return BatchResponse(False, [False] * len(batch.events))
+            return BatchResponse(True, results)
+
+        owner = session is None
+        with self._db.unitOfWork(session) as session:
+            # A batch is sent again as a whole, its events may legitimately repeat each other
+            response = self._applyOnce(machine_logic, batch, True, applyAll, session)
+        if owner:
+            self._storeReplies(session)
+
+        reply = response.serialize()
+        logging.info(
+            "[Machine %d] Batch of %d events -> response: %s",
+            machine_logic.getMachineId(),
+            len(batch.events),
+            reply,
+        )
+        return reply
+
     def messageReceived(self, machine: int, query: BaseJson) -> bool:
         """This function is called when a message is received from the MQTT broker.
         It calls the appropriate handler for the message type."""
 
         if type(query) not in self._handlers:
-            logging.warning(f"No handler for query {query} on machine {machine}")
+            logging.warning("No handler for query %s on machine %s", query, machine)
             return False
 
         machine_logic = self.getMachineLogic(machine)
@@ -179,14 +351,22 @@ class MsgMapper:
                 logging.error(f"Failed to publish response for machine {machine} to MQTT broker: {response}")
             return False
 
-        response = self._handlers[type(query)](machine_logic, query)
+        # One transaction per message, committed before the reply is published
+        with self._db.unitOfWork() as session:
+            response = self._handlers[type(query)](machine_logic, query, session)
+            lap("handler")
+        lap("commit")
+        self._storeReplies(session)
 
         if response is not None:
-            if not self._mqtt.publishReply(machine, response):
+            published = self._mqtt.publishReply(machine, response)
+            lap("publish")
+            if not published:
+                runtime_stats.recordError("publish")
                 logging.error(f"Failed to publish response for machine {machine} to MQTT broker: {response}")
                 return False
         else:
-            logging.warning(f"Machine {machine} query: {query.toJSON()} -> no response")
+            logging.warning("Machine %s query: %s -> no response", machine, query)
             return False
 
         return True
@@ -201,11 +381,51 @@ class MsgMapper:
         self._setHandler(EndUseQuery, self.handleEndUseQuery)
         self._setHandler(RegisterMaintenanceQuery, self.handleMaintenanceQuery)
         self._setHandler(SyncCacheQuery, self.handleSyncCacheQuery)
+        self._setHandler(BatchQuery, self.handleBatchQuery)
         self._mqtt.setMessageCallback(self.messageReceived)
 
     def _setHandler(self, query: type, handler: callable):
         self._handlers[query] = handler
 
+    def stats(self) -> dict:
+        """
+        Gets the statistics of the message processing.
+
+        Returns:
+            dict: A dictionary containing the statistics.
+        """
+        status_cache = self._db.getMachineStatusCache().stats()
+        replies = self._replies.stats()
+        return {
+            "Status cache hits": status_cache["hits"],
+            "Status cache misses": status_cache["misses"],
+            "Status cache hit rate (%)": status_cache["hit_rate"],
+            "Duplicate events": replies["hits"],
+            "Replies kept": replies["size"],
+            "Active machines": machine_liveness.activeCount(ACTIVE_MACHINE_S),
+            "DB pool": self._db.poolStats(),
+            "DB read pool": self._db.poolStats(read_only=True),
+        }
+
+    def flushHeartbeats(self, force: bool = False) -> int:
+        """
+        Writes the buffered inuse heartbeats to the database, if the flush interval has elapsed.
+
+        Args:
+            force (bool, optional): Flush regardless of the interval. Defaults to False.
+
+        Returns:
+            int: The number of uses updated.
+        """
+        return self._heartbeats.flush(self._db, force)
+
+    def pendingHeartbeats(self) -> dict[int, float]:
+        """
+        Returns:
+            dict[int, float]: The heartbeats not yet written to the database, keyed by use ID.
+        """
+        return self._heartbeats.pending()
+
     def remoteStart(self, machine_id: int, card_uuid: str) -> bool:
         machine_logic = self.getMachineLogic(machine_id)
 
@@ -224,56 +444,32 @@ class MsgMapper:
 
         return machine_logic.remoteStop(card_uuid, self._mqtt)
 
-    def _getAuthorizedCardsForMachine(self, machine_id: int) -> list:
+    def _getAuthorizedCardsForMachine(self, machine_id: int, session: Session = None) -> list:
         """
         Get all authorized cards for a specific machine.
         
         Args:
             machine_id (int): The machine ID
+            session (Session, optional): Unit of work of the message. Defaults to None.
             
         Returns:
             list: List of dictionaries with uid and level for each authorized card
+
+        Raises:
+            Exception: If the cards cannot be read. An empty list would be cached as the list of the machine,
+                and the boards would remove all their cards.
         """
         authorized_cards = []
-        
-        try:
-            with self._db.getSession() as session:
-                machine_repo = self._db.getMachineRepository(session)
-                user_repo = self._db.getUserRepository(session)
-                
-                # Get the machine
-                machine = machine_repo.get_by_id(machine_id)
-                if machine is None:
-                    logging.warning(f"Machine {machine_id} not found for sync cache")
-                    return []
-                
-                # Get all active users
-                all_users = user_repo.get_all()
-                
-                for user in all_users:
-                    # Skip disabled, deleted users or users without cards
-                    if user.disabled or user.deleted or not user.card_UUID:
-                        continue
-                    
-                    # Check if user is authorized for this machine
-                    if user_repo.IsUserAuthorizedForMachine(machine, user):
-                        user_level = user.user_level()
-                        
-                        # Convert user level to integer (1=normal, 2=admin)
-                        level_value = 1  # Default to normal user
-                        if user_level.name == "ADMIN":
-                            level_value = 2
-                        elif user_level.name == "INVALID":
-                            continue  # Skip invalid users
-                        
-                        authorized_cards.append({
-                            "uid": user.card_UUID,
-                            "level": level_value
-                        })
-                
-                logging.info(f"Found {len(authorized_cards)} authorized cards for machine {machine_id}")
-                
-        except Exception as e:
-            logging.error(f"Error getting authorized cards for machine {machine_id}: {str(e)}", exc_info=True)
-            
+
+        # Read-only: reuse the session of the message when there is one
+        with nullcontext(session) if session is not None else self._db.getSession() as session:
+            user_repo = self._db.getUserRepository(session)
+
+            # Users with an INVALID level are disabled, so they are already excluded by the query
+            for card_uuid, authorize_all in user_repo.getAuthorizedCards(machine_id):
+                level = USER_LEVEL.ADMIN if authorize_all else USER_LEVEL.NORMAL
+                authorized_cards.append({"uid": card_uuid, "level": level.value})
+
+            logging.info(f"Found {len(authorized_cards)} authorized cards for machine {machine_id}")
+
         return authorized_cards
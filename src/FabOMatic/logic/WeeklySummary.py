@@ -11,7 +11,7 @@ from flask_mail import Mail, Message
 from flask_babel import force_locale
 
 from FabOMatic.database.models import User, Machine, Use, UnknownCard
-from FabOMatic.database.repositories import UserRepository, MachineRepository
+from FabOMatic.database.repositories import UserRepository, MachineRepository, MaintenanceCounterRepository
 from FabOMatic.conf import FabConfig
 
 
@@ -105,27 +105,21 @@ class WeeklySummaryRepository:
             List of dictionaries with pending maintenance information
         """
         result = []
-        machine_repo = MachineRepository(self.db_session)
-        machines = machine_repo.get_all()
-
-        for machine in machines:
-            for maintenance in machine.maintenances:
-                relative_time = machine_repo.getRelativeUseTimeByMaintenance(machine.machine_id, maintenance)
-                required_time = maintenance.hours_between * 3600.0
-
-                if relative_time > required_time:
-                    # Calculate how overdue it is
-                    overdue_hours = (relative_time - required_time) / 3600.0
-
-                    result.append(
-                        {
-                            "machine_id": machine.machine_id,
-                            "machine_name": machine.machine_name,
-                            "maintenance_description": maintenance.description,
-                            "overdue_hours": overdue_hours,
-                            "instructions_url": maintenance.instructions_url or "",
-                        }
-                    )
+        machines = {machine.machine_id: machine for machine in MachineRepository(self.db_session).get_all()}
+
+        for status in MaintenanceCounterRepository(self.db_session).getMaintenanceStatus():
+            maintenance = status.maintenance
+            if status.expired:
+                machine = machines[maintenance.machine_id]
+                result.append(
+                    {
+                        "machine_id": machine.machine_id,
+                        "machine_name": machine.machine_name,
+                        "maintenance_description": maintenance.description,
+                        "overdue_hours": status.overdue_h,
+                        "instructions_url": maintenance.instructions_url or "",
+                    }
+                )
 
         # Sort by most overdue first
         result.sort(key=lambda x: x["overdue_hours"], reverse=True)
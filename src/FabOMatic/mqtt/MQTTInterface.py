@@ -2,10 +2,15 @@
 
 import logging
 import json
+import socket
 from time import sleep
 import paho.mqtt.client as mqtt
 from .mqtt_types import BaseJson, Parser
+from .MessageDispatcher import MessageDispatcher
+from .transport import PahoTransport, Transport
 from FabOMatic.conf import FabConfig
+from FabOMatic.statistics import runtime_stats
+from FabOMatic.tracing import Trace, request_tracer
 
 
 class MQTTInterface:
@@ -25,15 +30,21 @@ class MQTTInterface:
         _handlers (dict): A dictionary of message handlers.
         _msg_send_count (int): The count of sent messages.
         _msg_recv_count (int): The count of received messages.
+        _dispatcher (MessageDispatcher): The worker pool processing the received messages.
+        _transport_factory (callable): Builds the transport of the client, a paho-mqtt client by default.
+        _hostname (str): The name of the backend host, resolved once.
+        _ip_address (str): The IP address of the backend host, resolved once.
     """
 
-    def __init__(self):
+    def __init__(self, transport_factory: callable = None):
         """
         Initializes an instance of the MQTTInterface class.
 
         Args:
-            path (str, optional): The path to the MQTT settings file. Defaults to CONFIG_FILE.
+            transport_factory (callable, optional): transport_factory(client_id) returns the Transport used to
+                connect, e.g. a LoopbackTransport for tests and benchmarks. Defaults to a paho-mqtt client.
         """
+        self._transport_factory = transport_factory if transport_factory is not None else PahoTransport
         self._settings = FabConfig.loadSubSettings("MQTT")
         self._loadSettings()
 
@@ -42,6 +53,23 @@ class MQTTInterface:
         self._handlers = {}
         self._msg_send_count = 0
         self._msg_recv_count = 0
+        self._dispatcher = MessageDispatcher(self._dispatchMessage, self._workers, self._queue_size)
+        self._hostname, self._ip_address = self._resolveHost()
+
+    @staticmethod
+    def _resolveHost() -> tuple[str, str]:
+        """
+        Resolves the name and IP address of the backend host.
+
+        Returns:
+            tuple[str, str]: The host name and its IP address, "unknown" if it cannot be resolved.
+        """
+        hostname = socket.gethostname()
+        try:
+            return hostname, socket.gethostbyname(hostname)
+        except OSError as e:
+            logging.warning("Cannot resolve IP address of %s: %s", hostname, e)
+            return hostname, "unknown"
 
     def _loadSettings(self) -> None:
         """
@@ -59,6 +87,9 @@ class MQTTInterface:
             self._request_subtopic = "/request"
 
         self._statsTopic = self._settings["stats_topic"] + "/" + self._client_id
+        self._workers = self._settings.get("workers", 4)
+        self._queue_size = self._settings.get("queue_size", 1000)
+        request_tracer.slow_threshold_s = self._settings.get("slow_request_ms", 500) / 1000
         logging.info("Loaded MQTT settings")
 
     def _extractMachineFromTopic(self, topic: str) -> str:
@@ -86,8 +117,10 @@ class MQTTInterface:
         Args:
             *args: Variable length argument list.
         """
+        trace = Trace(None)
         topic: str = args[2].topic
-        message: str = args[2].payload.decode("utf-8")
+        # Parser decodes the UTF-8 payload itself
+        message: bytes = args[2].payload
         self._msg_recv_count += 1
 
         if topic.endswith(self._reply_subtopic) or topic.endswith(self._request_subtopic):
@@ -107,11 +140,26 @@ class MQTTInterface:
         try:
             query: BaseJson = Parser.parse(message)
             if query is not None and machine.isdigit():
-                self._messageCallback(int(machine), query)
+                trace.machine = machine
+                trace.action = query.action
+                trace.lap("parse")
+                self._dispatcher.submit(int(machine), query, trace)
         except ValueError:
+            runtime_stats.recordError("invalid message")
             logging.warning("Invalid message received: %s on machine %s", message, machine)
             return
 
+    def _dispatchMessage(self, machine: int, query: BaseJson):
+        """
+        Called by the dispatcher workers to process a received message.
+
+        Args:
+            machine (int): The ID of the machine.
+            query (BaseJson): The parsed message.
+        """
+        if self._messageCallback is not None:
+            self._messageCallback(machine, query)
+
     def publishQuery(self, machine: str, message: str) -> bool:
         """
         Publishes a query message to a specific machine.
@@ -199,9 +247,7 @@ class MQTTInterface:
         """
         Connects to the MQTT broker.
         """
-        self._client = mqtt.Client(
-            callback_api_version=mqtt.CallbackAPIVersion.VERSION1, client_id=self._client_id, clean_session=False
-        )
+        self._client: Transport = self._transport_factory(self._client_id)
 
         self._client.on_message = self._onMessage
         self._client.on_disconnect = self._onDisconnect
@@ -219,8 +265,13 @@ class MQTTInterface:
         else:
             logging.debug("Subscribed to topic [%s]", topic)
 
+        self._dispatcher.start()
         self._client.loop_start()
-        sleep(0.5)
+        # Give the network thread some time to complete the connection
+        for _ in range(10):
+            if self._connected:
+                break
+            sleep(0.05)
 
     def setMessageCallback(self, callback: callable):
         """
@@ -238,6 +289,7 @@ class MQTTInterface:
         self._client.unsubscribe(self._topic)
         self._client.loop_stop()
         self._client.disconnect()
+        self._dispatcher.stop()
 
     @property
     def connected(self):
@@ -256,20 +308,27 @@ class MQTTInterface:
         Returns:
             dict: A dictionary containing the statistics.
         """
-        import socket
-
-        hostname = socket.gethostname()
-        ipaddress = socket.gethostbyname(hostname)
         return {
             "Connected": self.connected,
-            "Backend host": hostname,
-            "Backend IP": ipaddress,
+            "Backend host": self._hostname,
+            "Backend IP": self._ip_address,
             "Received": self._msg_recv_count,
             "Sent": self._msg_send_count,
+            **self._dispatcher.stats(),
+            "Latency (ms)": request_tracer.stats(),
+            "Slow requests": request_tracer.slowCount(),
+            **runtime_stats.stats(),
         }
 
-    def publishStats(self):
+    def publishStats(self, extra: dict = None):
         """
         Publishes the statistics to the MQTT broker.
+
+        Args:
+            extra (dict, optional): Statistics of other components, published along. Defaults to None.
         """
-        self._publish(self._statsTopic, json.dumps(self.stats()))
+        runtime_stats.sampleQueueDepth(self._dispatcher.queueDepth())
+        stats = self.stats()
+        if extra is not None:
+            stats.update(extra)
+        self._publish(self._statsTopic, json.dumps(stats, separators=(",", ":")))
@@ -0,0 +1,325 @@
+""" A module for the MessageDispatcher class. """
+
+import logging
+import threading
+from collections import OrderedDict, deque
+from time import perf_counter
+
+from FabOMatic.statistics import runtime_stats
+from FabOMatic.tracing import Trace, activate, lap, request_tracer
+from .mqtt_types import BaseJson
+
+# Priority lanes, highest priority first
+LANE_USER = "user"
+LANE_NORMAL = "normal"
+LANE_HEARTBEAT = "heartbeat"
+LANES = (LANE_USER, LANE_NORMAL, LANE_HEARTBEAT)
+
+# Actions with a person waiting at the board, and heartbeats which can be merged. Others are normal.
+ACTION_LANES = {
+    "checkuser": LANE_USER,
+    "startuse": LANE_USER,
+    "stopuse": LANE_USER,
+    "maintenance": LANE_USER,
+    "alive": LANE_HEARTBEAT,
+    "inuse": LANE_HEARTBEAT,
+}
+
+
+def laneOf(query: BaseJson) -> str:
+    """
+    Args:
+        query (BaseJson): A parsed board message.
+
+    Returns:
+        str: The priority lane of the message.
+    """
+    return ACTION_LANES.get(getattr(query, "action", None), LANE_NORMAL)
+
+
+class _LaneQueue:
+    """
+    Bounded queue of a worker, with one FIFO per priority lane.
+
+    A heartbeat replaces the pending heartbeat of the same machine and action. When the queue is full,
+    the oldest heartbeat is dropped to make room for a more urgent message.
+    """
+
+    def __init__(self, capacity: int):
+        self._capacity = max(1, capacity)
+        self._condition = threading.Condition()
+        self._sequence = 0
+        self._fifos = {LANE_USER: deque(), LANE_NORMAL: deque()}
+        # (machine, action) -> (sequence, machine, query, trace), oldest first
+        self._heartbeats = OrderedDict()
+        self._closed = False
+        self.dropped = dict.fromkeys(LANES, 0)
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._fifos[LANE_USER]) + len(self._fifos[LANE_NORMAL]) + len(self._heartbeats)
+
+    def depths(self) -> dict:
+        """
+        Returns:
+            dict: The number of pending messages in each lane.
+        """
+        return {
+            LANE_USER: len(self._fifos[LANE_USER]),
+            LANE_NORMAL: len(self._fifos[LANE_NORMAL]),
+            LANE_HEARTBEAT: len(self._heartbeats),
+        }
+
+    def put(self, machine: int, query: BaseJson, trace: Trace | None) -> bool:
+        """
+        Queues a message without blocking.
+
+        Args:
+            machine (int): The ID of the machine which sent the message.
+            query (BaseJson): The parsed message.
+            trace (Trace | None): The latency trace of the message.
+
+        Returns:
+            bool: True if the message was queued or merged, False if it was dropped.
+        """
+        lane = laneOf(query)
+        with self._condition:
+            self._sequence += 1
+            item = (self._sequence, machine, query, trace)
+            if lane == LANE_HEARTBEAT:
+                key = (machine, query.action)
+                if key in self._heartbeats:
+                    # The previous heartbeat is redundant, the new one is queued after the messages received meanwhile
+                    del self._heartbeats[key]
+                    self._heartbeats[key] = item
+                    self.coalesced += 1
+                    return True
+
+            if len(self) >= self._capacity:
+                if lane == LANE_HEARTBEAT or len(self._heartbeats) == 0:
+                    self.dropped[lane] += 1
+                    return False
+                self._heartbeats.popitem(last=False)
+                self.dropped[LANE_HEARTBEAT] += 1
+
+            if lane == LANE_HEARTBEAT:
+                self._heartbeats[key] = item
+            else:
+                self._fifos[lane].append(item)
+            self._condition.notify()
+            return True
+
+    def get(self) -> list | None:
+        """
+        Waits for the most urgent message. The older messages of the same machine are returned
+        before it, so that the messages of a machine are always processed in order.
+
+        Returns:
+            list | None: The (machine, query, trace) to process in order, None once the queue is closed and empty.
+        """
+        with self._condition:
+            while len(self) == 0 and not self._closed:
+                self._condition.wait()
+            if len(self) == 0:
+                return None
+
+            if len(self._fifos[LANE_USER]) > 0:
+                head = self._fifos[LANE_USER].popleft()
+            elif len(self._fifos[LANE_NORMAL]) > 0:
+                head = self._fifos[LANE_NORMAL].popleft()
+            else:
+                _, head = self._heartbeats.popitem(last=False)
+
+            sequence, machine = head[0], head[1]
+            earlier = []
+            for lane, fifo in self._fifos.items():
+                if any(m == machine and s < sequence for s, m, _, _ in fifo):
+                    earlier.extend(item for item in fifo if item[1] == machine and item[0] < sequence)
+                    self._fifos[lane] = deque(item for item in fifo if item[1] != machine or item[0] > sequence)
+            for key in [key for key, (s, m, _, _) in self._heartbeats.items() if m == machine and s < sequence]:
+                earlier.append(self._heartbeats.pop(key))
+
+            earlier.sort(key=lambda item: item[0])
+            return [(m, query, trace) for _, m, query, trace in earlier + [head]]
+
+    def close(self) -> None:
+        """Wakes up the worker, which stops once the queue is empty."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class MessageDispatcher:
+    """
+    Dispatches parsed board messages from the MQTT network thread to a pool of workers.
+
+    Each worker owns a bounded queue. Messages are sharded by machine id, so all the messages
+    of one board are handled in order by the same worker, while different boards run in parallel.
+
+    Within a worker queue, messages are classified in priority lanes (see ACTION_LANES): user-facing
+    actions are served first, redundant heartbeats of a machine are merged, and heartbeats are dropped
+    first when the queue is full.
+
+    Attributes:
+        _callback (callable): Called with (machine, query) for every dispatched message.
+        _nb_workers (int): Number of worker threads.
+        _queue_size (int): Maximum number of pending messages per worker.
+        _queues (list): One bounded queue per worker.
+        _threads (list): The worker threads.
+        _busy_time (list): Cumulated time spent in the callback by each worker, in seconds.
+        _dropped (int): Number of messages dropped because the workers were not running.
+    """
+
+    def __init__(self, callback: callable, nb_workers: int = 4, queue_size: int = 1000):
+        """
+        Initializes an instance of the MessageDispatcher class.
+
+        Args:
+            callback (callable): The function processing a message, called as callback(machine, query).
+            nb_workers (int, optional): Number of worker threads. Defaults to 4.
+            queue_size (int, optional): Maximum pending messages per worker. Defaults to 1000.
+        """
+        self._callback = callback
+        self._nb_workers = max(1, nb_workers)
+        self._queue_size = queue_size
+        self._queues = []
+        self._threads = []
+        self._busy_time = [0.0] * self._nb_workers
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """
+        Starts the worker threads. Does nothing if the workers are already running.
+        """
+        with self._lock:
+            if self.running:
+                return
+            self._queues = [_LaneQueue(self._queue_size) for _ in range(self._nb_workers)]
+            self._threads = [
+                threading.Thread(target=self._run, args=(i,), name=f"mqtt-worker-{i}", daemon=True)
+                for i in range(self._nb_workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+        logging.info("Started %d MQTT message workers", self._nb_workers)
+
+    def stop(self) -> None:
+        """
+        Stops the worker threads after the messages already queued have been processed.
+        """
+        with self._lock:
+            if not self.running:
+                return
+            for q in self._queues:
+                q.close()
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+        logging.info("Stopped MQTT message workers")
+
+    @property
+    def running(self) -> bool:
+        """
+        Returns:
+            bool: True if the worker threads are running.
+        """
+        return any(thread.is_alive() for thread in self._threads)
+
+    def submit(self, machine: int, query: BaseJson, trace: Trace = None) -> bool:
+        """
+        Queues a message for processing by the worker in charge of the machine.
+
+        This method never blocks, as it is called from the MQTT network thread.
+
+        Args:
+            machine (int): The ID of the machine which sent the message.
+            query (BaseJson): The parsed message.
+            trace (Trace, optional): The latency trace started on arrival of the message. Defaults to None.
+
+        Returns:
+            bool: True if the message was queued, False if it was dropped.
+        """
+        if not self.running:
+            logging.error("Message workers not started, message from machine %s dropped", machine)
+            self._dropped += 1
+            return False
+
+        if self._queues[machine % self._nb_workers].put(machine, query, trace):
+            return True
+        logging.warning("Message queue full, %s message from machine %s dropped", laneOf(query), machine)
+        return False
+
+    def _run(self, index: int) -> None:
+        """
+        Worker thread main loop.
+
+        Args:
+            index (int): Index of the worker, and of its queue.
+        """
+        work_queue = self._queues[index]
+        while True:
+            items = work_queue.get()
+            if items is None:
+                break
+            for machine, query, trace in items:
+                start = perf_counter()
+                with activate(trace):
+                    lap("queue")
+                    try:
+                        self._callback(machine, query)
+                    except Exception as e:
+                        runtime_stats.recordError("handler")
+                        logging.error("Error processing message from machine %s: %s", machine, e, exc_info=True)
+                    finally:
+                        self._busy_time[index] += perf_counter() - start
+                if trace is not None:
+                    request_tracer.record(trace)
+                    runtime_stats.recordRequest(trace)
+
+    def queueDepth(self) -> int:
+        """
+        Returns:
+            int: The number of messages waiting to be processed, all workers included.
+        """
+        return sum(len(q) for q in self._queues)
+
+    def laneDepths(self) -> dict:
+        """
+        Returns:
+            dict: The number of messages waiting in each priority lane, all workers included.
+        """
+        depths = dict.fromkeys(LANES, 0)
+        for q in self._queues:
+            for lane, depth in q.depths().items():
+                depths[lane] += depth
+        return depths
+
+    def droppedByLane(self) -> dict:
+        """
+        Returns:
+            dict: The number of messages dropped from each priority lane because a queue was full.
+        """
+        dropped = dict.fromkeys(LANES, 0)
+        for q in self._queues:
+            for lane, count in q.dropped.items():
+                dropped[lane] += count
+        return dropped
+
+    def stats(self) -> dict:
+        """
+        Gets the statistics of the dispatcher.
+
+        Returns:
+            dict: A dictionary containing the statistics.
+        """
+        dropped = self.droppedByLane()
+        return {
+            "Workers": self._nb_workers,
+            "Queue depth": self.queueDepth(),
+            "Lane depth": self.laneDepths(),
+            "Workers busy time (s)": [round(busy, 3) for busy in self._busy_time],
+            "Dropped": self._dropped + sum(dropped.values()),
+            "Dropped by lane": dropped,
+            "Heartbeats merged": sum(q.coalesced for q in self._queues),
+        }
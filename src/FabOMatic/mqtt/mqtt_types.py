@@ -1,79 +1,237 @@
 import json
+from json.encoder import encode_basestring_ascii
 
 from FabOMatic.database.constants import USER_LEVEL
 
 
 class Parser:
+    """Decodes board messages into typed query objects, using a registry keyed on the 'action' field."""
+
+    _query_types: dict = {}
+
+    @staticmethod
+    def register(action: str):
+        """
+        Class decorator registering a query class for the given action.
+
+        The class must provide a from_dict static method building the query from the decoded message.
+
+        Args:
+            action (str): The value of the 'action' field handled by the class.
+        """
+
+        def decorator(cls):
+            Parser._query_types[action] = cls
+            return cls
+
+        return decorator
+
     @staticmethod
-    def parse(json_data: str):
+    def parse(json_data: str | bytes):
         """
         Parses the given JSON data and returns the corresponding query object based on the 'action' field.
 
+        The payload is decoded only once. Raw bytes received from the broker are accepted as well.
+
         Args:
-            json_data (str): The JSON data to parse.
+            json_data (str | bytes): The JSON data to parse.
 
         Returns:
             object: The deserialized query object based on the 'action' field.
 
         Raises:
-            ValueError: If the 'action' field is missing or invalid.
+            ValueError: If the message is not valid JSON, if the 'action' field is missing or invalid,
+            or if a field required by the action is missing.
         """
-        data = json.loads(json_data)
-        if "action" in data:
-            match data["action"]:
-                case "checkuser":
-                    return UserQuery.deserialize(json_data)
-                case "checkmachine":
-                    return MachineQuery.deserialize(json_data)
-                case "startuse":
-                    return StartUseQuery.deserialize(json_data)
-                case "inuse":
-                    return InUseQuery.deserialize(json_data)
-                case "stopuse":
-                    return EndUseQuery.deserialize(json_data)
-                case "maintenance":
-                    return RegisterMaintenanceQuery.deserialize(json_data)
-                case "alive":
-                    return AliveQuery.deserialize(json_data)
-                case "synccache":
-                    return SyncCacheQuery.deserialize(json_data)
-                case _:
-                    raise ValueError("Invalid action")
-        else:
+        if isinstance(json_data, bytes):
+            # Faster than letting json.loads detect the encoding of the payload
+            json_data = json_data.decode("utf-8")
+        return Parser.from_dict(json.loads(json_data))
+
+    @staticmethod
+    def from_dict(data: dict):
+        """
+        Builds the query object of an already decoded message, based on its 'action' field.
+
+        Args:
+            data (dict): The decoded message.
+
+        Returns:
+            object: The query object based on the 'action' field.
+
+        Raises:
+            ValueError: If the 'action' field is missing or invalid, or if a field required by the action is missing.
+        """
+        if not isinstance(data, dict) or "action" not in data:
             raise ValueError("Missing action field")
 
+        # Checked first: a list or dict action cannot be looked up
+        action = data["action"]
+        query_type = Parser._query_types.get(action) if isinstance(action, str) else None
+        if query_type is None:
+            raise ValueError("Invalid action")
 
-class BaseJson:
-    def toJSON(self):
-        return json.dumps(self, default=lambda o: (o.__dict__), sort_keys=True, separators=(",", ":"))
+        try:
+            return query_type.from_dict(data)
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Invalid {data['action']} message") from e
+
+
+def _asDict(o):
+    if isinstance(o, (BaseJson, BaseResponse)):
+        return o.asDict()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+# Encoders of the values which are not scalars, built once instead of at each json.dumps call with options
+_DEFAULT_ENCODER = json.JSONEncoder(default=_asDict)
+_COMPACT_ENCODER = json.JSONEncoder(separators=(",", ":"), default=_asDict)
+_SORTED_COMPACT_ENCODER = json.JSONEncoder(sort_keys=True, separators=(",", ":"), default=_asDict)
+
+_SCALAR_ENCODERS = {
+    str: encode_basestring_ascii,
+    bool: lambda value: "true" if value else "false",
+    int: int.__repr__,
+    type(None): lambda value: "null",
+}
+
+
+class FieldEncoder:
+    """
+    Encodes the given attributes of an object as a JSON object, in a fixed order.
+
+    The key parts of the output are computed once: only the values are encoded for each object. The output is the
+    same as json.dumps of the attributes dictionary with the same separators.
+    """
+
+    def __init__(self, fields: tuple[str, ...], compact: bool = False, sort_keys: bool = False):
+        """
+        Initializes a new instance of the FieldEncoder class.
+
+        Args:
+            fields (tuple[str, ...]): Names of the attributes, in output order.
+            compact (bool, optional): Use the (",", ":") separators instead of (", ", ": "). Defaults to False.
+            sort_keys (bool, optional): Sort the keys, including those of nested objects. Defaults to False.
+        """
+        item_separator, key_separator = (",", ":") if compact else (", ", ": ")
+        self.fields = tuple(sorted(fields)) if sort_keys else tuple(fields)
+        self._prefixes = tuple(
+            ("{" if index == 0 else item_separator) + encode_basestring_ascii(name) + key_separator
+            for index, name in enumerate(self.fields)
+        )
+        if sort_keys:
+            self._fallback = _SORTED_COMPACT_ENCODER.encode
+        else:
+            self._fallback = _COMPACT_ENCODER.encode if compact else _DEFAULT_ENCODER.encode
+
+    def encode(self, o) -> str:
+        """
+        Args:
+            o (object): The object to encode.
+
+        Returns:
+            str: The JSON object.
+        """
+        if len(self.fields) == 0:
+            return "{}"
+        parts = []
+        for name, prefix in zip(self.fields, self._prefixes):
+            value = getattr(o, name)
+            encoder = _SCALAR_ENCODERS.get(type(value))
+            parts.append(prefix)
+            parts.append(encoder(value) if encoder is not None else self._fallback(value))
+        parts.append("}")
+        return "".join(parts)
+
+
+class _Serializable:
+    """
+    Base of the slotted message classes. Subclasses list their attributes in _fields, in serialization order,
+    and the encoders are built once per class. str() gives the serialization, so that messages can be passed
+    as logging arguments and only be serialized if the record is emitted.
+    """
+
+    __slots__ = ()
+    _fields: tuple[str, ...] = ()
+    _compact: bool = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._encoder = FieldEncoder(cls._fields, cls._compact)
+        cls._sorted_encoder = FieldEncoder(cls._fields, compact=True, sort_keys=True)
+
+    def asDict(self) -> dict:
+        """
+        Returns:
+            dict: The attributes of the message, in serialization order.
+        """
+        return {name: getattr(self, name) for name in self._fields}
 
     def serialize(self) -> str:
-        return json.dumps(self.__dict__)
+        return self._encoder.encode(self)
 
+    def __str__(self):
+        return self.serialize()
+
+
+class BaseJson(_Serializable):
+    """Base of the queries sent by the boards and the requests sent to the boards."""
+
+    __slots__ = ()
+
+    def toJSON(self):
+        return self._sorted_encoder.encode(self)
+
+    def __str__(self):
+        return self.toJSON()
+
+
+class BaseResponse(_Serializable):
+    """Base of the replies sent to the boards."""
+
+    __slots__ = ()
 
+
+@Parser.register("checkuser")
 class UserQuery(BaseJson):
+    __slots__ = ("uid",)
+    _fields = ("uid", "action")
+    action = "checkuser"
+
     def __init__(self, card_uid: str):
         self.uid = card_uid
-        self.action = "checkuser"
 
     @staticmethod
     def deserialize(json_data: str):
-        data = json.loads(json_data)
+        return UserQuery.from_dict(json.loads(json_data))
+
+    @staticmethod
+    def from_dict(data: dict):
         return UserQuery(data["uid"])
 
 
+@Parser.register("checkmachine")
 class MachineQuery(BaseJson):
-    def __init__(self):
-        self.action = "checkmachine"
+    __slots__ = ()
+    _fields = ("action",)
+    action = "checkmachine"
 
     @staticmethod
     def deserialize(json_data: str):
         return MachineQuery()
 
+    @staticmethod
+    def from_dict(data: dict):
+        return MachineQuery()
+
 
+@Parser.register("alive")
 class AliveQuery(BaseJson):
+    __slots__ = ("version", "ip", "serial", "heap")
+    _fields = ("action", "version", "ip", "serial", "heap")
+    action = "alive"
+
     def __init__(self, version: str, ip: str, serial: str, heap: int):
-        self.action = "alive"
         self.version = version
         self.ip = ip
         self.serial = serial
@@ -81,71 +239,125 @@ class AliveQuery(BaseJson):
 
     @staticmethod
     def deserialize(json_data: str):
-        data = json.loads(json_data)
+        return AliveQuery.from_dict(json.loads(json_data))
+
+    @staticmethod
+    def from_dict(data: dict):
         # Serial and Heaps have been added in FW revision 0.6.7
-        if data.get("serial") is None:
-            data["serial"] = ""
-        if data.get("heap") is None:
-            data["heap"] = 0
-        return AliveQuery(data["version"], data["ip"], data["serial"], data["heap"])
+        serial = data.get("serial")
+        heap = data.get("heap")
+        return AliveQuery(data["version"], data["ip"], "" if serial is None else serial, 0 if heap is None else heap)
 
 
+@Parser.register("startuse")
 class StartUseQuery(BaseJson):
+    __slots__ = ("uid", "replay")
+    _fields = ("uid", "action", "replay")
+    action = "startuse"
+
     def __init__(self, card_uid: str, replay: bool = False):
         self.uid = card_uid
-        self.action = "startuse"
         self.replay = replay
 
     @staticmethod
     def deserialize(json_data: str):
-        data = json.loads(json_data)
-        if data.get("replay") is None:
-            data["replay"] = False
-        return StartUseQuery(data["uid"], data["replay"])
+        return StartUseQuery.from_dict(json.loads(json_data))
+
+    @staticmethod
+    def from_dict(data: dict):
+        return StartUseQuery(data["uid"], bool(data.get("replay")))
 
 
+@Parser.register("stopuse")
 class EndUseQuery(BaseJson):
+    __slots__ = ("uid", "duration", "replay")
+    _fields = ("uid", "duration", "action", "replay")
+    action = "stopuse"
+
     def __init__(self, card_uid: str, duration_s: int, replay: bool = False):
         self.uid = card_uid
         self.duration = duration_s
-        self.action = "stopuse"
         self.replay = replay
 
     @staticmethod
     def deserialize(json_data: str):
-        data = json.loads(json_data)
-        if data.get("replay") is None:
-            data["replay"] = False
-        return EndUseQuery(data["uid"], data["duration"], data["replay"])
+        return EndUseQuery.from_dict(json.loads(json_data))
+
+    @staticmethod
+    def from_dict(data: dict):
+        return EndUseQuery(data["uid"], data["duration"], bool(data.get("replay")))
 
 
+@Parser.register("inuse")
 class InUseQuery(BaseJson):
+    __slots__ = ("uid", "duration")
+    _fields = ("uid", "duration", "action")
+    action = "inuse"
+
     def __init__(self, card_uid: str, duration_s: int):
         self.uid = card_uid
         self.duration = duration_s
-        self.action = "inuse"
 
     @staticmethod
     def deserialize(json_data: str):
-        data = json.loads(json_data)
+        return InUseQuery.from_dict(json.loads(json_data))
+
+    @staticmethod
+    def from_dict(data: dict):
         return InUseQuery(data["uid"], data["duration"])
 
 
+@Parser.register("maintenance")
 class RegisterMaintenanceQuery(BaseJson):
+    __slots__ = ("uid", "replay")
+    _fields = ("uid", "action", "replay")
+    action = "maintenance"
+
     def __init__(self, card_uid: str, replay: bool = False):
         self.uid = card_uid
-        self.action = "maintenance"
         self.replay = replay
 
     @staticmethod
     def deserialize(json_data: str):
-        data = json.loads(json_data)
-        if data.get("replay") is None:
-            data["replay"] = False
-        return RegisterMaintenanceQuery(data["uid"], data["replay"])
+        return RegisterMaintenanceQuery.from_dict(json.loads(json_data))
+
+    @staticmethod
+    def from_dict(data: dict):
+        return RegisterMaintenanceQuery(data["uid"], bool(data.get("replay")))
 
 
-class UserResponse:
+@Parser.register("batch")
+class BatchQuery(BaseJson):
+    """Events buffered by a board while offline, replayed in a single message."""
+
+    __slots__ = ("events",)
+    _fields = ("action", "events")
+    action = "batch"
+
+    ACTIONS = ("startuse", "stopuse", "maintenance")
+    MAX_EVENTS = 500
+
+    def __init__(self, events: list):
+        self.events = events
+
+    @staticmethod
+    def deserialize(json_data: str):
+        return BatchQuery.from_dict(json.loads(json_data))
+
+    @staticmethod
+    def from_dict(data: dict):
+        events = data["events"]
+        if not isinstance(events, list) or len(events) > BatchQuery.MAX_EVENTS:
+            raise TypeError("Invalid events list")
+        for event in events:
+            if not isinstance(event, dict) or event.get("action") not in BatchQuery.ACTIONS:
+                raise TypeError("Invalid batch event")
+        return BatchQuery([Parser.from_dict(event) for event in events])
+
+
+class UserResponse(BaseResponse):
+    __slots__ = _fields = ("request_ok", "is_valid", "name", "missing_auth", "level")
+
     def __init__(
         self, request_ok: bool, is_valid: bool, holder_name: str, user_level: USER_LEVEL | int, missing_auth: bool
     ):
@@ -158,11 +370,20 @@ class UserResponse:
         else:
             self.level = user_level
 
-    def serialize(self) -> str:
-        return json.dumps(self.__dict__)
 
+class MachineResponse(BaseResponse):
+    __slots__ = _fields = (
+        "request_ok",
+        "is_valid",
+        "maintenance",
+        "allowed",
+        "name",
+        "logoff",
+        "type",
+        "grace",
+        "description",
+    )
 
-class MachineResponse:
     def __init__(
         self,
         request_ok: bool,
@@ -185,25 +406,32 @@ class MachineResponse:
         self.grace = grace_period_min
         self.description = description
 
-    def serialize(self) -> str:
-        return json.dumps(self.__dict__)
 
+class SimpleResponse(BaseResponse):
+    __slots__ = _fields = ("request_ok", "message")
 
-class SimpleResponse:
     def __init__(self, request_ok: bool, message: str = ""):
         self.request_ok = request_ok
         self.message = message
 
-    def serialize(self) -> str:
-        return json.dumps(self.__dict__)
 
-    def __str__(self):
-        return self.serialize()
+class BatchResponse(BaseResponse):
+    """Response to a batch query, with the outcome of each event in order."""
+
+    __slots__ = _fields = ("request_ok", "results")
+    _compact = True
+
+    def __init__(self, request_ok: bool, results: list[bool]):
+        self.request_ok = request_ok
+        self.results = results
 
 
 class StartRequest(BaseJson):
+    __slots__ = ("uid",)
+    _fields = ("request_type", "uid")
+    request_type = "start"
+
     def __init__(self, card_uid: str):
-        self.request_type = "start"
         self.uid = card_uid
 
     @staticmethod
@@ -213,8 +441,11 @@ class StartRequest(BaseJson):
 
 
 class StopRequest(BaseJson):
+    __slots__ = ("uid",)
+    _fields = ("request_type", "uid")
+    request_type = "stop"
+
     def __init__(self, card_uid: str):
-        self.request_type = "stop"
         self.uid = card_uid
 
     @staticmethod
@@ -223,27 +454,45 @@ class StopRequest(BaseJson):
         return StopRequest(data["uid"])
 
 
+@Parser.register("synccache")
 class SyncCacheQuery(BaseJson):
-    """Query for synchronizing RFID card cache from server."""
-    
-    def __init__(self):
-        self.action = "synccache"
+    """Query for synchronizing RFID card cache from server.
+
+    Boards holding a card list send its version, to receive only the changes.
+    """
+
+    __slots__ = ("version",)
+    _fields = ("action", "version")
+    action = "synccache"
+
+    def __init__(self, version: int | None = None):
+        self.version = version
 
     @staticmethod
     def deserialize(json_data: str):
-        data = json.loads(json_data)
-        return SyncCacheQuery()
+        return SyncCacheQuery.from_dict(json.loads(json_data))
+
+    @staticmethod
+    def from_dict(data: dict):
+        version = data.get("version")
+        return SyncCacheQuery(version if isinstance(version, int) else None)
 
 
-class SyncCacheResponse:
-    """Response containing synchronized card cache data."""
-    
-    def __init__(self, request_ok: bool, cards: list = None):
+class SyncCacheResponse(BaseResponse):
+    """Response containing synchronized card cache data. The version is not sent when unknown."""
+
+    __slots__ = _fields = ("request_ok", "cards", "version")
+    _unversioned_encoder = FieldEncoder(("request_ok", "cards"))
+
+    def __init__(self, request_ok: bool, cards: list = None, version: int | None = None):
         self.request_ok = request_ok
         self.cards = cards if cards is not None else []
+        self.version = version
 
     def serialize(self) -> str:
-        return json.dumps(self.__dict__)
+        if self.version is None:
+            return self._unversioned_encoder.encode(self)
+        return self._encoder.encode(self)
 
     def add_card(self, uid: str, level: int):
         """Add a card to the response.
@@ -253,3 +502,20 @@ class SyncCacheResponse:
             level (int): User level (1=normal, 2=admin)
         """
         self.cards.append({"uid": uid, "level": level})
+
+
+class SyncCacheDeltaResponse(BaseResponse):
+    """Response with the changes of the card list since the version held by the board."""
+
+    __slots__ = _fields = ("request_ok", "version", "added", "removed")
+
+    def __init__(self, request_ok: bool, version: int, added: list = None, removed: list = None):
+        self.request_ok = request_ok
+        self.version = version
+        self.added = added if added is not None else []
+        self.removed = removed if removed is not None else []
+
+    def serialize(self) -> str:
+        if len(self.added) == 0 and len(self.removed) == 0:
+            return json.dumps({"request_ok": self.request_ok, "version": self.version, "unchanged": True})
+        return self._encoder.encode(self)
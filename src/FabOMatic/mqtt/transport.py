@@ -0,0 +1,207 @@
+""" Transports carrying the MQTT messages of MQTTInterface: the paho-mqtt client, or an in-process loopback. """
+
+import itertools
+import queue
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Protocol
+
+import paho.mqtt.client as mqtt
+
+
+class Transport(Protocol):
+    """
+    The subset of the paho-mqtt Client API used by MQTTInterface.
+
+    Callbacks are called with the paho-mqtt version 1 signatures: on_connect(client, userdata, flags, rc),
+    on_disconnect(client, userdata, rc) and on_message(client, userdata, message), where message has topic
+    and payload (bytes) attributes.
+    """
+
+    on_connect: callable
+    on_disconnect: callable
+    on_message: callable
+
+    def username_pw_set(self, username: str, password: str | None = None) -> None: ...
+
+    def connect(self, host: str, port: int = 1883) -> int: ...
+
+    def subscribe(self, topic: str, qos: int = 0) -> tuple[int, int]: ...
+
+    def unsubscribe(self, topic: str) -> tuple[int, int]: ...
+
+    def publish(self, topic: str, payload, qos: int = 0, retain: bool = False): ...
+
+    def loop_start(self) -> int: ...
+
+    def loop_stop(self) -> int: ...
+
+    def disconnect(self) -> int: ...
+
+
+def PahoTransport(client_id: str) -> mqtt.Client:
+    """
+    Builds the paho-mqtt client connecting to the broker.
+
+    Args:
+        client_id (str): The MQTT client ID.
+
+    Returns:
+        mqtt.Client: The client.
+    """
+    return mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION1, client_id=client_id, clean_session=False)
+
+
+@dataclass(frozen=True)
+class LoopbackMessage:
+    """A message delivered by the loopback broker, with the attributes of paho MQTTMessage used by the callbacks."""
+
+    topic: str
+    payload: bytes
+    qos: int = 0
+    retain: bool = False
+
+
+def topicMatches(topic_filter: str, topic: str) -> bool:
+    """
+    Args:
+        topic_filter (str): A subscription, which may contain the + and # wildcards.
+        topic (str): The topic of a message.
+
+    Returns:
+        bool: True if the message matches the subscription.
+    """
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class LoopbackBroker:
+    """
+    In-process broker delivering the messages published by a LoopbackTransport to the subscribed ones.
+
+    Messages are delivered synchronously, in the thread of the publisher, without sockets nor serialization
+    other than the payload encoding.
+    """
+
+    def __init__(self):
+        self._subscriptions: list[tuple[str, "LoopbackTransport"]] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic_filter: str, transport: "LoopbackTransport") -> None:
+        with self._lock:
+            if (topic_filter, transport) not in self._subscriptions:
+                self._subscriptions.append((topic_filter, transport))
+
+    def unsubscribe(self, topic_filter: str, transport: "LoopbackTransport") -> None:
+        with self._lock:
+            self._subscriptions = [s for s in self._subscriptions if s != (topic_filter, transport)]
+
+    def disconnect(self, transport: "LoopbackTransport") -> None:
+        with self._lock:
+            self._subscriptions = [s for s in self._subscriptions if s[1] is not transport]
+
+    def publish(self, message: LoopbackMessage) -> int:
+        """
+        Delivers a message to the matching subscriptions, once per transport.
+
+        Args:
+            message (LoopbackMessage): The message.
+
+        Returns:
+            int: The number of transports the message was delivered to.
+        """
+        with self._lock:
+            receivers = []
+            for topic_filter, transport in self._subscriptions:
+                if transport not in receivers and topicMatches(topic_filter, message.topic):
+                    receivers.append(transport)
+        for transport in receivers:
+            transport._deliver(message)
+        return len(receivers)
+
+
+class LoopbackTransport:
+    """
+    Client of a LoopbackBroker, with the Transport interface.
+
+    The latest published messages are kept in published. Received messages are passed to on_message,
+    or queued in received when on_message is not set, e.g. for a simulated board waiting for its replies.
+    """
+
+    PUBLISHED_SIZE = 1000
+
+    _mids = itertools.count(1)
+
+    def __init__(self, broker: LoopbackBroker, client_id: str = ""):
+        """
+        Initializes a new instance of the LoopbackTransport class.
+
+        Args:
+            broker (LoopbackBroker): The broker shared by the clients.
+            client_id (str, optional): The client ID. Defaults to "".
+        """
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.published: deque[tuple[str, bytes]] = deque(maxlen=self.PUBLISHED_SIZE)
+        self.received = queue.Queue()
+        self._broker = broker
+        self._connected = False
+
+    def username_pw_set(self, username: str, password: str | None = None) -> None:
+        pass
+
+    def connect(self, host: str = "loopback", port: int = 0) -> int:
+        self._connected = True
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, mqtt.MQTT_ERR_SUCCESS)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def subscribe(self, topic: str, qos: int = 0) -> tuple[int, int]:
+        self._broker.subscribe(topic, self)
+        return mqtt.MQTT_ERR_SUCCESS, next(self._mids)
+
+    def unsubscribe(self, topic: str) -> tuple[int, int]:
+        self._broker.unsubscribe(topic, self)
+        return mqtt.MQTT_ERR_SUCCESS, next(self._mids)
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False) -> int:
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif payload is None:
+            payload = b""
+        self.published.append((topic, payload))
+        self._broker.publish(LoopbackMessage(topic, payload, qos, retain))
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_start(self) -> int:
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_stop(self) -> int:
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def disconnect(self) -> int:
+        was_connected = self._connected
+        self._connected = False
+        self._broker.disconnect(self)
+        if was_connected and self.on_disconnect is not None:
+            self.on_disconnect(self, None, mqtt.MQTT_ERR_SUCCESS)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def _deliver(self, message: LoopbackMessage) -> None:
+        if self.on_message is not None:
+            self.on_message(self, None, message)
+        else:
+            self.received.put(message)
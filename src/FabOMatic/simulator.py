@@ -0,0 +1,407 @@
+""" Simulator of a fleet of Fab-O-Matic boards, to measure the load a backend can handle.
+
+Each virtual board connects to the MQTT broker and runs realistic sessions with the real query classes:
+checkmachine, alive and synccache at boot, then card swipes (checkuser) followed by startuse,
+periodic inuse and stopuse. Replies are timed per action.
+
+Usage (the backend must be running against the same broker and database):
+    python -m FabOMatic.simulator --setup --boards 20 --duration 60
+    python -m FabOMatic.simulator --boards 10 --ramp 10 --max-boards 200 --target-ms 200
+
+With --loopback, the backend message processing runs in the simulator process, connected with
+an in-process loopback transport instead of a broker.
+"""
+
+import argparse
+import json
+import logging
+import queue
+import random
+import threading
+from time import perf_counter, sleep
+
+import paho.mqtt.client as mqtt
+
+from FabOMatic.conf import FabConfig
+from FabOMatic.database.DatabaseBackend import DatabaseBackend
+from FabOMatic.database.models import Authorization, Machine, MachineType, Role, User
+from FabOMatic.logic.MsgMapper import MsgMapper
+from FabOMatic.mqtt.MQTTInterface import MQTTInterface
+from FabOMatic.mqtt.mqtt_types import (
+    AliveQuery,
+    BaseJson,
+    EndUseQuery,
+    InUseQuery,
+    MachineQuery,
+    StartUseQuery,
+    SyncCacheQuery,
+    UserQuery,
+)
+from FabOMatic.mqtt.transport import LoopbackBroker, LoopbackTransport, Transport
+from FabOMatic.tracing import LatencyHistogram
+
+SIM_TYPE_NAME = "Simulator"
+SIM_ROLE_NAME = "Simulated users"
+SIM_MACHINE_PREFIX = "SIM-"
+SIM_CARD_PREFIX = "51"
+
+
+class SimulationReport:
+    """Latency histogram, request and error counts of each action, shared by the virtual boards."""
+
+    def __init__(self):
+        self._sent: dict[str, int] = {}
+        self._histograms: dict[str, LatencyHistogram] = {}
+        self._errors: dict[str, dict[str, int]] = {}
+        self._lock = threading.Lock()
+        self.start = perf_counter()
+
+    def sent(self, action: str) -> None:
+        """
+        Counts a message sent by a board.
+
+        Args:
+            action (str): The action of the message.
+        """
+        with self._lock:
+            self._sent[action] = self._sent.get(action, 0) + 1
+
+    def record(self, action: str, seconds: float) -> None:
+        """
+        Records a reply.
+
+        Args:
+            action (str): The action of the request.
+            seconds (float): Time between the request and its reply.
+        """
+        with self._lock:
+            histogram = self._histograms.get(action)
+            if histogram is None:
+                histogram = self._histograms[action] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def error(self, action: str, kind: str) -> None:
+        """
+        Counts a failed request.
+
+        Args:
+            action (str): The action of the request.
+            kind (str): "timeout", "invalid reply" or "not ok".
+        """
+        with self._lock:
+            errors = self._errors.setdefault(action, {})
+            errors[kind] = errors.get(kind, 0) + 1
+
+    def percentile(self, action: str, p: float) -> float:
+        """
+        Args:
+            action (str): The action.
+            p (float): The percentile, between 0 and 100.
+
+        Returns:
+            float: The latency of the percentile in seconds, 0 if the action has no reply.
+        """
+        with self._lock:
+            histogram = self._histograms.get(action)
+            return histogram.percentile(p) if histogram is not None else 0.0
+
+    def summary(self) -> dict:
+        """
+        Returns:
+            dict: For each action, the messages sent, replies, errors, throughput (msg/s) and p50/p95/p99
+                latencies (ms). Actions without reply, like alive, only have messages sent.
+        """
+        elapsed = max(perf_counter() - self.start, 1e-6)
+        result = {}
+        with self._lock:
+            for action in sorted(self._sent):
+                histogram = self._histograms.get(action, LatencyHistogram())
+                errors = sum(self._errors.get(action, {}).values())
+                result[action] = {
+                    "sent": self._sent[action],
+                    "replies": histogram.count,
+                    "errors": errors,
+                    "error_rate": round(100.0 * errors / self._sent[action], 1),
+                    "throughput": round(self._sent[action] / elapsed, 2),
+                    "latency_ms": [round(histogram.percentile(p) * 1000, 1) for p in (50, 95, 99)],
+                }
+        return result
+
+    def print(self) -> None:
+        """Prints the summary as a table."""
+        print(
+            f"{'action':<14}{'sent':>8}{'replies':>9}{'errors':>8}{'err %':>7}{'msg/s':>9}"
+            f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+        )
+        for action, row in self.summary().items():
+            p50, p95, p99 = row["latency_ms"]
+            print(
+                f"{action:<14}{row['sent']:>8}{row['replies']:>9}{row['errors']:>8}{row['error_rate']:>7.1f}"
+                f"{row['throughput']:>9.2f}{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}"
+            )
+
+
+class VirtualBoard(threading.Thread):
+    """A board of one machine, sending requests and waiting for each reply like the firmware does."""
+
+    def __init__(self, machine_id: int, cards: list[str], report: SimulationReport, stop: threading.Event, args):
+        """
+        Initializes a new instance of the VirtualBoard class.
+
+        Args:
+            machine_id (int): The ID of the simulated machine.
+            cards (list[str]): The card UUIDs swiped on the board.
+            report (SimulationReport): Collects the reply times.
+            stop (threading.Event): Set to end the simulation.
+            args (argparse.Namespace): The simulation parameters, args.transport_factory(client_id) builds the client.
+        """
+        super().__init__(name=f"board-{machine_id}", daemon=True)
+        self.machine_id = machine_id
+        self._cards = cards
+        self._report = report
+        self._stop_event = stop
+        self._args = args
+        self._random = random.Random(args.seed * 100003 + machine_id)
+        self._replies = queue.Queue()
+        self._topic = f"{args.topic}/{machine_id}"
+
+    def run(self) -> None:
+        client = self._args.transport_factory(f"sim-board-{self.machine_id}")
+        client.on_message = lambda client, userdata, message: self._replies.put(message.payload)
+        client.connect(self._args.broker, port=self._args.port)
+        client.subscribe(self._topic + self._args.reply_subtopic, qos=1)
+        client.loop_start()
+        try:
+            self._boot(client)
+            next_alive = perf_counter() + self._args.alive_interval
+            sessions = 0
+            while not self._stop_event.wait(self._random.expovariate(1.0 / self._args.think)):
+                if perf_counter() >= next_alive:
+                    self._alive(client)
+                    next_alive = perf_counter() + self._args.alive_interval
+                self._session(client)
+                sessions += 1
+                if sessions % 10 == 0:
+                    self._request(client, SyncCacheQuery())
+        finally:
+            client.loop_stop()
+            client.disconnect()
+
+    def _boot(self, client: Transport) -> None:
+        self._request(client, MachineQuery())
+        self._alive(client)
+        self._request(client, SyncCacheQuery())
+
+    def _alive(self, client: Transport) -> None:
+        # The backend does not reply to alive messages
+        query = AliveQuery("1.0.0-sim", "127.0.0.1", f"SIM{self.machine_id:05d}", 150000)
+        client.publish(self._topic, query.toJSON(), qos=0)
+        self._report.sent(query.action)
+
+    def _session(self, client: Transport) -> None:
+        uid = self._random.choice(self._cards)
+        reply = self._request(client, UserQuery(uid))
+        if reply is None or not reply.get("is_valid", False):
+            return
+
+        reply = self._request(client, StartUseQuery(uid))
+        if reply is None:
+            return
+
+        start = perf_counter()
+        end = start + self._random.expovariate(1.0 / self._args.use_duration)
+        while not self._stop_event.wait(max(0.0, min(self._args.inuse_interval, end - perf_counter()))):
+            if perf_counter() >= end:
+                break
+            self._request(client, InUseQuery(uid, int(perf_counter() - start)))
+        self._request(client, EndUseQuery(uid, int(perf_counter() - start)))
+
+    def _request(self, client: Transport, query: BaseJson) -> dict | None:
+        # A late reply to a previous request must not be taken for this one
+        while not self._replies.empty():
+            self._replies.get_nowait()
+
+        start = perf_counter()
+        client.publish(self._topic, query.toJSON(), qos=0)
+        self._report.sent(query.action)
+        try:
+            payload = self._replies.get(timeout=self._args.timeout)
+        except queue.Empty:
+            self._report.error(query.action, "timeout")
+            return None
+        self._report.record(query.action, perf_counter() - start)
+
+        try:
+            reply = json.loads(payload)
+        except ValueError:
+            self._report.error(query.action, "invalid reply")
+            return None
+        if not reply.get("request_ok", False):
+            self._report.error(query.action, "not ok")
+        return reply
+
+
+def setupFleet(db: DatabaseBackend, nb_machines: int, nb_users: int) -> None:
+    """
+    Creates the simulated machines, and users authorized on all of them, if missing.
+
+    Args:
+        db (DatabaseBackend): The database of the backend.
+        nb_machines (int): Number of simulated machines.
+        nb_users (int): Number of simulated users with a card.
+    """
+    with db.getSession() as session:
+        machine_type = session.query(MachineType).filter_by(type_name=SIM_TYPE_NAME).first()
+        if machine_type is None:
+            machine_type = MachineType(type_name=SIM_TYPE_NAME)
+            session.add(machine_type)
+        role = session.query(Role).filter_by(role_name=SIM_ROLE_NAME).first()
+        if role is None:
+            role = Role(role_name=SIM_ROLE_NAME)
+            session.add(role)
+        session.flush()
+
+        for i in range(1, nb_machines + 1):
+            name = f"{SIM_MACHINE_PREFIX}{i:03d}"
+            if session.query(Machine).filter_by(machine_name=name).first() is None:
+                session.add(Machine(machine_name=name, machine_type_id=machine_type.type_id))
+        for i in range(1, nb_users + 1):
+            card = f"{SIM_CARD_PREFIX}{i:06X}"
+            if session.query(User).filter_by(card_UUID=card).first() is None:
+                session.add(User(name="Simulated", surname=f"User {i}", role_id=role.role_id, card_UUID=card))
+        session.flush()
+
+        machines = session.query(Machine).filter(Machine.machine_name.startswith(SIM_MACHINE_PREFIX)).all()
+        users = session.query(User).filter(User.card_UUID.startswith(SIM_CARD_PREFIX)).all()
+        existing = set(
+            session.query(Authorization.user_id, Authorization.machine_id).filter(
+                Authorization.user_id.in_([user.user_id for user in users])
+            )
+        )
+        session.add_all(
+            Authorization(user_id=user.user_id, machine_id=machine.machine_id)
+            for user in users
+            for machine in machines
+            if (user.user_id, machine.machine_id) not in existing
+        )
+        session.commit()
+
+
+def loadFleet(db: DatabaseBackend) -> tuple[list[int], list[str]]:
+    """
+    Args:
+        db (DatabaseBackend): The database of the backend.
+
+    Returns:
+        tuple[list[int], list[str]]: The IDs of the simulated machines and the cards of the simulated users.
+    """
+    with db.getSession() as session:
+        machine_ids = [
+            machine_id
+            for (machine_id,) in session.query(Machine.machine_id)
+            .filter(Machine.machine_name.startswith(SIM_MACHINE_PREFIX))
+            .order_by(Machine.machine_id)
+        ]
+        cards = [
+            card
+            for (card,) in session.query(User.card_UUID)
+            .filter(User.card_UUID.startswith(SIM_CARD_PREFIX))
+            .order_by(User.user_id)
+        ]
+    return machine_ids, cards
+
+
+def runStage(machine_ids: list[int], cards: list[str], args) -> SimulationReport:
+    """
+    Runs one board per machine during args.duration seconds.
+
+    Args:
+        machine_ids (list[int]): The machines simulated.
+        cards (list[str]): The card UUIDs swiped on the boards.
+        args (argparse.Namespace): The simulation parameters.
+
+    Returns:
+        SimulationReport: The reply times of the stage.
+    """
+    report = SimulationReport()
+    stop = threading.Event()
+    boards = [VirtualBoard(machine_id, cards, report, stop, args) for machine_id in machine_ids]
+    for board in boards:
+        board.start()
+        # Spread the boots of the boards, as after a power cut
+        sleep(0.01)
+    stop.wait(args.duration)
+    stop.set()
+    for board in boards:
+        board.join(args.timeout + 1)
+    return report
+
+
+def main():
+    settings = FabConfig.loadSubSettings("MQTT")
+    parser = argparse.ArgumentParser(description="Fab-O-Matic boards fleet simulator")
+    parser.add_argument("-b", "--boards", type=int, default=10, help="Number of simulated boards")
+    parser.add_argument("-d", "--duration", type=float, default=60, help="Duration of each stage (s)")
+    parser.add_argument("--ramp", type=int, default=0, help="Boards added after each stage, 0 for a single stage")
+    parser.add_argument("--max-boards", type=int, default=200, help="Maximum number of boards when ramping")
+    parser.add_argument("--target-ms", type=float, default=200, help="Ramping stops when checkuser p95 exceeds it")
+    parser.add_argument("--setup", action="store_true", help="Create the simulated machines and users first")
+    parser.add_argument("--users", type=int, default=50, help="Number of simulated users created by --setup")
+    parser.add_argument("--think", type=float, default=5, help="Mean idle time between two sessions (s)")
+    parser.add_argument("--use-duration", type=float, default=30, help="Mean duration of a machine use (s)")
+    parser.add_argument("--inuse-interval", type=float, default=10, help="Interval of the inuse heartbeats (s)")
+    parser.add_argument("--alive-interval", type=float, default=30, help="Interval of the alive messages (s)")
+    parser.add_argument("--timeout", type=float, default=5, help="Reply timeout (s)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random sessions")
+    parser.add_argument("--broker", default=settings["broker"], help="MQTT broker")
+    parser.add_argument("--port", type=int, default=settings["port"], help="MQTT broker port")
+    parser.add_argument("--loopback", action="store_true", help="Run the backend in-process, without broker")
+    args = parser.parse_args()
+    args.topic = settings["topic"]
+    args.reply_subtopic = settings["reply_subtopic"]
+
+    logging.basicConfig(level=logging.WARNING)
+    db = DatabaseBackend()
+    if args.setup:
+        setupFleet(db, max(args.boards, args.max_boards if args.ramp > 0 else 0), args.users)
+        if not args.loopback:
+            print("Simulated machines and users created, the backend loads them within database.cache_refresh_s.")
+    machine_ids, cards = loadFleet(db)
+    if len(cards) == 0 or len(machine_ids) < args.boards:
+        print(f"Only {len(machine_ids)} simulated machines and {len(cards)} cards in the database, use --setup")
+        return
+
+    backend = None
+    if args.loopback:
+        broker = LoopbackBroker()
+        args.transport_factory = lambda client_id: LoopbackTransport(broker, client_id)
+        backend = MQTTInterface(args.transport_factory)
+        MsgMapper(backend, db).registerHandlers()
+        backend.connect()
+    else:
+        args.transport_factory = lambda client_id: mqtt.Client(
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION1, client_id=client_id
+        )
+
+    boards = args.boards
+    while True:
+        print(f"\n{boards} boards, {args.duration:.0f} s")
+        report = runStage(machine_ids[:boards], cards, args)
+        report.print()
+        p95 = report.percentile("checkuser", 95) * 1000
+        if args.ramp <= 0:
+            break
+        if p95 > args.target_ms:
+            print(f"\ncheckuser p95 {p95:.0f} ms exceeds {args.target_ms:.0f} ms with {boards} boards")
+            break
+        if boards + args.ramp > min(args.max_boards, len(machine_ids)):
+            print(f"\ncheckuser p95 stayed under {args.target_ms:.0f} ms up to {boards} boards")
+            break
+        boards += args.ramp
+
+    if backend is not None:
+        backend.disconnect()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+""" Runtime statistics of the backend, kept in fixed-size ring buffers. """
+
+import threading
+from time import monotonic
+
+from FabOMatic.tracing import Trace
+
+
+class RingBuffer:
+    """Fixed-size buffer of the latest values, the oldest value is overwritten when full."""
+
+    def __init__(self, size: int):
+        """
+        Initializes a new instance of the RingBuffer class.
+
+        Args:
+            size (int): Number of values kept.
+        """
+        self._values = [0.0] * max(1, size)
+        self._index = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, value: float) -> None:
+        """
+        Adds a value, overwriting the oldest one when the buffer is full.
+
+        Args:
+            value (float): The value.
+        """
+        self._values[self._index] = value
+        self._index = (self._index + 1) % len(self._values)
+        if self._count < len(self._values):
+            self._count += 1
+
+    def values(self) -> list[float]:
+        """
+        Returns:
+            list[float]: The values kept, in no particular order.
+        """
+        return self._values[: self._count]
+
+    def percentiles(self, *percents: float) -> list[float]:
+        """
+        Args:
+            *percents (float): The percentiles, between 0 and 100.
+
+        Returns:
+            list[float]: The value of each percentile (nearest rank), 0 if the buffer is empty.
+        """
+        values = sorted(self.values())
+        if len(values) == 0:
+            return [0.0 for _ in percents]
+        return [values[min(len(values) - 1, max(0, int(p * len(values) / 100.0 + 0.5) - 1))] for p in percents]
+
+    def mean(self) -> float:
+        """
+        Returns:
+            float: The mean of the values, 0 if the buffer is empty.
+        """
+        return sum(self.values()) / self._count if self._count > 0 else 0.0
+
+    def max(self) -> float:
+        """
+        Returns:
+            float: The largest value, 0 if the buffer is empty.
+        """
+        return max(self.values(), default=0.0)
+
+
+class RateCounter:
+    """Counts events in one slot per second, over a sliding window."""
+
+    def __init__(self, window_s: int = 60):
+        """
+        Initializes a new instance of the RateCounter class.
+
+        Args:
+            window_s (int, optional): Length of the window, in seconds. Defaults to 60.
+        """
+        self._window_s = max(1, window_s)
+        self._counts = [0] * self._window_s
+        self._seconds = [-1] * self._window_s
+
+    def add(self, now: float) -> None:
+        """
+        Counts an event.
+
+        Args:
+            now (float): Time of the event, from time.monotonic.
+        """
+        second = int(now)
+        slot = second % self._window_s
+        if self._seconds[slot] != second:
+            self._seconds[slot] = second
+            self._counts[slot] = 0
+        self._counts[slot] += 1
+
+    def rate(self, now: float, elapsed_s: float) -> float:
+        """
+        Args:
+            now (float): Current time, from time.monotonic.
+            elapsed_s (float): Time since the counting started, shorter windows are used at startup.
+
+        Returns:
+            float: The number of events per second over the window.
+        """
+        second = int(now)
+        total = sum(c for c, s in zip(self._counts, self._seconds) if second - s < self._window_s)
+        return total / max(1.0, min(self._window_s, elapsed_s))
+
+
+class RuntimeStatistics:
+    """
+    Recent activity of the board requests: message rates and handler latency per action, database time
+    per message, queue depth and error counts.
+
+    Memory is bounded whatever the traffic: rates use one slot per second over a window, other values
+    keep the latest samples in ring buffers.
+    """
+
+    def __init__(self, samples: int = 256, window_s: int = 60):
+        """
+        Initializes a new instance of the RuntimeStatistics class.
+
+        Args:
+            samples (int, optional): Number of samples kept by each ring buffer. Defaults to 256.
+            window_s (int, optional): Window of the message rates, in seconds. Defaults to 60.
+        """
+        self._samples = samples
+        self._window_s = window_s
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        """Forgets the recorded activity."""
+        with self._lock:
+            self._start = monotonic()
+            self._rates: dict[str, RateCounter] = {}
+            self._latency: dict[str, RingBuffer] = {}
+            self._db_time = RingBuffer(self._samples)
+            self._queue_depth = RingBuffer(self._samples)
+            self._errors: dict[str, int] = {}
+
+    def recordRequest(self, trace: Trace) -> None:
+        """
+        Records a processed board request.
+
+        Args:
+            trace (Trace): The latency trace of the request.
+        """
+        action = trace.action or "unknown"
+        now = monotonic()
+        with self._lock:
+            rate = self._rates.get(action)
+            if rate is None:
+                rate = self._rates[action] = RateCounter(self._window_s)
+                self._latency[action] = RingBuffer(self._samples)
+            rate.add(now)
+            # The end-to-end latency, queue wait included, is measured by request_tracer
+            self._latency[action].append(trace.stages.get("handler", 0.0))
+            self._db_time.append(trace.stages.get("sql", 0.0))
+
+    def recordError(self, kind: str) -> None:
+        """
+        Counts an error.
+
+        Args:
+            kind (str): The kind of error, e.g. "handler", "invalid message", "publish".
+        """
+        with self._lock:
+            self._errors[kind] = self._errors.get(kind, 0) + 1
+
+    def sampleQueueDepth(self, depth: int) -> None:
+        """
+        Records the number of messages waiting to be processed.
+
+        Args:
+            depth (int): The queue depth.
+        """
+        with self._lock:
+            self._queue_depth.append(depth)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: The uptime, the message rate and the p50/p95/p99 handler time (ms) of each action, the mean
+                and p95 database time per message (ms), the maximum sampled queue depth and the error counts.
+        """
+        now = monotonic()
+        with self._lock:
+            elapsed = now - self._start
+            return {
+                "Uptime (s)": int(elapsed),
+                "Rate (msg/s)": {
+                    action: round(rate.rate(now, elapsed), 2) for action, rate in sorted(self._rates.items())
+                },
+                "Handler latency (ms)": {
+                    action: [round(value * 1000, 1) for value in latency.percentiles(50, 95, 99)]
+                    for action, latency in sorted(self._latency.items())
+                },
+                "DB time per message (ms)": {
+                    "mean": round(self._db_time.mean() * 1000, 1),
+                    "p95": round(self._db_time.percentiles(95)[0] * 1000, 1),
+                },
+                "Queue depth max": int(self._queue_depth.max()),
+                "Errors": dict(sorted(self._errors.items())),
+            }
+
+
+runtime_stats = RuntimeStatistics()
@@ -0,0 +1,272 @@
+""" Latency tracing of the board requests, from their arrival to the reply. """
+
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Thread-local holder of the trace of the request being processed
+_local = threading.local()
+
+
+class LatencyHistogram:
+    """
+    Histogram of durations with fixed, geometrically growing buckets.
+
+    Recording is a binary search and an increment, whatever the number of samples.
+    Percentiles are the upper bound of the bucket holding them, so they are precise within 20 %.
+    """
+
+    # From 0.1 ms to about 70 s
+    BOUNDS = [0.0001 * 1.2**i for i in range(75)]
+
+    def __init__(self):
+        self._counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        """
+        Adds a sample.
+
+        Args:
+            seconds (float): The duration.
+        """
+        self._counts[bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p: float) -> float:
+        """
+        Args:
+            p (float): The percentile, between 0 and 100.
+
+        Returns:
+            float: The duration under which p percent of the samples are, in seconds. 0 if there is no sample.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = p * self.count / 100.0
+        cumulated = 0
+        for index, count in enumerate(self._counts):
+            cumulated += count
+            if cumulated >= rank and count > 0:
+                return min(self.BOUNDS[index], self.max) if index < len(self.BOUNDS) else self.max
+        return self.max
+
+
+class Trace:
+    """
+    Timings of one board request, split in stages.
+
+    Sequential stages are measured with lap, which charges the time elapsed since the previous lap.
+    The SQL time is measured inside the handler stage, and counted in both.
+    """
+
+    def __init__(self, machine: str):
+        """
+        Stamps the arrival of a message.
+
+        Args:
+            machine (str): The ID of the machine which sent the message.
+        """
+        self.machine = machine
+        self.action = None
+        self.start = perf_counter()
+        self._mark = self.start
+        self.stages: dict[str, float] = {}
+        self.sql_count = 0
+
+    def lap(self, stage: str) -> None:
+        """
+        Charges the time elapsed since the previous lap to a stage.
+
+        Args:
+            stage (str): The name of the stage.
+        """
+        now = perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self._mark
+        self._mark = now
+
+    def add(self, stage: str, seconds: float) -> None:
+        """
+        Adds a duration measured separately to a stage.
+
+        Args:
+            stage (str): The name of the stage.
+            seconds (float): The duration.
+        """
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        """
+        Returns:
+            float: The time since the arrival of the message, in seconds.
+        """
+        return perf_counter() - self.start
+
+    def breakdown(self) -> str:
+        """
+        Returns:
+            str: The duration of each stage, for the logs.
+        """
+        stages = ", ".join(f"{stage} {seconds * 1000:.1f} ms" for stage, seconds in self.stages.items())
+        return f"{stages} ({self.sql_count} SQL statements)"
+
+
+def currentTrace() -> Trace | None:
+    """
+    Returns:
+        Trace | None: The trace of the request processed by the current thread, if any.
+    """
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def activate(trace: Trace | None):
+    """
+    Makes a trace the current one of the thread, for the duration of the block.
+
+    Args:
+        trace (Trace | None): The trace of the request to be processed.
+    """
+    previous = getattr(_local, "trace", None)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def lap(stage: str) -> None:
+    """
+    Charges the time elapsed since the previous lap to a stage of the current trace. Does nothing if there is none.
+
+    Args:
+        stage (str): The name of the stage.
+    """
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace.lap(stage)
+
+
+class RequestTracer:
+    """
+    Collects the finished traces in one histogram per action and stage, and logs the slow requests.
+
+    Attributes:
+        slow_threshold_s (float): Requests taking longer than this are logged with their stage breakdown.
+    """
+
+    TOTAL = "total"
+
+    def __init__(self, slow_threshold_s: float = 0.5):
+        """
+        Initializes a new instance of the RequestTracer class.
+
+        Args:
+            slow_threshold_s (float, optional): Threshold of the slow requests log, in seconds. Defaults to 0.5.
+        """
+        self.slow_threshold_s = slow_threshold_s
+        self._histograms: dict[str, dict[str, LatencyHistogram]] = {}
+        self._slow_count = 0
+        self._lock = threading.Lock()
+
+    def record(self, trace: Trace) -> None:
+        """
+        Records a finished request.
+
+        Args:
+            trace (Trace): The trace of the request.
+        """
+        total = trace.elapsed()
+        action = trace.action or "unknown"
+        with self._lock:
+            histograms = self._histograms.setdefault(action, {})
+            for stage, seconds in [(self.TOTAL, total), *trace.stages.items()]:
+                histogram = histograms.get(stage)
+                if histogram is None:
+                    histogram = histograms[stage] = LatencyHistogram()
+                histogram.record(seconds)
+            slow = total >= self.slow_threshold_s
+            if slow:
+                self._slow_count += 1
+
+        if slow:
+            logging.warning(
+                "Slow %s request from machine %s: %.1f ms, %s",
+                action,
+                trace.machine,
+                total * 1000,
+                trace.breakdown(),
+            )
+
+    def histogram(self, action: str, stage: str = TOTAL) -> LatencyHistogram | None:
+        """
+        Args:
+            action (str): The action of the requests.
+            stage (str, optional): The stage. Defaults to the whole request.
+
+        Returns:
+            LatencyHistogram | None: The histogram, None if no such request was recorded.
+        """
+        with self._lock:
+            return self._histograms.get(action, {}).get(stage)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: For each action, the number of requests and the p50/p95/p99 latencies in ms of the whole request
+                and of each stage.
+        """
+        result = {}
+        with self._lock:
+            for action, histograms in sorted(self._histograms.items()):
+                result[action] = {
+                    "count": histograms[self.TOTAL].count,
+                    **{
+                        stage: [round(histogram.percentile(p) * 1000, 1) for p in (50, 95, 99)]
+                        for stage, histogram in histograms.items()
+                    },
+                }
+        return result
+
+    def slowCount(self) -> int:
+        """
+        Returns:
+            int: The number of requests slower than the threshold.
+        """
+        return self._slow_count
+
+    def clear(self) -> None:
+        """Forgets the recorded requests."""
+        with self._lock:
+            self._histograms.clear()
+            self._slow_count = 0
+
+
+request_tracer = RequestTracer()
+
+
+# The start time is kept on the execution context of the statement: nothing is left behind when it fails
+@event.listens_for(Engine, "before_cursor_execute")
+def _beforeExecute(conn, cursor, statement, parameters, context, executemany):
+    trace = getattr(_local, "trace", None)
+    if trace is not None and context is not None:
+        context._trace = (trace, perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _afterExecute(conn, cursor, statement, parameters, context, executemany):
+    # The statement is charged to the trace active when it started
+    trace, start = getattr(context, "_trace", (None, 0.0))
+    if trace is not None:
+        trace.add("sql", perf_counter() - start)
+        trace.sql_count += 1
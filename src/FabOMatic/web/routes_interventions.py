@@ -9,37 +9,37 @@ from flask import render_template, request, redirect, url_for
 from flask_login import login_required
 from flask_babel import gettext
 from FabOMatic.database.models import Intervention, Machine, Maintenance, User
-from .webapplication import DBSession, app, excel
+from .webapplication import DBReadSession, DBSession, app, excel
 
 
 @app.route("/interventions")
 @login_required
 def view_interventions():
-    session = DBSession()
-    users = session.query(User).filter_by(deleted=False).order_by(User.user_id).all()
-    machines = session.query(Machine).order_by(Machine.machine_id).all()
+    with DBReadSession() as session:
+        users = session.query(User).filter_by(deleted=False).order_by(User.user_id).all()
+        machines = session.query(Machine).order_by(Machine.machine_id).all()
+
+        search_user = request.args.get("search_user_id")
+        search_machine = request.args.get("search_machine_id")
+
+        query = session.query(Intervention)
 
-    search_user = request.args.get("search_user_id")
-    search_machine = request.args.get("search_machine_id")
-
-    query = session.query(Intervention)
-
-    if search_user and search_user.isdigit():
-        search_user = int(search_user)
-        query = query.filter(Intervention.user_id == search_user)
-    if search_machine and search_machine.isdigit():
-        search_machine = int(search_machine)
-        query = query.filter(Intervention.machine_id == search_machine)
-
-    interventions = query.limit(500).all()
-    return render_template(
-        "view_interventions.html",
-        users=users,
-        machines=machines,
-        interventions=interventions,
-        search_user_id=search_user,
-        search_machine_id=search_machine,
-    )
+        if search_user and search_user.isdigit():
+            search_user = int(search_user)
+            query = query.filter(Intervention.user_id == search_user)
+        if search_machine and search_machine.isdigit():
+            search_machine = int(search_machine)
+            query = query.filter(Intervention.machine_id == search_machine)
+
+        interventions = query.limit(500).all()
+        return render_template(
+            "view_interventions.html",
+            users=users,
+            machines=machines,
+            interventions=interventions,
+            search_user_id=search_user,
+            search_machine_id=search_machine,
+        )
 
 
 @app.route("/interventions/add", methods=["GET", "POST"])
@@ -5,27 +5,28 @@
 from flask import flash, render_template, request, redirect, url_for
 from flask_login import login_required, current_user
 from flask_babel import gettext
+from sqlalchemy.orm import selectinload
 from FabOMatic.__main__ import Backend
 from FabOMatic.database.models import Machine, MachineType, User
-from FabOMatic.database.repositories import MachineRepository
-from .webapplication import DBSession, app
+from FabOMatic.database.repositories import MaintenanceCounterRepository
+from .webapplication import DBReadSession, DBSession, app
 
 
 @app.route("/machines", methods=["GET"])
 @login_required
 def view_machines():
-    session = DBSession()
-    machine_repo = MachineRepository(session)
-    machines = session.query(Machine).order_by(Machine.machine_id).all()
-    maint_stats = {}
-    for machine in machines:
-        for maint in machine.maintenances:
-            elapsed_s = machine_repo.getRelativeUseTimeByMaintenance(machine.machine_id, maint)
-            elapsed_h = round(elapsed_s / 3600.0, 1)
-            expired = elapsed_h > maint.hours_between
-            maint_stats[maint.maintenance_id] = {"expired": expired, "elapsed": elapsed_h}
-
-    return render_template("view_machines.html", machines=machines, maint_stats=maint_stats)
+    with DBReadSession() as session:
+        machines = (
+            session.query(Machine).options(selectinload(Machine.maintenances)).order_by(Machine.machine_id).all()
+        )
+        maint_stats = {}
+        for status in MaintenanceCounterRepository(session).getMaintenanceStatus():
+            maint_stats[status.maintenance.maintenance_id] = {
+                "expired": status.expired,
+                "elapsed": round(status.elapsed_h, 1),
+            }
+
+        return render_template("view_machines.html", machines=machines, maint_stats=maint_stats)
 
 
 @app.route("/machines/add", methods=["GET"])
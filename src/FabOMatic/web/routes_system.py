@@ -2,17 +2,22 @@
 
 # pylint: disable=C0116
 
-from flask import flash, redirect, render_template, Response, request, send_file, url_for
+from flask import flash, jsonify, redirect, render_template, Response, request, send_file, url_for
 from flask_login import login_required
 from flask_babel import gettext
 from importlib.metadata import version
 
 from FabOMatic.conf import FabConfig
+from FabOMatic.database import sqlite_profile, transfer
+from FabOMatic.database.engines import engine_factory
+from FabOMatic.database.notifications import changes_notifier
 from FabOMatic.database.repositories import BoardsRepository
-from .webapplication import DBSession, app
+from .webapplication import DBSession, app, engine
+import io
 import os
 import platform
 import shutil
+import tempfile
 import psutil
 import subprocess
 import requests
@@ -21,8 +26,11 @@ import requests
 @app.route("/system")
 @login_required
 def system():
-    db_file = FabConfig.getDatabaseUrl().replace("sqlite:///", "")
-    db_size = os.path.getsize(db_file)
+    if transfer.isSqlite(engine):
+        db_file = engine.url.database
+    else:
+        db_file = engine.url.render_as_string(hide_password=True)
+    db_size = transfer.databaseSize(engine)
     # Returns information about the host machine (Raspberry Pi)
     machine_info = f"{platform.uname() }, CPU:{os.cpu_count()}"
     total, used, disk_free = shutil.disk_usage(__file__)
@@ -52,15 +60,33 @@ def system():
         latest_version=latest_version,
         db_file=db_file,
         boards=boards,
+        runtime_stats=app.backend.stats() if app.backend is not None else {},
     )
 
 
+@app.route("/system/stats")
+@login_required
+def system_stats():
+    # Same statistics as published on the MQTT stats topic
+    if app.backend is None:
+        return jsonify({})
+    return jsonify(app.backend.stats())
+
+
 @app.route("/download_db")
 @login_required
 def download_db():
-    # Returns of copy of the SQLite database to the user
-    db_file = FabConfig.getDatabaseUrl().replace("sqlite:///", "")
-    return send_file(db_file, as_attachment=True)
+    # Returns a SQLite copy of the database to the user, including the transactions of the write-ahead log
+    if transfer.isSqlite(engine):
+        download_name = os.path.basename(engine.url.database)
+    else:
+        download_name = FabConfig.getSetting("database", "name") + ".sqldb"
+    with tempfile.TemporaryDirectory() as folder:
+        snapshot = os.path.join(folder, download_name)
+        transfer.exportDatabase(engine, snapshot)
+        with open(snapshot, "rb") as f:
+            data = io.BytesIO(f.read())
+    return send_file(data, as_attachment=True, download_name=download_name)
 
 
 @app.route("/download_logs")
@@ -82,13 +108,28 @@ def upload_db():
         flash(gettext("File must have sqldb extension"), "error")
         redirect(url_for("system"))
 
+    if not transfer.isSqlite(engine):
+        # The contents of the database are replaced by the uploaded file, a copy of the previous ones is kept
+        backup_copy = os.path.abspath(FabConfig.getSetting("database", "name") + ".bak.sqldb")
+        transfer.exportDatabase(engine, backup_copy)
+        with tempfile.TemporaryDirectory() as folder:
+            uploaded = os.path.join(folder, "upload.sqldb")
+            new_db_file.save(uploaded)
+            transfer.importDatabase(uploaded, engine)
+        changes_notifier.notifyReset(FabConfig.getDatabaseUrl())
+        flash(gettext("Database was replaced. Previous copy can be found at ") + backup_copy)
+        return redirect(url_for("system"))
+
     # Backup existing file
-    actual_db_file = FabConfig.getDatabaseUrl().replace("sqlite:///", "")
+    actual_db_file = engine.url.database
     backup_copy = actual_db_file + ".bak"
-    shutil.copyfile(actual_db_file, backup_copy)
+    sqlite_profile.backup(actual_db_file, backup_copy)
 
-    # Save the uploaded file over the existing
+    # Save the uploaded file over the existing, the write-ahead log of the previous database is discarded
+    engine_factory.dispose(FabConfig.getDatabaseUrl())
+    sqlite_profile.removeDatabaseFiles(actual_db_file)
     new_db_file.save(actual_db_file)
+    changes_notifier.notifyReset(FabConfig.getDatabaseUrl())
     # Redirect to the home page after uploading
     flash(gettext("Database was replaced. Previous copy can be found at ") + backup_copy)
     return redirect(url_for("system"))
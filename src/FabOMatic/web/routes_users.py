@@ -9,16 +9,16 @@ from flask_login import login_required
 from flask_babel import gettext
 from FabOMatic.database.models import User, Role, UnknownCard
 from FabOMatic.web.authentication import send_reset_email
-from .webapplication import DBSession, app, excel
+from .webapplication import DBReadSession, DBSession, app, excel
 
 
 @app.route("/users", methods=["GET"])
 @login_required
 def view_users():
-    session = DBSession()
-    users = session.query(User).filter_by(deleted=False).order_by(User.user_id).all()
-    cards = session.query(UnknownCard).order_by(UnknownCard.timestamp.desc()).limit(20)
-    return render_template("view_users.html", users=users, cards=cards)
+    with DBReadSession() as session:
+        users = session.query(User).filter_by(deleted=False).order_by(User.user_id).all()
+        cards = session.query(UnknownCard).order_by(UnknownCard.timestamp.desc()).limit(20)
+        return render_template("view_users.html", users=users, cards=cards)
 
 
 @app.route("/users/add", methods=["GET"])
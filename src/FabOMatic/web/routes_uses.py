@@ -8,8 +8,8 @@ from flask import render_template, request, redirect, url_for, flash
 from flask_login import login_required
 from flask_babel import gettext
 from FabOMatic.database.models import Machine, Use, User
-from FabOMatic.database.repositories import MachineRepository, UserRepository
-from .webapplication import DBSession, app, excel
+from FabOMatic.database.repositories import MachineRepository, MaintenanceCounterRepository, UserRepository
+from .webapplication import DBReadSession, DBSession, app, excel, last_seen_of
 
 
 @app.route("/machines/history/<int:machine_id>", methods=["GET"])
@@ -39,13 +39,14 @@ def delete_use(use_id):
         if correct == "on":
             # We may delete a use record which is not yet closed.
             if use.end_timestamp is None:
-                use.end_timestamp = use.last_seen
+                use.end_timestamp = last_seen_of(use)
             duration = use.end_timestamp - use.start_timestamp
             machine = session.query(Machine).filter_by(machine_id=use.machine_id).one()
             if machine and duration > 0:
                 machine.machine_hours -= duration / 3600.0
 
         session.delete(use)
+        MaintenanceCounterRepository(session).rebuild(use.machine_id)
         session.commit()
         flash(gettext("Use deleted successfully."))
     else:
@@ -56,44 +57,44 @@ def delete_use(use_id):
 @app.route("/view_uses", methods=["GET"])
 @login_required
 def view_uses():
-    session = DBSession()
-    user_id = request.args.get("user_id")
-    machine_id = request.args.get("machine_id")
-    start_time = request.args.get("start_time")
-
-    # Convert start_time to a datetime object
-    if start_time:
-        start_time = datetime.strptime(start_time, "%Y-%m-%dT%H:%M")
-
-    # Query the database to get the data
-    uses = session.query(Use)
-
-    if user_id and user_id.isdigit():
-        user_id = int(user_id)
-        uses = uses.filter(Use.user_id == user_id)
-
-    if machine_id and machine_id.isdigit():
-        machine_id = int(machine_id)
-        uses = uses.filter(Use.machine_id == machine_id)
-
-    if start_time:
-        uses = uses.filter(Use.start_timestamp >= start_time)
-
-    uses = uses.order_by(Use.start_timestamp.desc()).limit(500).all()
-
-    # Query the database to get all users and machines for the filter dropdowns
-    all_users = session.query(User).filter_by(deleted=False).all()
-    all_machines = session.query(Machine).all()
-
-    return render_template(
-        "view_uses.html",
-        uses=uses,
-        all_users=all_users,
-        all_machines=all_machines,
-        selected_user_id=user_id,
-        selected_machine_id=machine_id,
-        selected_start_time=start_time,
-    )
+    with DBReadSession() as session:
+        user_id = request.args.get("user_id")
+        machine_id = request.args.get("machine_id")
+        start_time = request.args.get("start_time")
+
+        # Convert start_time to a datetime object
+        if start_time:
+            start_time = datetime.strptime(start_time, "%Y-%m-%dT%H:%M")
+
+        # Query the database to get the data
+        uses = session.query(Use)
+
+        if user_id and user_id.isdigit():
+            user_id = int(user_id)
+            uses = uses.filter(Use.user_id == user_id)
+
+        if machine_id and machine_id.isdigit():
+            machine_id = int(machine_id)
+            uses = uses.filter(Use.machine_id == machine_id)
+
+        if start_time:
+            uses = uses.filter(Use.start_timestamp >= start_time)
+
+        uses = uses.order_by(Use.start_timestamp.desc()).limit(500).all()
+
+        # Query the database to get all users and machines for the filter dropdowns
+        all_users = session.query(User).filter_by(deleted=False).all()
+        all_machines = session.query(Machine).all()
+
+        return render_template(
+            "view_uses.html",
+            uses=uses,
+            all_users=all_users,
+            all_machines=all_machines,
+            selected_user_id=user_id,
+            selected_machine_id=machine_id,
+            selected_start_time=start_time,
+        )
 
 
 @app.route("/add_use", methods=["GET"])
@@ -153,6 +154,7 @@ def add_use_post():
         machine.machine_hours += (end_timestamp - start_timestamp) / 3600.0
 
         session.add(new_use)
+        MaintenanceCounterRepository(session).rebuild(machine.machine_id)
         session.commit()
         flash(gettext("Registration added successfully."))
         return redirect(url_for("view_uses"))
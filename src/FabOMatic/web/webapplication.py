@@ -9,11 +9,12 @@ from time import time
 from flask import Flask, render_template, request, send_from_directory, g, session
 from flask_login import login_required
 from flask_babel import gettext
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from FabOMatic.database.models import Base
+from FabOMatic.database.engines import engine_factory
+from FabOMatic.database.heartbeats import use_heartbeats
 from FabOMatic.conf import FabConfig
-from FabOMatic.database.repositories import MachineRepository
+from FabOMatic.database.repositories import READ_ONLY, MachineRepository, MaintenanceCounterRepository
 from flask_babel import Babel
 import flask_excel as excel
 
@@ -26,9 +27,13 @@ ALLOWED_EXTENSIONS = {"txt", "pdf", "docx"}
 app = Flask(__name__, template_folder=FLASK_TEMPLATES_FOLDER, static_folder=FLASK_STATIC_FOLDER)
 app.config["SECRET_KEY"] = FabConfig.getSetting("web", "secret_key")
 
-engine = create_engine(FabConfig.getDatabaseUrl(), echo=False)
+# Same engine and connection pool as the MQTT backend of the process
+engine = engine_factory.getEngine(FabConfig.getDatabaseUrl(), FabConfig.loadSubSettings("database"))
 Base.metadata.bind = engine
 DBSession = sessionmaker(bind=engine)
+# Listing pages read through a read-only engine, their long reads do not compete with the writers
+read_engine = engine_factory.getReadEngine(FabConfig.getDatabaseUrl(), FabConfig.loadSubSettings("database"))
+DBReadSession = sessionmaker(bind=read_engine, autoflush=False, info={READ_ONLY: True})
 
 # Init various extensions
 
@@ -113,6 +118,16 @@ def format_hours(value):
     return f"{hours} {hour_text} {minutes} {minutes_text}"
 
 
+@app.template_filter("use_last_seen")
+def use_last_seen(use):
+    """Last heartbeat of a use, including the ones buffered by the backend and not yet written."""
+    return last_seen_of(use)
+
+
+def last_seen_of(use) -> float:
+    return use_heartbeats.lastSeen(use.use_id, use.last_seen)
+
+
 @app.template_filter("time_since")
 def time_since(dt):
     now = datetime.now()
@@ -162,9 +177,13 @@ def index():
 
 @app.route("/about")
 def about():
-    with DBSession() as session:
-        machine_repo = MachineRepository(session)
-        machines = machine_repo.get_all()
+    with DBReadSession() as session:
+        machines = MachineRepository(session).get_all()
+        expired = {
+            status.maintenance.machine_id
+            for status in MaintenanceCounterRepository(session).getMaintenanceStatus()
+            if status.expired
+        }
         for mac in machines:
-            setattr(mac, "maintenance_needed", machine_repo.getMachineMaintenanceNeeded(mac.machine_id)[0])
+            setattr(mac, "maintenance_needed", mac.machine_id in expired)
         return render_template("about.html", machines=machines)
@@ -7,21 +7,29 @@ import unittest
 from random import randint
 from string import ascii_uppercase
 from time import time
+from unittest.mock import patch
 
+from sqlalchemy import Engine, event, text
 from sqlalchemy.exc import IntegrityError
 
+from FabOMatic.conf import FabConfig
 from FabOMatic.database.DatabaseBackend import DatabaseBackend
+from FabOMatic.database.heartbeats import use_heartbeats
+from FabOMatic.database.liveness import machine_liveness
+from FabOMatic.database.notifications import changes_notifier
 from FabOMatic.database.models import (
     Role,
     MachineType,
     User,
     Machine,
     Maintenance,
+    MaintenanceCounter,
     Authorization,
     Use,
     Intervention,
 )
-from tests.common import get_empty_test_db, get_simple_db, configure_logger
+from FabOMatic.database.repositories import MaintenanceCounterRepository
+from tests.common import add_test_data, get_empty_test_db, get_simple_db, configure_logger
 
 
 def random_string(length=16):
@@ -802,6 +810,352 @@ class TestDB(unittest.TestCase):
             for board in board_repo.get_all():
                 self.assertAlmostEqual(board.last_seen, time(), delta=1000)
 
+    def test_machine_liveness(self):
+        simple_db = get_simple_db()
+        with simple_db.getSession() as session:
+            machine_repo = simple_db.getMachineRepository(session)
+            mac = machine_repo.get_all()[0]
+            mac.last_seen = None
+            machine_repo.update(mac)
+            self.assertFalse(mac.isOnline(), "Machine never seen is online")
+
+            now = time()
+            machine_liveness.touch(mac.machine_id, now)
+            self.assertTrue(mac.isOnline(), "In-memory liveness ignored")
+            self.assertEqual(mac.lastSeen(), now)
+            self.assertIsNone(mac.last_seen, "last_seen written before flush")
+            self.assertGreaterEqual(machine_liveness.activeCount(90), 1)
+            self.assertEqual(machine_liveness.activeCount(-1), 0, "Machine seen in the future")
+
+            self.assertEqual(simple_db.flushMachinesLastSeen(force=True), 1, "Flush failed")
+            self.assertEqual(simple_db.flushMachinesLastSeen(force=True), 0, "Nothing left to flush")
+            session.refresh(mac)
+            self.assertAlmostEqual(mac.last_seen, now, 3, "last_seen not written")
+
+            # Stored value is newer
+            mac.last_seen = now + 10
+            machine_repo.update(mac)
+            self.assertEqual(mac.lastSeen(), now + 10)
+            machine_liveness.touch(mac.machine_id, now + 5)
+            self.assertEqual(simple_db.flushMachinesLastSeen(force=True), 0, "Older timestamp written")
+
+            use_heartbeats.touch(1, time())
+            simple_db.dropContents()
+            self.assertIsNone(machine_liveness.lastSeen(mac.machine_id, None), "Liveness not cleared")
+            self.assertEqual(use_heartbeats.pending(), {}, "Heartbeats of the previous uses kept")
+
+    def test_authorization_index(self):
+        simple_db = get_simple_db()
+        index = simple_db.getAuthorizationIndex()
+        with simple_db.getSession() as session:
+            user_repo = simple_db.getUserRepository(session)
+            mac = simple_db.getMachineRepository(session).get_all()[0]
+            mac.machine_type.access_management = MachineType.MANAGEMENT_WITH_AUTHORIZATION
+            simple_db.getMachineTypeRepository(session).update(mac.machine_type)
+            user = user_repo.get_all()[0]
+            user.role.authorize_all = False
+            simple_db.getRoleRepository(session).update(user.role)
+            user.card_UUID = "CAFE0001"
+            user_repo.update(user)
+
+            index.load()
+            for auth in session.query(Authorization).filter_by(user_id=user.user_id).all():
+                session.delete(auth)
+            session.commit()
+            indexed = index.userByCard("CAFE0001")
+            self.assertEqual(indexed.user_id, user.user_id)
+            self.assertEqual(
+                index.isAuthorized(mac.machine_id, indexed), user_repo.IsUserAuthorizedForMachine(mac, user)
+            )
+            self.assertFalse(index.isAuthorized(mac.machine_id, indexed), "Authorization not removed")
+
+            # Refreshed on commit only
+            simple_db.getAuthorizationRepository(session).create(
+                Authorization(user_id=user.user_id, machine_id=mac.machine_id)
+            )
+            self.assertTrue(index.isAuthorized(mac.machine_id, indexed), "Authorization not added")
+            user.card_UUID = "CAFE0002"
+            session.flush()
+            session.rollback()
+            self.assertIsNotNone(index.userByCard("CAFE0001"), "Index changed by a rollback")
+
+            # Expired object, only the changed attribute is known
+            user = user_repo.get_by_id(indexed.user_id)
+            session.commit()
+            user.card_UUID = "CAFE0002"
+            session.commit()
+            self.assertIsNone(index.userByCard("CAFE0001"), "Previous card still indexed")
+            self.assertEqual(index.userByCard("CAFE0002").user_id, user.user_id)
+
+            mac.blocked = True
+            session.commit()
+            self.assertFalse(index.isAuthorized(mac.machine_id, index.userByCard("CAFE0002")), "Machine not blocked")
+
+            # Changes of other processes are seen at the next refresh of the caches
+            with simple_db.getEngine().begin() as connection:
+                connection.execute(text("UPDATE users SET card_UUID = 'CAFE0003' WHERE card_UUID = 'CAFE0002'"))
+            self.assertIsNotNone(index.userByCard("CAFE0002"))
+            self.assertFalse(simple_db.refreshCaches(), "Refreshed before the interval")
+            self.assertTrue(simple_db.refreshCaches(force=True))
+            self.assertIsNone(index.userByCard("CAFE0002"), "External change not seen")
+            self.assertEqual(index.userByCard("CAFE0003").user_id, user.user_id)
+
+            simple_db.dropContents()
+            self.assertIsNone(index.userByCard("CAFE0003"), "Index not reset")
+
+    def test_authorized_cards_query(self):
+        # Random databases, the single query must give the same cards as IsUserAuthorizedForMachine
+        for seed in range(5):
+            rnd = random.Random(seed)
+            empty_db = get_empty_test_db()
+            with empty_db.getSession() as session:
+                types = [MachineType(type_name=f"type {i}", access_management=rnd.choice([0, 1])) for i in range(3)]
+                roles = [
+                    Role(role_name=f"role {i}", authorize_all=rnd.random() < 0.2, maintenance=rnd.random() < 0.5)
+                    for i in range(4)
+                ]
+                session.add_all(types + roles)
+                session.flush()
+                machines = [
+                    Machine(
+                        machine_name=f"machine {i}",
+                        machine_type_id=rnd.choice(types).type_id,
+                        blocked=rnd.random() < 0.3,
+                    )
+                    for i in range(6)
+                ]
+                users = [
+                    User(
+                        name=f"name {i}",
+                        surname=f"surname {i}",
+                        role_id=rnd.choice(roles).role_id,
+                        card_UUID="" if i == 0 else rnd.choice([None, f"CARD{i:04d}", f"CARD{i:04d}"]),
+                        disabled=rnd.random() < 0.2,
+                        deleted=rnd.random() < 0.2,
+                    )
+                    for i in range(40)
+                ]
+                session.add_all(machines + users)
+                session.flush()
+                for user in users:
+                    for machine in rnd.sample(machines, rnd.randint(0, len(machines))):
+                        session.add(Authorization(user_id=user.user_id, machine_id=machine.machine_id))
+                session.commit()
+
+                user_repo = empty_db.getUserRepository(session)
+                for machine in machines:
+                    expected = [
+                        (user.card_UUID, user.role.authorize_all)
+                        for user in user_repo.get_all()
+                        if user.card_UUID and user_repo.IsUserAuthorizedForMachine(machine, user)
+                    ]
+                    self.assertEqual(user_repo.getAuthorizedCards(machine.machine_id), expected, f"Seed {seed}")
+                self.assertEqual(user_repo.getAuthorizedCards(-1), [], "Unknown machine")
+
+    def test_use_time_aggregates(self):
+        # Random uses and interventions, the SQL sums must match the durations summed in Python
+        rnd = random.Random(0)
+        simple_db = get_simple_db()
+        with simple_db.getSession() as session:
+            machines = simple_db.getMachineRepository(session).get_all()[:3]
+            users = simple_db.getUserRepository(session).get_all()[:4]
+            maintenance = Maintenance(hours_between=10, description="test", machine_id=machines[0].machine_id)
+            other = Maintenance(hours_between=20, description="other", machine_id=machines[0].machine_id)
+            session.add_all([maintenance, other])
+            session.flush()
+            now = time()
+            for _ in range(200):
+                start = now - rnd.uniform(0, 100000)
+                end = start + rnd.randint(1, 3600) if rnd.random() > 0.1 else None
+                session.add(
+                    Use(
+                        user_id=rnd.choice(users).user_id,
+                        machine_id=rnd.choice(machines).machine_id,
+                        start_timestamp=start,
+                        last_seen=start if end is None else end,
+                        end_timestamp=end,
+                    )
+                )
+            for timestamp in (now - 80000, now - 50000):
+                session.add(
+                    Intervention(
+                        maintenance_id=maintenance.maintenance_id,
+                        machine_id=machines[0].machine_id,
+                        user_id=users[0].user_id,
+                        timestamp=timestamp,
+                    )
+                )
+            # Intervention of another maintenance, only resets the relative use time of the machine
+            session.add(
+                Intervention(
+                    maintenance_id=other.maintenance_id,
+                    machine_id=machines[0].machine_id,
+                    user_id=users[0].user_id,
+                    timestamp=now - 20000,
+                )
+            )
+            session.commit()
+
+            def expected(uses, after=0):
+                closed = [u for u in uses if u.end_timestamp is not None and u.start_timestamp > after]
+                return sum(u.end_timestamp - u.start_timestamp for u in closed)
+
+            mac_repo = simple_db.getMachineRepository(session)
+            user_repo = simple_db.getUserRepository(session)
+            all_uses = simple_db.getUseRepository(session).get_all()
+            for machine in machines:
+                uses = [u for u in all_uses if u.machine_id == machine.machine_id]
+                self.assertAlmostEqual(mac_repo.getTotalUseTime(machine.machine_id), expected(uses), 3)
+                last = max([i.timestamp for i in machine.interventions], default=0)
+                self.assertAlmostEqual(mac_repo.getRelativeUseTime(machine.machine_id), expected(uses, last), 3)
+                self.assertAlmostEqual(
+                    mac_repo.getRelativeUseTimeByMaintenance(machine.machine_id, maintenance),
+                    expected(uses, now - 50000 if machine == machines[0] else 0),
+                    3,
+                )
+            for user in users:
+                uses = [u for u in all_uses if u.user_id == user.user_id]
+                self.assertAlmostEqual(user_repo.getUserTotalTime(user.user_id), expected(uses), 3)
+            self.assertEqual(user_repo.getUserTotalTime(-1), 0, "No use")
+
+    def test_maintenance_counters(self):
+        simple_db = get_simple_db()
+        with simple_db.getSession() as session:
+            counter_repo = simple_db.getMaintenanceCounterRepository(session)
+            mac_repo = simple_db.getMachineRepository(session)
+            use_repo = simple_db.getUseRepository(session)
+            user = simple_db.getUserRepository(session).get_by_id(1)
+            machine = mac_repo.get_by_id(1)
+            maintenance = Maintenance(hours_between=0.5, description="counted", machine_id=machine.machine_id)
+            session.add(maintenance)
+            session.commit()
+
+            def assertConsistent():
+                counters = counter_repo.getCounters(machine.machine_id)
+                self.assertEqual(len(counters), len(machine.maintenances))
+                for maint in machine.maintenances:
+                    self.assertAlmostEqual(
+                        counters[maint.maintenance_id],
+                        mac_repo.getRelativeUseTimeByMaintenance(machine.machine_id, maint),
+                        3,
+                    )
+                return counters
+
+            # Missing counters are computed on first use
+            self.assertEqual(assertConsistent()[maintenance.maintenance_id], 0)
+
+            now = time()
+            for start in (now - 5000, now - 3000):
+                self.assertTrue(use_repo.startUse(machine.machine_id, user, start))
+                use_repo.endUse(machine.machine_id, user, 1000, False)
+            # Use closed without startUse
+            use_repo.endUse(machine.machine_id, user, 1000, False)
+            self.assertAlmostEqual(assertConsistent()[maintenance.maintenance_id], 3000, 3)
+            self.assertTrue(mac_repo.getMachineMaintenanceNeeded(machine.machine_id)[0])
+
+            # Interventions reset the counters
+            simple_db.getInterventionRepository(session).registerInterventionsDone(machine.machine_id, user.user_id)
+            self.assertEqual(assertConsistent()[maintenance.maintenance_id], 0)
+            self.assertFalse(mac_repo.getMachineMaintenanceNeeded(machine.machine_id)[0])
+
+            # Interventions edited outside of the repository are detected
+            intervention = session.query(Intervention).filter_by(maintenance_id=maintenance.maintenance_id).one()
+            session.delete(intervention)
+            session.commit()
+            self.assertAlmostEqual(assertConsistent()[maintenance.maintenance_id], 3000, 3)
+
+            # Uses edited outside of the repository require a rebuild
+            session.delete(session.query(Use).filter_by(machine_id=machine.machine_id).first())
+            session.commit()
+            counters = counter_repo.getCounters(machine.machine_id)
+            self.assertNotAlmostEqual(counters[maintenance.maintenance_id], 2000, 3)
+            self.assertEqual(counter_repo.rebuild(), len(simple_db.getMaintenanceRepository(session).get_all()))
+            self.assertAlmostEqual(assertConsistent()[maintenance.maintenance_id], 2000, 3)
+
+            # Counters are deleted with their maintenance
+            session.delete(maintenance)
+            session.commit()
+            counters = session.query(MaintenanceCounter).filter_by(maintenance_id=maintenance.maintenance_id)
+            self.assertEqual(counters.count(), 0)
+
+    def test_maintenance_status(self):
+        simple_db = add_test_data(get_simple_db(), 200)
+        with simple_db.getSession() as session:
+            counter_repo = simple_db.getMaintenanceCounterRepository(session)
+            mac_repo = simple_db.getMachineRepository(session)
+            use_repo = simple_db.getUseRepository(session)
+            user = simple_db.getUserRepository(session).get_by_id(1)
+            maintenances = simple_db.getMaintenanceRepository(session).get_all()
+            for maintenance in maintenances:
+                maintenance.hours_between = 0.1 if maintenance.maintenance_id % 2 else 1000
+            session.commit()
+            # One use since the last interventions on each machine
+            for machine in mac_repo.get_all():
+                self.assertTrue(use_repo.startUse(machine.machine_id, user, time() - 600))
+                use_repo.endUse(machine.machine_id, user, 600, False)
+
+            statuses = counter_repo.getMaintenanceStatus()
+            self.assertEqual(len(statuses), len(maintenances), "One status per maintenance")
+            self.assertTrue(any(status.expired for status in statuses))
+            self.assertFalse(all(status.expired for status in statuses))
+            for status in statuses:
+                maintenance = status.maintenance
+                elapsed_s = mac_repo.getRelativeUseTimeByMaintenance(maintenance.machine_id, maintenance)
+                self.assertAlmostEqual(status.elapsed_s, elapsed_s, 3)
+                self.assertEqual(status.expired, elapsed_s > maintenance.hours_between * 3600.0)
+                self.assertAlmostEqual(status.overdue_h, elapsed_s / 3600.0 - maintenance.hours_between, 3)
+
+            # Counters are up to date, the status is read in one statement
+            statements = []
+
+            def capture(conn, cursor, statement, parameters, context, executemany):
+                statements.append(statement)
+
+            event.listen(Engine, "before_cursor_execute", capture)
+            try:
+                counter_repo.getMaintenanceStatus()
+            finally:
+                event.remove(Engine, "before_cursor_execute", capture)
+            self.assertEqual(len(statements), 1, statements)
+
+            machine_id = statuses[0].maintenance.machine_id
+            self.assertEqual(
+                [s.maintenance.maintenance_id for s in counter_repo.getMaintenanceStatus(machine_id)],
+                [s.maintenance.maintenance_id for s in statuses if s.maintenance.machine_id == machine_id],
+            )
+
+    def test_maintenance_status_rebuild(self):
+        simple_db = add_test_data(get_simple_db(), 10)
+        with simple_db.getSession() as session:
+            counter_repo = simple_db.getMaintenanceCounterRepository(session)
+            expected = [status.elapsed_s for status in counter_repo.getMaintenanceStatus()]
+            session.query(MaintenanceCounter).delete()
+            session.commit()
+
+            # Another worker stored the missing counters first
+            role = session.query(Role).first()
+            role.role_name = "pending"
+            conflict = IntegrityError("INSERT INTO maintenance_counters", {}, Exception("UNIQUE constraint failed"))
+            with patch.object(MaintenanceCounterRepository, "_rebuild", side_effect=conflict):
+                self.assertEqual([status.elapsed_s for status in counter_repo.getMaintenanceStatus()], expected)
+            self.assertEqual(role.role_name, "pending", "Session rolled back")
+            self.assertEqual(session.query(MaintenanceCounter).count(), 0)
+
+            # The counters are rebuilt without committing the work of the caller, nor notifying it
+            notified = []
+
+            def onChanges(changes):
+                notified.append(changes)
+
+            changes_notifier.subscribe(FabConfig.getDatabaseUrl(), onChanges)
+            self.assertEqual([status.elapsed_s for status in counter_repo.getMaintenanceStatus()], expected)
+            self.assertEqual(session.query(MaintenanceCounter).count(), len(expected))
+            session.rollback()
+            self.assertEqual(notified, [], "Changes notified before their commit")
+
+        with simple_db.getSession() as session:
+            self.assertEqual(session.query(Role).filter_by(role_name="pending").count(), 0, "Committed by a read")
+
     def test_orphans(self):
         simple_db = get_simple_db()
         simple_db.closeOrphans()
@@ -0,0 +1,138 @@
+""" Test the engines shared by the backend and the web application. """
+
+# pylint: disable=missing-function-docstring,missing-class-docstring,missing-module-docstring
+
+import os
+import tempfile
+import threading
+import unittest
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import sessionmaker
+
+from FabOMatic.conf import FabConfig
+from FabOMatic.database.DatabaseBackend import DatabaseBackend
+from FabOMatic.database.engines import EngineFactory, MeteredQueuePool, PoolSettings, engine_factory
+from FabOMatic.database.models import MaintenanceCounter
+from FabOMatic.database.repositories import READ_ONLY, MaintenanceCounterRepository
+from tests.common import add_test_data, get_simple_db
+
+
+class TestEngines(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self.url = "sqlite:///" + os.path.join(self._folder.name, "pool.sqldb")
+
+    def tearDown(self):
+        self._folder.cleanup()
+
+    def test_settings(self):
+        self.assertEqual(PoolSettings.fromSettings(None), PoolSettings())
+        self.assertEqual(PoolSettings.fromSettings({"size": 2, "timeout_s": 0.5}).size, 2)
+        for settings in ({"size": 0}, {"max_overflow": -1}, {"timeout_s": "long"}, {"size": True}, {"unknown": 1}):
+            with self.subTest(settings=settings):
+                with self.assertRaises(ValueError):
+                    PoolSettings.fromSettings(settings)
+
+    def test_shared_engine(self):
+        db = DatabaseBackend()
+        other = DatabaseBackend()
+        self.assertIs(db.getEngine(), other.getEngine())
+        self.assertIs(db.getEngine(), engine_factory.getEngine(FabConfig.getDatabaseUrl()))
+
+        from FabOMatic.web.webapplication import DBSession, engine
+
+        self.assertIs(engine, db.getEngine(), "Web application has its own pool")
+        self.assertIs(DBSession.kw["bind"], db.getEngine())
+
+        db = get_simple_db()
+        with db.getSession() as session:
+            session.execute(text("SELECT 1"))
+        stats = db.poolStats()
+        self.assertGreater(stats["checkouts"], 0)
+        self.assertEqual(stats["in_use"], 0)
+
+    def test_pool_metrics(self):
+        factory = EngineFactory()
+        engine = factory.getEngine(self.url, {"pool": {"size": 1, "max_overflow": 1, "timeout_s": 0.2}})
+        self.assertIs(factory.getEngine(self.url), engine)
+        self.assertIsInstance(engine.pool, MeteredQueuePool)
+        self.assertEqual(factory.stats("sqlite:///other.sqldb"), {})
+
+        first = engine.connect()
+        second = engine.connect()
+        stats = factory.stats(self.url)
+        self.assertEqual((stats["size"], stats["max_overflow"]), (1, 1))
+        self.assertEqual((stats["in_use"], stats["in_use_max"], stats["checkouts"]), (2, 2, 2))
+
+        with self.assertRaises(PoolTimeoutError):
+            engine.connect()
+        stats = factory.stats(self.url)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(len(stats["wait_ms"]), 3)
+
+        # A connection returned in time is handed to the waiting thread
+        threading.Timer(0.05, second.close).start()
+        third = engine.connect()
+        stats = factory.stats(self.url)
+        self.assertGreaterEqual(stats["wait_ms"][2], 40)
+        third.close()
+        first.close()
+
+        engine.dispose()
+        stats = factory.stats(self.url)
+        self.assertEqual((stats["in_use"], stats["checkouts"], stats["timeouts"]), (0, 3, 1), "Metrics lost")
+
+    def test_memory_database(self):
+        factory = EngineFactory()
+        engine = factory.getEngine("sqlite://")
+        self.assertNotIsInstance(engine.pool, MeteredQueuePool)
+        self.assertEqual(factory.stats("sqlite://"), {})
+        self.assertIs(factory.getReadEngine("sqlite://"), engine)
+
+    def test_read_engine(self):
+        url = "sqlite:///" + os.path.join(self._folder.name, "read only.sqldb")
+        factory = EngineFactory()
+        engine = factory.getEngine(url)
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE t (v INTEGER)"))
+            connection.execute(text("INSERT INTO t VALUES (1)"))
+
+        read_engine = factory.getReadEngine(url)
+        self.assertIsNot(read_engine, engine)
+        self.assertIs(factory.getReadEngine(url), read_engine)
+        with read_engine.connect() as connection:
+            self.assertEqual(connection.exec_driver_sql("PRAGMA query_only").scalar(), 1)
+            self.assertEqual(connection.execute(text("SELECT COUNT(*) FROM t")).scalar(), 1)
+            with self.assertRaises(OperationalError):
+                connection.execute(text("INSERT INTO t VALUES (2)"))
+            connection.rollback()
+
+            # Writes of the other engine are read by the next transactions
+            with engine.begin() as writer:
+                writer.execute(text("INSERT INTO t VALUES (3)"))
+            self.assertEqual(connection.execute(text("SELECT COUNT(*) FROM t")).scalar(), 2)
+        self.assertEqual(factory.stats(url, read_only=True)["checkouts"], 1)
+        self.assertEqual(factory.stats(url)["checkouts"], 2)
+        factory.dispose(url)
+
+    def test_read_sessions(self):
+        db = add_test_data(get_simple_db(), 10)
+        read_session = sessionmaker(
+            bind=engine_factory.getReadEngine(FabConfig.getDatabaseUrl()), info={READ_ONLY: True}
+        )
+        with db.getSession() as session:
+            expected = [s.elapsed_s for s in MaintenanceCounterRepository(session).getMaintenanceStatus()]
+            session.query(MaintenanceCounter).delete()
+            session.commit()
+
+        with read_session() as session:
+            statuses = MaintenanceCounterRepository(session).getMaintenanceStatus()
+            self.assertEqual([status.elapsed_s for status in statuses], expected)
+            self.assertEqual(session.query(MaintenanceCounter).count(), 0, "Counters rebuilt by a read session")
+
+
+if __name__ == "__main__":
+    unittest.main()
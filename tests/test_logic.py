@@ -1,6 +1,12 @@
+import json
 from time import time
 import unittest
-from FabOMatic.database.models import Authorization, MachineType, Use
+from unittest.mock import Mock
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from FabOMatic.database.models import Authorization, Intervention, MachineType, Use
 
 from FabOMatic.mqtt.mqtt_types import (
     UserQuery,
@@ -10,11 +16,16 @@ from FabOMatic.mqtt.mqtt_types import (
     EndUseQuery,
     RegisterMaintenanceQuery,
     InUseQuery,
+    SyncCacheQuery,
+    BatchQuery,
 )
 
 from FabOMatic.mqtt.MQTTInterface import MQTTInterface
 from FabOMatic.logic.MsgMapper import MsgMapper
 from FabOMatic.logic.MachineLogic import MachineLogic
+from FabOMatic.database.heartbeats import use_heartbeats
+from FabOMatic.logic.IdempotencyCache import IdempotencyCache
+from FabOMatic.web.webapplication import last_seen_of
 from tests.common import get_simple_db, configure_logger
 
 
@@ -150,6 +161,62 @@ class TestLogic(unittest.TestCase):
 
                 self.assertAlmostEqual(expected_hours, mac.machine_hours, None, "Total hours not updated", 0.01)
 
+    def test_heartbeats_write_behind(self):
+        db = get_simple_db()
+        with db.getSession() as session:
+            MachineLogic.database = db
+            use_heartbeats.flush_interval_s = 3600
+            MachineLogic.heartbeats = use_heartbeats
+            try:
+                mac = db.getMachineRepository(session).get_all()[0]
+                user = db.getUserRepository(session).get_all()[0]
+                user.card_UUID = "1234"
+                db.getUserRepository(session).update(user)
+                use_repo = db.getUseRepository(session)
+                for use in use_repo.get_all():
+                    use_repo.delete(use)
+
+                ml = MachineLogic(mac.machine_id)
+                # First heartbeat without startUse creates the record immediately
+                self.assertTrue(ml.inUse("1234", 10).request_ok, "inUse failed")
+                usage = use_repo.getOpenUse(mac.machine_id)
+                self.assertIsNotNone(usage, "Usage not created")
+                self.assertEqual(len(MachineLogic.heartbeats.pending()), 0, "First heartbeat must not be buffered")
+
+                # Next heartbeats are only buffered
+                usage.last_seen = time() - 100
+                session.commit()
+                for d in range(5):
+                    self.assertTrue(ml.inUse("1234", 20 + d).request_ok, "inUse failed")
+                pending = MachineLogic.heartbeats.pending()
+                self.assertEqual(list(pending.keys()), [usage.use_id], "Heartbeats not coalesced")
+                session.refresh(usage)
+                self.assertLess(usage.last_seen, time() - 50, "Heartbeat written before flush")
+                self.assertAlmostEqual(MachineLogic.heartbeats.lastSeen(usage.use_id, usage.last_seen), time(), 0)
+                self.assertAlmostEqual(last_seen_of(usage), time(), 0, "Web pages do not see the buffer")
+
+                # Interval not elapsed
+                self.assertEqual(MachineLogic.heartbeats.flush(db), 0, "Flush before interval")
+                self.assertEqual(MachineLogic.heartbeats.flush(db, force=True), 1, "Forced flush failed")
+                self.assertEqual(len(MachineLogic.heartbeats.pending()), 0, "Buffer not emptied")
+                session.refresh(usage)
+                self.assertAlmostEqual(usage.last_seen, pending[usage.use_id], 3, "last_seen not written")
+
+                # An older timestamp never overwrites a newer one
+                self.assertEqual(use_repo.updateLastSeen({usage.use_id: usage.last_seen - 10}), 0)
+
+                # Orphan detection takes buffered heartbeats into account
+                usage.last_seen = time() - 7200
+                session.commit()
+                db.closeOrphans({usage.use_id: time()})
+                session.refresh(usage)
+                self.assertIsNone(usage.end_timestamp, "Use closed despite recent heartbeat")
+                db.closeOrphans()
+                session.refresh(usage)
+                self.assertIsNotNone(usage.end_timestamp, "Orphan use not closed")
+            finally:
+                MachineLogic.heartbeats = None
+
     def test_machine_logic(self):
         db = get_simple_db()
         with db.getSession() as session:
@@ -250,6 +317,229 @@ class TestLogic(unittest.TestCase):
         query = RegisterMaintenanceQuery("DEADBEEF", True)
         self.assertTrue(mapper.messageReceived("1", query), "Message not processed")
 
+    def test_commits_per_message(self):
+        db = get_simple_db()
+        with db.getSession() as session:
+            user = db.getUserRepository(session).get_all()[0]
+            user.card_UUID = "1234"
+            db.getUserRepository(session).update(user)
+            mac_id = db.getMachineRepository(session).get_all()[0].machine_id
+
+        events = []
+
+        def on_commit(session):
+            # Savepoints released by the lazy maintenance counters rebuild are not commits
+            if not session.in_nested_transaction():
+                events.append("commit")
+
+        mqtt = Mock()
+        mqtt.publishReply.side_effect = lambda *_: events.append("reply") or True
+        mapper = MsgMapper(mqtt, db)
+        mapper.registerHandlers()
+
+        queries = [
+            UserQuery("1234"),
+            MachineQuery(),
+            AliveQuery("0.1.32", "127.0.0.1", "SN0", 1000),
+            StartUseQuery("1234", False),
+            InUseQuery("1234", 10),
+            InUseQuery("1234", 20),
+            EndUseQuery("1234", 30, False),
+            EndUseQuery("1234", 30, False),
+            RegisterMaintenanceQuery("1234", False),
+            UserQuery("DEADBEEF"),
+            SyncCacheQuery(),
+        ]
+        event.listen(Session, "after_commit", on_commit)
+        try:
+            for query in queries:
+                events.clear()
+                mapper.messageReceived(mac_id, query)
+                self.assertEqual(events.count("commit"), 1, f"Wrong number of commits for {query.toJSON()}")
+                self.assertEqual(events[0], "commit", f"Reply published before commit for {query.toJSON()}")
+        finally:
+            event.remove(Session, "after_commit", on_commit)
+            MachineLogic.heartbeats = None
+
+        with db.getSession() as session:
+            use_repo = db.getUseRepository(session)
+            self.assertGreater(len([u for u in use_repo.get_all() if u.machine_id == mac_id]), 0, "Use not recorded")
+            self.assertIsNone(use_repo.getOpenUse(mac_id), "Use not closed")
+
+    def test_batch_replay(self):
+        db = get_simple_db()
+        with db.getSession() as session:
+            user = db.getUserRepository(session).get_all()[0]
+            user.card_UUID = "1234"
+            db.getUserRepository(session).update(user)
+            mac_id = db.getMachineRepository(session).get_all()[0].machine_id
+            use_repo = db.getUseRepository(session)
+            for use in use_repo.get_all():
+                use_repo.delete(use)
+
+        mqtt = Mock()
+        mqtt.publishReply.return_value = True
+        mapper = MsgMapper(mqtt, db)
+        mapper.registerHandlers()
+
+        commits = []
+
+        def on_commit(session):
+            if not session.in_nested_transaction():
+                commits.append(1)
+
+        batch = BatchQuery(
+            [
+                StartUseQuery("1234", True),
+                EndUseQuery("1234", 60, True),
+                StartUseQuery("DEADBEEF", True),
+                RegisterMaintenanceQuery("1234", True),
+            ]
+        )
+        event.listen(Session, "after_commit", on_commit)
+        try:
+            self.assertTrue(mapper.messageReceived(mac_id, batch), "Batch not processed")
+        finally:
+            event.remove(Session, "after_commit", on_commit)
+            MachineLogic.heartbeats = None
+
+        self.assertEqual(len(commits), 1, "Batch not applied in one transaction")
+        reply = json.loads(mqtt.publishReply.call_args[0][1])
+        self.assertEqual(reply, {"request_ok": True, "results": [True, True, False, True]})
+
+        with db.getSession() as session:
+            uses = [u for u in db.getUseRepository(session).get_all() if u.machine_id == mac_id]
+            self.assertEqual(len(uses), 1, "Replayed use not recorded")
+            self.assertTrue(uses[0].replay, "Use not flagged as replay")
+            self.assertAlmostEqual(uses[0].end_timestamp - uses[0].start_timestamp, 60, 0)
+
+    def test_duplicate_events(self):
+        replies = IdempotencyCache(capacity=2, window_s=60)
+        for query in (StartUseQuery("1234"), EndUseQuery("1234", 30), RegisterMaintenanceQuery("1234")):
+            self.assertIsNone(replies.keyOf(1, query, False), "Live events can be repeated")
+        self.assertIsNone(replies.keyOf(1, InUseQuery("1234", 10), True))
+        key = replies.keyOf(1, EndUseQuery("1234", 30, True), True)
+        replies.put(key, "first", now=119)
+        self.assertEqual(replies.get(replies.keyOf(1, EndUseQuery("1234", 30, True), True), now=121), "first")
+        self.assertIsNone(replies.get(replies.keyOf(1, EndUseQuery("1234", 31, True), True), now=121))
+        self.assertIsNone(replies.get(replies.keyOf(2, EndUseQuery("1234", 30, True), True), now=121))
+        self.assertIsNone(replies.get(key, now=179), "Expired")
+        replies.put(replies.keyOf(1, StartUseQuery("1234", True), True), "second", now=150)
+        self.assertIsNone(replies.get(key, now=151), "Only the last event of the machine is repeated")
+        replies.forget(1)
+        self.assertIsNone(replies.get(replies.keyOf(1, StartUseQuery("1234", True), True), now=151))
+        replies.put(key, "first", now=150)
+        replies.put(replies.keyOf(2, StartUseQuery("1", True), True), "third", now=150)
+        replies.put(replies.keyOf(3, StartUseQuery("2", True), True), "fourth", now=150)
+        self.assertIsNone(replies.get(key, now=151), "Least recently used machine not evicted")
+        self.assertEqual(replies.stats(), {"hits": 1, "misses": 6, "size": 2})
+
+        db = get_simple_db()
+        with db.getSession() as session:
+            user = db.getUserRepository(session).get_all()[0]
+            user.card_UUID = "1234"
+            db.getUserRepository(session).update(user)
+            mac_id, batch_mac_id = [m.machine_id for m in db.getMachineRepository(session).get_all()[:2]]
+            use_repo = db.getUseRepository(session)
+            for use in use_repo.get_all():
+                use_repo.delete(use)
+
+        mqtt = Mock()
+        mqtt.publishReply.return_value = True
+        mapper = MsgMapper(mqtt, db)
+        mapper.registerHandlers()
+
+        def uses(machine_id=mac_id):
+            with db.getSession() as session:
+                return [u for u in db.getUseRepository(session).get_all() if u.machine_id == machine_id]
+
+        try:
+            for query in [StartUseQuery("1234", True), EndUseQuery("1234", 60, True)]:
+                self.assertTrue(mapper.messageReceived(mac_id, query))
+                first_reply = mqtt.publishReply.call_args[0][1]
+                self.assertTrue(mapper.messageReceived(mac_id, query))
+                self.assertEqual(mqtt.publishReply.call_args[0][1], first_reply, "Duplicate not answered the same")
+            self.assertEqual(len(uses()), 1, "Duplicate events applied twice")
+            self.assertEqual(mapper.stats()["Duplicate events"], 2)
+
+            # A batch sent again after a lost reply
+            batch = BatchQuery([StartUseQuery("1234", True), EndUseQuery("1234", 120, True)])
+            self.assertTrue(mapper.messageReceived(batch_mac_id, batch))
+            self.assertTrue(mapper.messageReceived(batch_mac_id, batch))
+            reply = json.loads(mqtt.publishReply.call_args[0][1])
+            self.assertEqual(reply, {"request_ok": True, "results": [True, True]})
+            self.assertEqual(len(uses(batch_mac_id)), 1, "Duplicate batch applied twice")
+            self.assertEqual(mapper.stats()["Duplicate events"], 3)
+
+            # Identical uses, live or replayed, one by one or in a batch, are all applied
+            cycles = [
+                [StartUseQuery("1234"), EndUseQuery("1234", 5)] * 2,
+                [StartUseQuery("1234", True), EndUseQuery("1234", 5, True)] * 2,
+                [BatchQuery([StartUseQuery("1234", True), EndUseQuery("1234", 5, True)] * 2)],
+            ]
+            for queries in cycles:
+                with self.subTest(queries=[str(query) for query in queries]):
+                    before = len(uses())
+                    for query in queries:
+                        self.assertTrue(mapper.messageReceived(mac_id, query))
+                    self.assertEqual(len(uses()) - before, 2, "Repeated use not recorded")
+                    self.assertTrue(all(use.end_timestamp is not None for use in uses()), "Use left open")
+            self.assertEqual(mapper.stats()["Duplicate events"], 3)
+        finally:
+            MachineLogic.heartbeats = None
+
+    def test_machine_status_cache(self):
+        db = get_simple_db()
+        MachineLogic.database = db
+        cache = db.getMachineStatusCache()
+        with db.getSession() as session:
+            mac = db.getMachineRepository(session).get_all()[0]
+            user = db.getUserRepository(session).get_all()[0]
+            user.card_UUID = "1234"
+            db.getUserRepository(session).update(user)
+            ml = MachineLogic(mac.machine_id)
+
+            status = ml.machineStatus()
+            self.assertTrue(status.allowed, "Machine is not allowed")
+            self.assertIs(ml.machineStatus(), status, "Status not cached")
+            self.assertGreater(cache.stats()["hits"], 0, "Cache hit not counted")
+
+            # Changes rolled back do not invalidate
+            mac.blocked = True
+            session.flush()
+            session.rollback()
+            self.assertIs(ml.machineStatus(), status, "Status invalidated by a rollback")
+
+            # Committed change of the machine
+            mac.blocked = True
+            db.getMachineRepository(session).update(mac)
+            status = ml.machineStatus()
+            self.assertFalse(status.allowed, "Status not invalidated on machine change")
+            self.assertIs(ml.machineStatus(), status, "Status not cached")
+
+            # Uses only invalidate once closed
+            self.assertTrue(ml.startUse("1234", False).request_ok, "startUse failed")
+            self.assertIs(ml.machineStatus(), status, "Status invalidated by a use start")
+            self.assertTrue(ml.endUse("1234", 100, False).request_ok, "endUse failed")
+            self.assertIsNot(ml.machineStatus(), status, "Status not invalidated by a use end")
+
+            status = ml.machineStatus()
+            maintenance = db.getMaintenanceRepository(session).get_all()[0]
+            db.getInterventionRepository(session).create(
+                Intervention(
+                    machine_id=mac.machine_id,
+                    maintenance_id=maintenance.maintenance_id,
+                    user_id=user.user_id,
+                    timestamp=time(),
+                )
+            )
+            self.assertIsNot(ml.machineStatus(), status, "Status not invalidated by an intervention")
+
+            mac_id = mac.machine_id
+            status = ml.machineStatus()
+            db.dropContents()
+            self.assertIsNone(cache.get(mac_id), "Cache not reset with database contents")
+
     def test_machine_auth(self):
         db = get_simple_db()
         with db.getSession() as session:
@@ -9,6 +9,7 @@ import os
 import shutil
 
 from FabOMatic.database.DatabaseBackend import DatabaseBackend
+from FabOMatic.database import sqlite_profile
 from FabOMatic.conf import FabConfig
 from tests.common import get_empty_test_db, configure_logger
 
@@ -24,7 +25,8 @@ class TestMigrations(unittest.TestCase):
                 dest = dest[len("sqlite:///") :]
 
             self.assertTrue(os.path.exists(source))
-            # Overwrite any existing database with the previous version
+            # Overwrite any existing database with the previous version, without its write-ahead log
+            sqlite_profile.removeDatabaseFiles(dest)
             shutil.copyfile(source, dest)
 
             # Now check that the upgrade works
@@ -2,10 +2,18 @@
 
 # pylint: disable=missing-function-docstring,missing-class-docstring,missing-module-docstring
 
+import json
+import logging
+import threading
 import unittest
+from unittest.mock import patch
+
+from sqlalchemy.exc import OperationalError
 
 from FabOMatic.mqtt.mqtt_types import (
+    InUseQuery,
     MachineQuery,
+    Parser,
     MachineResponse,
     SimpleResponse,
     StartRequest,
@@ -16,9 +24,15 @@ from FabOMatic.mqtt.mqtt_types import (
     EndUseQuery,
     RegisterMaintenanceQuery,
     AliveQuery,
+    BatchQuery,
+    BatchResponse,
 )
 from FabOMatic.mqtt.MQTTInterface import MQTTInterface
+from FabOMatic.mqtt.MessageDispatcher import MessageDispatcher
+from FabOMatic.mqtt.transport import LoopbackBroker, LoopbackTransport, topicMatches
 from FabOMatic.logic.MsgMapper import MsgMapper
+from FabOMatic.statistics import RateCounter, RingBuffer, runtime_stats
+from FabOMatic.tracing import LatencyHistogram, Trace, activate, lap, request_tracer
 from tests.common import get_simple_db
 
 
@@ -61,6 +75,49 @@ class TestMQTT(unittest.TestCase):
         self.assertEqual(alive_query.action, "alive")
         self.assertEqual(alive_query.__class__, AliveQuery)
 
+    def test_parser(self):
+        query = Parser.parse(b'{"action": "checkuser", "uid": "1234567890"}')
+        self.assertEqual(query.__class__, UserQuery)
+        self.assertEqual(query.uid, "1234567890")
+
+        query = Parser.parse('{"action": "inuse", "uid": "1234", "duration": 12}')
+        self.assertEqual(query.__class__, InUseQuery)
+        self.assertEqual(query.duration, 12)
+
+        query = Parser.parse(b'{"action": "stopuse", "uid": "1234", "duration": 123}')
+        self.assertEqual(query.__class__, EndUseQuery)
+        self.assertFalse(query.replay)
+
+        query = Parser.parse(b'{"action": "alive", "ip": "1.2.3.4", "version": "1.2.3"}')
+        self.assertEqual(query.__class__, AliveQuery)
+        self.assertEqual(query.serial, "")
+        self.assertEqual(query.heap, 0)
+
+        query = Parser.parse(
+            b'{"action": "batch", "events": [{"action": "startuse", "uid": "1234", "replay": true},'
+            b' {"action": "stopuse", "uid": "1234", "duration": 12, "replay": true}]}'
+        )
+        self.assertEqual(query.__class__, BatchQuery)
+        self.assertEqual([e.__class__ for e in query.events], [StartUseQuery, EndUseQuery])
+        self.assertEqual(query.events[1].duration, 12)
+        self.assertEqual(BatchResponse(True, [True, False]).serialize(), '{"request_ok":true,"results":[true,false]}')
+
+        for invalid in [
+            b"not json",
+            b"[1, 2]",
+            b'{"uid": "1234"}',
+            b'{"action": "foo"}',
+            b'{"action": []}',
+            b'{"action": {"checkuser": 1}}',
+            b'{"action": "batch", "events": [{"action": []}]}',
+            b'{"action": "alive"}',
+            b'{"action": "batch"}',
+            b'{"action": "batch", "events": [{"action": "checkuser", "uid": "1234"}]}',
+            b'{"action": "batch", "events": [{"action": "stopuse", "uid": "1234"}]}',
+        ]:
+            with self.assertRaises(ValueError, msg=invalid):
+                Parser.parse(invalid)
+
     def test_json_serialize(self):
         response = UserResponse(True, True, "user name", 2, False)
         json_response = response.serialize()
@@ -89,6 +146,270 @@ class TestMQTT(unittest.TestCase):
         json_response = stop_req.serialize()
         self.assertEqual(json_response, '{"request_type": "stop", "uid": "6"}')
 
+    def test_message_slots(self):
+        query = StartUseQuery("1234", True)
+        with self.assertRaises(AttributeError):
+            query.other = 1
+        self.assertFalse(hasattr(query, "__dict__"))
+        self.assertEqual(query.asDict(), {"uid": "1234", "action": "startuse", "replay": True})
+        self.assertEqual(str(query), query.toJSON())
+        self.assertEqual(str(SimpleResponse(False, "é")), '{"request_ok": false, "message": "\\u00e9"}')
+        self.assertEqual(
+            BatchQuery([StartUseQuery("1"), EndUseQuery("2", 5)]).toJSON(),
+            '{"action":"batch","events":[{"action":"startuse","replay":false,"uid":"1"},'
+            + '{"action":"stopuse","duration":5,"replay":false,"uid":"2"}]}',
+        )
+
+        # Debug renderings are only built when the debug level is enabled
+        db = get_simple_db()
+        mapper = MsgMapper(MQTTInterface(), db)
+        with db.getSession() as session:
+            machine_logic = mapper.getMachineLogic(db.getMachineRepository(session).get_all()[0].machine_id)
+        with patch.object(UserQuery, "toJSON", autospec=True, return_value="{}") as to_json:
+            with self.assertLogs(level="INFO"):
+                mapper.handleUserQuery(machine_logic, UserQuery("1234"))
+                logging.info("At least one record")
+            self.assertEqual(to_json.call_count, 0)
+            with self.assertLogs(level="DEBUG"):
+                mapper.handleUserQuery(machine_logic, UserQuery("1234"))
+            self.assertEqual(to_json.call_count, 1)
+
+    def test_dispatcher_order(self):
+        received = []
+        lock = threading.Lock()
+
+        def callback(machine, query):
+            with lock:
+                received.append((machine, query.uid))
+
+        dispatcher = MessageDispatcher(callback, nb_workers=3, queue_size=100)
+        dispatcher.start()
+        for i in range(50):
+            for machine in range(1, 6):
+                self.assertTrue(dispatcher.submit(machine, UserQuery(str(i))))
+        dispatcher.stop()
+
+        self.assertEqual(len(received), 250)
+        for machine in range(1, 6):
+            uids = [uid for mac, uid in received if mac == machine]
+            self.assertEqual(uids, [str(i) for i in range(50)], "Messages of a machine must stay in order")
+        self.assertEqual(dispatcher.stats()["Queue depth"], 0)
+
+    def test_dispatcher_full(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def callback(machine, query):
+            started.set()
+            release.wait(5)
+
+        dispatcher = MessageDispatcher(callback, nb_workers=1, queue_size=1)
+        self.assertFalse(dispatcher.submit(1, MachineQuery()), "Workers are not started")
+        dispatcher.start()
+        self.assertTrue(dispatcher.submit(1, MachineQuery()))
+        self.assertTrue(started.wait(5))
+        self.assertTrue(dispatcher.submit(1, MachineQuery()))
+        self.assertFalse(dispatcher.submit(1, MachineQuery()), "Queue is full")
+        self.assertEqual(dispatcher.stats()["Queue depth"], 1)
+        release.set()
+        dispatcher.stop()
+        self.assertEqual(dispatcher.stats()["Dropped"], 2)
+
+    def test_dispatcher_priority(self):
+        started = threading.Event()
+        release = threading.Event()
+        received = []
+
+        def callback(machine, query):
+            received.append((machine, query.action, getattr(query, "duration", None)))
+            started.set()
+            release.wait(5)
+
+        dispatcher = MessageDispatcher(callback, nb_workers=1, queue_size=5)
+        dispatcher.start()
+        self.assertTrue(dispatcher.submit(1, MachineQuery()))
+        self.assertTrue(started.wait(5))
+
+        # Worker busy: heartbeats are merged, user actions go first except behind older messages of their machine
+        self.assertTrue(dispatcher.submit(2, AliveQuery("1.0", "1.2.3.4", "A", 1000)))
+        for duration in range(3):
+            self.assertTrue(dispatcher.submit(3, InUseQuery("1234", duration)))
+        self.assertTrue(dispatcher.submit(4, MachineQuery()))
+        self.assertTrue(dispatcher.submit(5, UserQuery("1234")))
+        self.assertTrue(dispatcher.submit(2, UserQuery("1234")))
+        stats = dispatcher.stats()
+        self.assertEqual(stats["Lane depth"], {"user": 2, "normal": 1, "heartbeat": 2})
+        self.assertEqual(stats["Heartbeats merged"], 2)
+
+        # Queue full: the oldest heartbeat is dropped for a user action, not for another heartbeat
+        self.assertTrue(dispatcher.submit(6, StartUseQuery("1234")))
+        self.assertFalse(dispatcher.submit(7, AliveQuery("1.0", "1.2.3.4", "B", 1000)))
+        self.assertEqual(dispatcher.stats()["Dropped by lane"], {"user": 0, "normal": 0, "heartbeat": 2})
+
+        release.set()
+        dispatcher.stop()
+        self.assertEqual(
+            received,
+            [
+                (1, "checkmachine", None),
+                (5, "checkuser", None),
+                (2, "checkuser", None),
+                (6, "startuse", None),
+                (4, "checkmachine", None),
+                (3, "inuse", 2),
+            ],
+        )
+        self.assertEqual(dispatcher.stats()["Dropped"], 2)
+
+        # A heartbeat is processed before a later user action of the same machine
+        started.clear()
+        release.clear()
+        received.clear()
+        dispatcher = MessageDispatcher(callback, nb_workers=1, queue_size=10)
+        dispatcher.start()
+        self.assertTrue(dispatcher.submit(1, MachineQuery()))
+        self.assertTrue(started.wait(5))
+        self.assertTrue(dispatcher.submit(2, InUseQuery("1234", 10)))
+        self.assertTrue(dispatcher.submit(3, UserQuery("1234")))
+        self.assertTrue(dispatcher.submit(2, EndUseQuery("1234", 12)))
+        release.set()
+        dispatcher.stop()
+        self.assertEqual(
+            received,
+            [(1, "checkmachine", None), (3, "checkuser", None), (2, "inuse", 10), (2, "stopuse", 12)],
+        )
+
+    def test_tracing(self):
+        histogram = LatencyHistogram()
+        for ms in range(1, 101):
+            histogram.record(ms / 1000)
+        self.assertAlmostEqual(histogram.percentile(50), 0.050, delta=0.010)
+        self.assertAlmostEqual(histogram.percentile(99), 0.099, delta=0.020)
+        self.assertEqual(histogram.percentile(100), 0.100)
+
+        db = get_simple_db()
+
+        def callback(machine, query):
+            with db.getSession() as session:
+                db.getMachineRepository(session).get_all()
+            lap("handler")
+
+        request_tracer.clear()
+        threshold = request_tracer.slow_threshold_s
+        request_tracer.slow_threshold_s = 0
+        dispatcher = MessageDispatcher(callback, nb_workers=1)
+        dispatcher.start()
+        try:
+            trace = Trace("1")
+            trace.action = "checkuser"
+            trace.lap("parse")
+            with self.assertLogs(level="WARNING") as logs:
+                self.assertTrue(dispatcher.submit(1, UserQuery("1234"), trace))
+                dispatcher.stop()
+        finally:
+            request_tracer.slow_threshold_s = threshold
+
+        self.assertEqual(trace.sql_count, 1)
+        self.assertEqual(set(trace.stages), {"parse", "queue", "sql", "handler"})
+        self.assertIn("Slow checkuser request from machine 1", logs.output[0])
+        stats = request_tracer.stats()
+        self.assertEqual(stats["checkuser"]["count"], 1)
+        self.assertEqual(len(stats["checkuser"]["sql"]), 3)
+        self.assertEqual(request_tracer.slowCount(), 1)
+
+        # Failed statements leave nothing on the pooled connection, and are not charged to a later trace
+        trace = Trace("1")
+        with db.getSession() as session, activate(trace):
+            connection = session.connection()
+            with self.assertRaises(OperationalError):
+                connection.exec_driver_sql("SELECT missing FROM nowhere")
+            connection.exec_driver_sql("SELECT 1")
+            self.assertNotIn("trace_start", connection.info)
+        self.assertEqual(trace.sql_count, 1)
+
+    def test_statistics(self):
+        ring = RingBuffer(10)
+        for value in range(1, 26):
+            ring.append(value)
+        self.assertEqual(len(ring), 10)
+        self.assertEqual(sorted(ring.values()), list(range(16, 26)))
+        self.assertEqual(ring.percentiles(50, 100), [20, 25])
+        self.assertEqual(ring.mean(), 20.5)
+
+        rate = RateCounter(10)
+        for second in range(100, 120):
+            rate.add(second + 0.5)
+            rate.add(second + 0.7)
+        self.assertEqual(rate.rate(119.9, 1000), 2.0)
+        self.assertEqual(rate.rate(125.0, 1000), 0.8, "Old slots are out of the window")
+
+        runtime_stats.clear()
+        trace = Trace("1")
+        trace.action = "checkuser"
+        trace.add("sql", 0.002)
+        trace.add("queue", 0.5)
+        trace.add("handler", 0.004)
+        runtime_stats.recordRequest(trace)
+        runtime_stats.recordError("handler")
+        runtime_stats.sampleQueueDepth(3)
+        stats = runtime_stats.stats()
+        self.assertGreater(stats["Rate (msg/s)"]["checkuser"], 0)
+        self.assertEqual(stats["Handler latency (ms)"]["checkuser"], [4.0, 4.0, 4.0], "Queue wait counted")
+        self.assertEqual(stats["DB time per message (ms)"]["mean"], 2.0)
+        self.assertEqual(stats["Queue depth max"], 3)
+        self.assertEqual(stats["Errors"], {"handler": 1})
+
+        # Host resolved once, statistics published as compact JSON
+        with patch("socket.gethostbyname", return_value="10.0.0.1") as resolve:
+            mqtt = MQTTInterface()
+            mqtt.stats()
+            mqtt.stats()
+        self.assertEqual(resolve.call_count, 1)
+        with patch.object(mqtt, "_publish") as publish:
+            mqtt.publishStats({"Active machines": 2})
+        payload = publish.call_args[0][1]
+        self.assertNotIn(", ", payload)
+        self.assertEqual(json.loads(payload)["Backend IP"], "10.0.0.1")
+        self.assertEqual(json.loads(payload)["Active machines"], 2)
+
+    def test_loopback(self):
+        self.assertTrue(topicMatches("machine/+", "machine/1"))
+        self.assertFalse(topicMatches("machine/+", "machine/1/reply"))
+        self.assertTrue(topicMatches("machine/#", "machine/1/reply"))
+
+        db = get_simple_db()
+        with db.getSession() as session:
+            machine_id = db.getMachineRepository(session).get_all()[0].machine_id
+
+        broker = LoopbackBroker()
+        mqtt = MQTTInterface(lambda client_id: LoopbackTransport(broker, client_id))
+        MsgMapper(mqtt, db).registerHandlers()
+        mqtt.connect()
+        self.assertTrue(mqtt.connected)
+
+        board = LoopbackTransport(broker, "board")
+        board.connect()
+        board.subscribe(f"machine/{machine_id}/reply")
+        try:
+            board.publish(f"machine/{machine_id}", MachineQuery().toJSON())
+            reply = json.loads(board.received.get(timeout=5).payload)
+            self.assertTrue(reply["request_ok"])
+            self.assertTrue(reply["is_valid"])
+
+            board.publish(f"machine/{machine_id}", UserQuery("1234").toJSON())
+            reply = json.loads(board.received.get(timeout=5).payload)
+            self.assertTrue(reply["request_ok"])
+            self.assertTrue(reply["is_valid"])
+            self.assertEqual(reply["name"], "Mario")
+
+            # Replies on machine/<id>/reply are not processed again by the backend
+            self.assertEqual(mqtt.stats()["Received"], 2)
+        finally:
+            board.disconnect()
+            mqtt.disconnect()
+        self.assertFalse(mqtt.connected)
+        self.assertEqual(board.publish(f"machine/{machine_id}", MachineQuery().toJSON()), 4, "MQTT_ERR_NO_CONN")
+
     def test_init(self):
         d = MQTTInterface()
         self.assertIsNotNone(d)
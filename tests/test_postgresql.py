@@ -0,0 +1,134 @@
+""" Test the PostgreSQL mode, against the server of FABOMATIC_TEST_PG_URL (skipped if it is not set). """
+
+# pylint: disable=missing-function-docstring,missing-class-docstring,missing-module-docstring
+
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import text
+from sqlalchemy.exc import InternalError
+
+from FabOMatic.conf import FabConfig
+from FabOMatic.database import transfer
+from FabOMatic.database.engines import MeteredQueuePool, engine_factory
+from FabOMatic.database.models import Machine, Role, User
+from tests.common import add_test_data, get_empty_test_db, get_simple_db
+
+# e.g. postgresql://postgres@127.0.0.1:5432/fabomatic_test, the tables of the database are dropped
+PG_URL = os.environ.get("FABOMATIC_TEST_PG_URL")
+
+
+@unittest.skipIf(PG_URL is None, "FABOMATIC_TEST_PG_URL is not set")
+class TestPostgreSQL(unittest.TestCase):
+    def setUp(self):
+        settings = FabConfig.loadSettings()
+        settings["database"]["url"] = PG_URL
+        patcher = patch.object(FabConfig, "loadSettings", return_value=settings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self._folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self._folder.cleanup)
+
+    def count(self, db, model) -> int:
+        with db.getSession() as session:
+            return session.query(model).count()
+
+    def test_migrations(self):
+        engine = engine_factory.getEngine(PG_URL)
+        engine.dispose()
+        transfer.dropTables(engine)
+        alembic_cfg = Config()
+        alembic_cfg.set_main_option("sqlalchemy.url", PG_URL)
+        alembic_cfg.set_main_option("script_location", transfer.MIGRATIONS_DIR)
+        alembic_cfg.attributes["configure_logger"] = False
+        command.upgrade(alembic_cfg, "head")
+        command.downgrade(alembic_cfg, "base")
+        command.upgrade(alembic_cfg, "head")
+        # Raises if the models and the migrated schema differ
+        command.check(alembic_cfg)
+
+    def test_backend(self):
+        db = get_simple_db()
+        self.assertIsInstance(db.getEngine().pool, MeteredQueuePool)
+        self.assertGreater(db.getSize(), 0)
+        add_test_data(db, 50)
+
+        with db.getSession() as session:
+            machine_ids = [m.machine_id for m in db.getMachineRepository(session).get_all()]
+            machine_repo = db.getMachineRepository(session)
+            total = sum(machine_repo.getTotalUseTime(machine_id) for machine_id in machine_ids)
+            self.assertGreater(total, 0)
+            statuses = db.getMaintenanceCounterRepository(session).getMaintenanceStatus()
+            self.assertGreater(len(statuses), 0)
+            # A long password hash is kept whole
+            user = db.getUserRepository(session).get_all()[0]
+            user.set_password("secret")
+            db.getUserRepository(session).update(user)
+            db.seedAnonymousUser(session, db.seedAnonymousRole(session))
+        self.assertGreater(db.rebuildMaintenanceCounters(), 0)
+        self.assertTrue(db.purge_data(0))
+
+        db.dropContents()
+        with db.getSession() as session:
+            role = Role(role_name="after drop")
+            db.getRoleRepository(session).create(role)
+            self.assertEqual(role.role_id, 1, "Sequences not reset")
+
+        self.assertTrue(db.deleteExistingDatabase())
+        self.assertFalse(db.deleteExistingDatabase(), "No tables left")
+
+    def test_read_engine(self):
+        get_simple_db()
+        read_engine = engine_factory.getReadEngine(PG_URL)
+        self.assertIs(read_engine.pool, engine_factory.getEngine(PG_URL).pool)
+        with read_engine.connect() as connection:
+            self.assertEqual(connection.execute(text("SHOW transaction_read_only")).scalar(), "on")
+            with self.assertRaises(InternalError):
+                connection.execute(text("INSERT INTO roles (role_name) VALUES ('read only')"))
+        with engine_factory.getEngine(PG_URL).connect() as connection:
+            self.assertEqual(connection.execute(text("SHOW transaction_read_only")).scalar(), "off")
+
+    def test_copy_and_restore(self):
+        db = get_simple_db()
+        add_test_data(db, 10)
+        users = self.count(db, User)
+        machines = self.count(db, Machine)
+
+        copy = os.path.join(self._folder.name, "copy.sqldb")
+        db.copy(copy)
+        with sqlite3.connect(copy) as connection:
+            self.assertEqual(connection.execute("SELECT COUNT(*) FROM users").fetchone()[0], users)
+            version = connection.execute("SELECT version_num FROM alembic_version").fetchone()[0]
+        connection.close()
+        self.assertIsNotNone(version)
+
+        db.dropContents()
+        self.assertEqual(self.count(db, User), 0)
+        db.restore(copy)
+        self.assertEqual(self.count(db, User), users)
+        self.assertEqual(self.count(db, Machine), machines)
+        with db.getSession() as session:
+            # The sequences continue after the restored IDs
+            machine = Machine(machine_name="after restore", machine_type_id=1)
+            db.getMachineRepository(session).create(machine)
+            self.assertGreater(machine.machine_id, machines)
+
+    def test_restore_previous_versions(self):
+        db = get_empty_test_db()
+        src_dir = os.path.join(os.path.dirname(__file__), "databases")
+        for file in sorted(os.listdir(src_dir)):
+            with self.subTest(file=file):
+                source = os.path.join(src_dir, file)
+                db.restore(source)
+                if os.path.getsize(source) > 0:
+                    self.assertGreaterEqual(self.count(db, User), 1)
+                    self.assertGreaterEqual(self.count(db, Machine), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+""" Check that the frequent repository queries use indexes instead of scanning the tables. """
+
+# pylint: disable=missing-function-docstring,missing-class-docstring,missing-module-docstring
+
+import re
+import unittest
+from datetime import datetime, timedelta
+
+from sqlalchemy import Engine, event
+
+from FabOMatic.database.models import Maintenance
+from tests.common import get_simple_db, add_test_data
+
+# Tables growing with the activity. Scans of the other tables (users, machines...) are expected.
+GROWING_TABLES = ("uses", "interventions", "unknown_cards", "boards", "authorizations", "maintenance_counters")
+
+# Scans of partial indexes only go through the open uses
+PARTIAL_INDEXES = ("idx_uses_open_machine_id", "idx_uses_open_last_seen")
+
+FULL_SCAN = re.compile(r"^SCAN (\w+)(?: USING (?:COVERING )?INDEX (\w+))?")
+
+
+class TestQueryPlans(unittest.TestCase):
+    def setUp(self):
+        self.db = add_test_data(get_simple_db(), 50)
+        self.statements = []
+        event.listen(Engine, "before_cursor_execute", self._capture)
+
+    def tearDown(self):
+        event.remove(Engine, "before_cursor_execute", self._capture)
+
+    def _capture(self, conn, cursor, statement, parameters, context, executemany):
+        # Queries, and updates or deletes filtered with subqueries
+        if not executemany and "SELECT" in statement.upper():
+            self.statements.append((statement, parameters))
+
+    def assertIndexed(self, name: str, call: callable):
+        self.statements.clear()
+        call()
+        statements = list(self.statements)
+        self.assertGreater(len(statements), 0, f"No query captured for {name}")
+        with self.db.getSession() as session:
+            connection = session.connection()
+            for statement, parameters in statements:
+                plan = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+                for row in plan:
+                    detail = row[-1]
+                    match = FULL_SCAN.match(detail)
+                    if match is None or match.group(1) not in GROWING_TABLES:
+                        continue
+                    if match.group(2) in PARTIAL_INDEXES:
+                        continue
+                    self.fail(f"{name} scans table {match.group(1)}: {detail}\n{statement}")
+
+    def test_query_plans(self):
+        db = self.db
+        past = datetime.now() - timedelta(days=3650)
+        with db.getSession() as session:
+            user_repo = db.getUserRepository(session)
+            machine_repo = db.getMachineRepository(session)
+            use_repo = db.getUseRepository(session)
+            user = [u for u in user_repo.get_all() if u.card_UUID is not None][0]
+            machine = machine_repo.get_all()[0]
+            mid = machine.machine_id
+            maintenance = session.query(Maintenance).first()
+            anonymous = user_repo.get_anonymous()
+
+            queries = {
+                "getUserUses": lambda: user_repo.getUserUses(user),
+                "getUserTotalTime": lambda: user_repo.getUserTotalTime(user.user_id),
+                "IsUserAuthorizedForMachine": lambda: user_repo.IsUserAuthorizedForMachine(machine, user),
+                "getAuthorizedCards": lambda: user_repo.getAuthorizedCards(mid),
+                "isMachineCurrentlyUsed": lambda: machine_repo.isMachineCurrentlyUsed(mid),
+                "getCurrentlyUsedMachines": lambda: machine_repo.getCurrentlyUsedMachines(),
+                "getRelativeUseTime": lambda: machine_repo.getRelativeUseTime(mid),
+                "getRelativeUseTimeByMaintenance": lambda: machine_repo.getRelativeUseTimeByMaintenance(
+                    maintenance.machine_id, maintenance
+                ),
+                "getTotalUseTime": lambda: machine_repo.getTotalUseTime(mid),
+                "getMachineMaintenanceNeeded": lambda: machine_repo.getMachineMaintenanceNeeded(mid),
+                "getMaintenanceStatus": lambda: db.getMaintenanceCounterRepository(session).getMaintenanceStatus(),
+                "Counters rebuild": lambda: db.getMaintenanceCounterRepository(session).rebuild(mid),
+                "getOpenUse": lambda: use_repo.getOpenUse(mid),
+                "startUse": lambda: use_repo.startUse(mid, user),
+                "endUse": lambda: use_repo.endUse(mid, user, 10, False),
+                "endUse without open use": lambda: use_repo.endUse(mid, user, 10, False),
+                "registerBoard": lambda: db.getBoardsRepository(session).registerBoard(
+                    "1.2.3.4", "1.0", "S", 0, machine
+                ),
+                "Uses purge": lambda: use_repo.purge_records(anonymous, past),
+                "Interventions purge": lambda: db.getInterventionRepository(session).purge_records(anonymous, past),
+                "Unknown cards purge": lambda: db.getUnknownCardsRepository(session).purge_records(past),
+                "closeOrphans": lambda: db.closeOrphans(),
+            }
+            for name, call in queries.items():
+                with self.subTest(query=name):
+                    self.assertIndexed(name, call)
+
+
+if __name__ == "__main__":
+    unittest.main()
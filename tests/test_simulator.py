@@ -0,0 +1,40 @@
+""" Test the boards fleet simulator. """
+
+# pylint: disable=missing-function-docstring,missing-class-docstring,missing-module-docstring
+
+import unittest
+
+from FabOMatic.database.models import Authorization
+from FabOMatic.simulator import SimulationReport, loadFleet, setupFleet
+from tests.common import get_empty_test_db
+
+
+class TestSimulator(unittest.TestCase):
+    def test_setup_fleet(self):
+        db = get_empty_test_db()
+        setupFleet(db, 3, 5)
+        setupFleet(db, 4, 5)
+        machine_ids, cards = loadFleet(db)
+        self.assertEqual(len(machine_ids), 4)
+        self.assertEqual(len(cards), 5)
+        with db.getSession() as session:
+            self.assertEqual(session.query(Authorization).count(), 20, "Each user authorized once on each machine")
+            user_repo = db.getUserRepository(session)
+            self.assertEqual(len(user_repo.getAuthorizedCards(machine_ids[-1])), 5)
+
+    def test_report(self):
+        report = SimulationReport()
+        for _ in range(3):
+            report.sent("checkuser")
+        report.record("checkuser", 0.010)
+        report.record("checkuser", 0.020)
+        report.error("checkuser", "timeout")
+        report.sent("alive")
+
+        summary = report.summary()
+        self.assertEqual(summary["checkuser"]["sent"], 3)
+        self.assertEqual(summary["checkuser"]["replies"], 2)
+        self.assertEqual(summary["checkuser"]["error_rate"], 33.3)
+        self.assertAlmostEqual(summary["checkuser"]["latency_ms"][2], 20.0, delta=4)
+        self.assertEqual(summary["alive"]["replies"], 0)
+        self.assertEqual(report.percentile("alive", 95), 0.0)
@@ -0,0 +1,113 @@
+""" Test the SQLite connection settings. """
+
+# pylint: disable=missing-function-docstring,missing-class-docstring,missing-module-docstring
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, text
+
+from FabOMatic.database import sqlite_profile
+from FabOMatic.database.sqlite_profile import SqliteProfile
+from tests.common import get_simple_db
+
+
+class TestSqliteProfile(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._folder.name, "profile.sqldb")
+
+    def tearDown(self):
+        self._folder.cleanup()
+
+    def pragma(self, engine, name):
+        with engine.connect() as connection:
+            return connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+    def test_settings(self):
+        self.assertEqual(SqliteProfile.fromSettings(None), SqliteProfile())
+        profile = SqliteProfile.fromSettings({"journal_mode": "delete", "synchronous": "full", "busy_timeout": 10})
+        self.assertEqual(profile.journal_mode, "DELETE")
+        self.assertEqual(profile.synchronous, "FULL")
+        self.assertIn("PRAGMA busy_timeout=10", profile.pragmas())
+        self.assertIn("PRAGMA query_only=ON", profile.pragmas(read_only=True))
+        self.assertNotIn("PRAGMA journal_mode=DELETE", profile.pragmas(read_only=True))
+
+        for settings in (
+            {"journal_mode": "WAL; DROP TABLE users"},
+            {"synchronous": 1},
+            {"temp_store": "disk"},
+            {"cache_size": "big"},
+            {"mmap_size": -1},
+            {"busy_timeout": True},
+            {"unknown": 1},
+        ):
+            with self.subTest(settings=settings):
+                with self.assertRaises(ValueError):
+                    SqliteProfile.fromSettings(settings)
+
+    def test_apply(self):
+        engine = create_engine("sqlite:///" + self.path)
+        SqliteProfile(cache_size=-2000, mmap_size=1 << 20, busy_timeout=1234).attach(engine)
+        self.assertEqual(self.pragma(engine, "journal_mode"), "wal")
+        self.assertEqual(self.pragma(engine, "synchronous"), 1)  # NORMAL
+        self.assertEqual(self.pragma(engine, "cache_size"), -2000)
+        self.assertEqual(self.pragma(engine, "mmap_size"), 1 << 20)
+        self.assertEqual(self.pragma(engine, "temp_store"), 2)  # MEMORY
+        self.assertEqual(self.pragma(engine, "busy_timeout"), 1234)
+        # Applied along the foreign keys of the models
+        self.assertEqual(self.pragma(engine, "foreign_keys"), 1)
+        sqlite_profile.optimize(engine)
+        engine.dispose()
+
+        engine = create_engine("sqlite:///" + self.path)
+        SqliteProfile(journal_mode="DELETE", synchronous="FULL").attach(engine)
+        self.assertEqual(self.pragma(engine, "journal_mode"), "delete")
+        self.assertEqual(self.pragma(engine, "synchronous"), 2)
+        engine.dispose()
+
+    def test_backup_and_delete(self):
+        engine = create_engine("sqlite:///" + self.path)
+        SqliteProfile().attach(engine)
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE t (v INTEGER)"))
+            connection.execute(text("INSERT INTO t VALUES (1), (2), (3)"))
+        # Connection kept open: the transactions are still in the write-ahead log
+        connection = engine.connect()
+        self.assertTrue(os.path.exists(self.path + "-wal"))
+
+        copy = os.path.join(self._folder.name, "copy.sqldb")
+        sqlite_profile.backup(self.path, copy)
+        with sqlite3.connect(copy) as copy_connection:
+            self.assertEqual(copy_connection.execute("SELECT COUNT(*) FROM t").fetchone()[0], 3)
+        copy_connection.close()
+        connection.close()
+        engine.dispose()
+
+        self.assertTrue(sqlite_profile.removeDatabaseFiles(self.path))
+        for suffix in ("", "-wal", "-shm"):
+            self.assertFalse(os.path.exists(self.path + suffix))
+        self.assertFalse(sqlite_profile.removeDatabaseFiles(self.path))
+
+    def test_backend(self):
+        db = get_simple_db()
+        self.assertEqual(self.pragma(db._engine, "journal_mode"), "wal")
+        self.assertTrue(db.optimize(force=True))
+        self.assertFalse(db.optimize(), "Not due yet")
+
+        copy = os.path.join(self._folder.name, "copy.sqldb")
+        db.copy(copy)
+        with sqlite3.connect(copy) as copy_connection:
+            self.assertGreater(copy_connection.execute("SELECT COUNT(*) FROM machines").fetchone()[0], 0)
+        copy_connection.close()
+
+        self.assertTrue(db.deleteExistingDatabase())
+        path = db._url[len("sqlite:///") :]
+        for suffix in ("", "-wal", "-shm"):
+            self.assertFalse(os.path.exists(path + suffix))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,7 +11,8 @@ import sys
 import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
-from FabOMatic.mqtt.mqtt_types import Parser, SyncCacheQuery, SyncCacheResponse
+from FabOMatic.mqtt.mqtt_types import Parser, SyncCacheQuery, SyncCacheResponse, SyncCacheDeltaResponse
+from FabOMatic.logic.CardSyncTracker import CardSyncTracker
 from FabOMatic.logic.MsgMapper import MsgMapper
 from FabOMatic.database.constants import USER_LEVEL
 
@@ -108,45 +109,14 @@ class TestSyncCacheHandler(unittest.TestCase):
         """Test _getAuthorizedCardsForMachine method."""
         # Mock database session and repositories
         mock_session = MagicMock()
-        mock_machine_repo = Mock()
         mock_user_repo = Mock()
         
         # Properly mock the context manager
         self.mock_db.getSession.return_value = mock_session
-        self.mock_db.getMachineRepository.return_value = mock_machine_repo
         self.mock_db.getUserRepository.return_value = mock_user_repo
         
-        # Mock machine
-        mock_machine = Mock()
-        mock_machine_repo.get_by_id.return_value = mock_machine
-        
-        # Mock users
-        mock_user1 = Mock()
-        mock_user1.disabled = False
-        mock_user1.deleted = False
-        mock_user1.card_UUID = "1234ABCD"
-        # Create mock user level with name attribute
-        mock_normal_level = Mock()
-        mock_normal_level.name = "NORMAL"
-        mock_user1.user_level.return_value = mock_normal_level
-        
-        mock_user2 = Mock()
-        mock_user2.disabled = False
-        mock_user2.deleted = False
-        mock_user2.card_UUID = "5678EFGH"
-        
-        # Create mock user level with name attribute
-        mock_admin_level = Mock()
-        mock_admin_level.name = "ADMIN"
-        mock_user2.user_level.return_value = mock_admin_level
-        
-        mock_user3 = Mock()  # Disabled user - should be skipped
-        mock_user3.disabled = True
-        mock_user3.deleted = False
-        mock_user3.card_UUID = "9ABC0123"
-        
-        mock_user_repo.get_all.return_value = [mock_user1, mock_user2, mock_user3]
-        mock_user_repo.IsUserAuthorizedForMachine.side_effect = lambda machine, user: user != mock_user3
+        # The repository query returns (card_UUID, authorize_all) of the authorized users only
+        mock_user_repo.getAuthorizedCards.return_value = [("1234ABCD", False), ("5678EFGH", True)]
         
         # Test the method
         result = self.msg_mapper._getAuthorizedCardsForMachine(1)
@@ -155,6 +125,7 @@ class TestSyncCacheHandler(unittest.TestCase):
         self.assertEqual(len(result), 2)
         self.assertIn({"uid": "1234ABCD", "level": 1}, result)
         self.assertIn({"uid": "5678EFGH", "level": 2}, result)
+        mock_user_repo.getAuthorizedCards.assert_called_once_with(1)
 
     def test_handle_sync_cache_query(self):
         """Test handleSyncCacheQuery method."""
@@ -220,6 +191,112 @@ class TestSyncCacheHandler(unittest.TestCase):
         self.assertEqual(parsed_result["cards"], [])
 
 
+class TestCardSyncTracker(unittest.TestCase):
+    """Test cases for the versioned card lists."""
+
+    def setUp(self):
+        self.cards = {1: [{"uid": "1234ABCD", "level": 1}]}
+        self.generation = 0
+        self.computed = 0
+
+        def compute(machine_id, session):
+            self.computed += 1
+            return list(self.cards[machine_id])
+
+        self.tracker = CardSyncTracker(compute, lambda: self.generation, max_cards=3)
+
+    def test_versions_and_deltas(self):
+        first = self.tracker.sync(1, None)
+        self.assertEqual(first.cards, [{"uid": "1234ABCD", "level": 1}])
+
+        # No change: nothing computed again, nothing sent
+        unchanged = self.tracker.sync(1, first.version)
+        self.assertEqual(unchanged.version, first.version)
+        self.assertIsNone(unchanged.cards)
+        self.assertEqual((unchanged.added, unchanged.removed), ([], []))
+        self.assertEqual(self.computed, 1)
+
+        # Generation changed, but not the list of this machine
+        self.generation += 1
+        self.assertEqual(self.tracker.sync(1, first.version).version, first.version)
+
+        self.cards[1] = [{"uid": "1234ABCD", "level": 2}, {"uid": "5678EFGH", "level": 1}]
+        self.generation += 1
+        second = self.tracker.sync(1, first.version)
+        self.assertGreater(second.version, first.version)
+        self.assertIsNone(second.cards)
+        self.assertEqual(second.added, [{"uid": "1234ABCD", "level": 2}, {"uid": "5678EFGH", "level": 1}])
+
+        self.cards[1] = [{"uid": "1234ABCD", "level": 2}]
+        self.generation += 1
+        third = self.tracker.sync(1, second.version)
+        self.assertEqual((third.added, third.removed), ([], ["5678EFGH"]))
+
+        # Changes are merged for a board two versions behind
+        merged = self.tracker.sync(1, first.version)
+        self.assertEqual(merged.version, third.version)
+        self.assertEqual((merged.added, merged.removed), ([{"uid": "1234ABCD", "level": 2}], ["5678EFGH"]))
+
+        # Unknown version, e.g. from before a restart
+        self.assertEqual(self.tracker.sync(1, 12345).cards, [{"uid": "1234ABCD", "level": 2}])
+
+    def test_large_lists_sent_in_full(self):
+        first = self.tracker.sync(1, None)
+        self.cards[1] = [{"uid": f"CARD{i}", "level": 1} for i in range(4)]
+        self.generation += 1
+        self.assertEqual(len(self.tracker.sync(1, first.version).cards), 4)
+
+    def test_failed_compute_not_cached(self):
+        first = self.tracker.sync(1, None)
+        failing = self.cards
+        self.cards = {}
+        self.generation += 1
+        with self.assertRaises(KeyError):
+            self.tracker.sync(1, first.version)
+
+        self.cards = failing
+        retry = self.tracker.sync(1, first.version)
+        self.assertEqual(self.computed, 3, "Failure cached")
+        self.assertEqual((retry.version, retry.cards, retry.removed), (first.version, None, []))
+
+    def test_handler_database_error(self):
+        msg_mapper = MsgMapper(Mock(), MagicMock())
+        machine_logic = Mock()
+        machine_logic.getMachineId.return_value = 1
+        cards = [{"uid": "1234ABCD", "level": 1}]
+        generation = Mock(return_value=0)
+        msg_mapper._card_sync._generation = generation
+        with patch.object(msg_mapper, "_getAuthorizedCardsForMachine", return_value=cards):
+            full = json.loads(msg_mapper.handleSyncCacheQuery(machine_logic, SyncCacheQuery()))
+
+        # A failed read after an authorization change is not a list without cards
+        generation.return_value = 1
+        query = Parser.parse(json.dumps({"action": "synccache", "version": full["version"]}))
+        msg_mapper._db.getUserRepository.return_value.getAuthorizedCards.side_effect = Exception("Database error")
+        failed = json.loads(msg_mapper.handleSyncCacheQuery(machine_logic, query))
+        self.assertEqual(failed, {"request_ok": False, "cards": []})
+
+        with patch.object(msg_mapper, "_getAuthorizedCardsForMachine", return_value=cards):
+            retry = json.loads(msg_mapper.handleSyncCacheQuery(machine_logic, query))
+        self.assertEqual(retry, {"request_ok": True, "version": full["version"], "unchanged": True})
+
+    def test_handler_delta_response(self):
+        msg_mapper = MsgMapper(Mock(), Mock())
+        machine_logic = Mock()
+        machine_logic.getMachineId.return_value = 1
+        with patch.object(msg_mapper, "_getAuthorizedCardsForMachine", return_value=self.cards[1]):
+            full = json.loads(msg_mapper.handleSyncCacheQuery(machine_logic, Parser.parse('{"action": "synccache"}')))
+            query = Parser.parse(json.dumps({"action": "synccache", "version": full["version"]}))
+            unchanged = json.loads(msg_mapper.handleSyncCacheQuery(machine_logic, query))
+
+        self.assertEqual(full["cards"], self.cards[1])
+        self.assertEqual(unchanged, {"request_ok": True, "version": full["version"], "unchanged": True})
+        self.assertEqual(
+            json.loads(SyncCacheDeltaResponse(True, 3, [], ["1234ABCD"]).serialize()),
+            {"request_ok": True, "version": 3, "added": [], "removed": ["1234ABCD"]},
+        )
+
+
 class TestSyncCacheIntegration(unittest.TestCase):
     """Integration tests for sync cache functionality."""
 